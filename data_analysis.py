@@ -1,4 +1,6 @@
 import matplotlib.pyplot as plt
+import lib.hotspots as hotspots
+import lib.spatial_index as spatial_index
 # import numpy as np
 # import sklearn
 
@@ -33,3 +35,11 @@ def find_k_neighbors(list_thermal, k):
     return distances
 
 
+def find_k_neighbors_km(list_thermal, k):
+    """Same as find_k_neighbors, with distances in km, using an index."""
+    return spatial_index.ThermalIndex(list_thermal).find_k_neighbors(k)
+
+
+def find_hotspots(list_thermal, eps=1.0, min_samples=5):
+    """Clusters the thermals of a season into hotspots, see lib.hotspots."""
+    return hotspots.find_hotspots(list_thermal, eps, min_samples)
@@ -0,0 +1,238 @@
+import collections
+
+import numpy as np
+
+# Length of the fixed part of a B record: time, position, validity and
+# both altitudes. The B record extensions (if any) follow it.
+B_RECORD_LENGTH = 35
+
+BRecords = collections.namedtuple(
+    'BRecords',
+    ['rawtime', 'lat', 'lon', 'validity', 'press_alt', 'gnss_alt', 'extras'])
+
+# A B record extension declared in an I record: its three letter code, e.g.
+# 'ENL' or 'FXA', and its [start, end) offsets in the extension bytes.
+ExtensionField = collections.namedtuple(
+    'ExtensionField', ['code', 'start', 'end'])
+
+_DIGIT_COLUMNS = (list(range(1, 14)) + list(range(15, 23)) +
+                  list(range(26, 30)) + list(range(31, 35)))
+
+
+def _gather(buf, starts, ends, offset, width):
+    """Gathers fixed-width windows of the buffer into a 2D array.
+
+    Args:
+        buf: a uint8 array, the raw bytes of the records
+        starts: an int array, offsets of the first byte of each record
+        ends: an int array, offsets past the last byte of each record
+        offset: an int, position of the window inside each record
+        width: an int, the width of the window
+
+    Returns:
+        An int16 array of shape (len(starts), width). Positions past the end
+        of a record are filled with zeros.
+    """
+    positions = (starts + offset)[:, np.newaxis] + np.arange(width)
+    inside = positions < ends[:, np.newaxis]
+    if len(buf):
+        chars = np.take(buf, positions, mode='clip').astype(np.int16)
+    else:
+        chars = np.zeros(positions.shape, dtype=np.int16)
+    chars[~inside] = 0
+    return chars
+
+
+def _digits(chars, first, last):
+    """Returns the integer value of the digit columns [first, last)."""
+    value = np.zeros(len(chars), dtype=np.int64)
+    for column in range(first, last):
+        value = value * 10 + (chars[:, column] - ord('0'))
+    return value
+
+
+def _altitude(chars, is_digit, first):
+    """Decodes a 5-character altitude field, optionally starting with '-'."""
+    value = _digits(chars, first + 1, first + 5).astype(np.float64)
+    lead = (chars[:, first] - ord('0')).astype(np.float64)
+    return np.where(is_digit[:, first], lead * 10000.0 + value, -value)
+
+
+def _coordinate(chars, first, deg_digits, negative_char):
+    """Decodes a DDMMmmm latitude or a DDDMMmmm longitude field."""
+    minutes_at = first + deg_digits
+    coordinate = _digits(chars, first, minutes_at).astype(np.float64)
+    coordinate += _digits(chars, minutes_at, minutes_at + 2) / 60.0
+    coordinate += _digits(chars, minutes_at + 2, minutes_at + 5) / 1000.0 / 60.0
+    sign_at = minutes_at + 5
+    return np.where(chars[:, sign_at] == ord(negative_char),
+                    -coordinate, coordinate)
+
+
+def _extras(buf, starts, ends):
+    """Extracts the B record extensions as a bytes array.
+
+    The extension is the longest run of [0-9a-zA-Z-] characters that
+    follows the fixed part of the record.
+    """
+    width = int((ends - starts).max()) - B_RECORD_LENGTH if len(starts) else 0
+    if width <= 0:
+        return np.zeros(len(starts), dtype='S1')
+
+    chars = _gather(buf, starts, ends, B_RECORD_LENGTH, width)
+    allowed = ((chars >= ord('0')) & (chars <= ord('9')) |
+               (chars >= ord('a')) & (chars <= ord('z')) |
+               (chars >= ord('A')) & (chars <= ord('Z')) |
+               (chars == ord('-')))
+    allowed = np.logical_and.accumulate(allowed, axis=1)
+    chars[~allowed] = 0
+    chars = np.ascontiguousarray(chars.astype(np.uint8))
+    return chars.view('S%d' % width).ravel()
+
+
+def decode_B_records(buf, starts, ends):
+    """Decodes B records held in a byte buffer, in bulk.
+
+    Malformed records are rejected exactly like the per-line regular
+    expression in igc_lib does, and fixes with the same time as the
+    previous fix are dropped.
+
+    Args:
+        buf: a uint8 array, e.g. the raw content of an IGC file
+        starts: an int array, offsets of the first byte ('B') of each record
+        ends: an int array, offsets past the last byte of each record,
+        line terminators excluded
+
+    Returns:
+        A BRecords namedtuple of arrays, one row per accepted B record.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    chars = _gather(buf, starts, ends, 0, B_RECORD_LENGTH)
+
+    is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+    ok = chars[:, 0] == ord('B')
+    ok &= is_digit[:, _DIGIT_COLUMNS].all(axis=1)
+    ok &= (chars[:, 14] == ord('N')) | (chars[:, 14] == ord('S'))
+    ok &= (chars[:, 23] == ord('E')) | (chars[:, 23] == ord('W'))
+    ok &= (chars[:, 24] == ord('A')) | (chars[:, 24] == ord('V'))
+    ok &= is_digit[:, 25] | (chars[:, 25] == ord('-'))
+    ok &= is_digit[:, 30] | (chars[:, 30] == ord('-'))
+
+    chars = chars[ok]
+    is_digit = is_digit[ok]
+    starts = starts[ok]
+    ends = ends[ok]
+
+    rawtime = ((_digits(chars, 1, 3) * 60.0 + _digits(chars, 3, 5)) * 60.0 +
+               _digits(chars, 5, 7))
+
+    # The time did not change since the previous fix, ignore such fixes.
+    keep = np.ones(len(rawtime), dtype=bool)
+    keep[1:] = np.fabs(np.diff(rawtime)) >= 1e-5
+    chars = chars[keep]
+    is_digit = is_digit[keep]
+
+    return BRecords(
+        rawtime=rawtime[keep],
+        lat=_coordinate(chars, 7, 2, 'S'),
+        lon=_coordinate(chars, 15, 3, 'W'),
+        validity=chars[:, 24].astype(np.uint8).view('S1'),
+        press_alt=_altitude(chars, is_digit, 25),
+        gnss_alt=_altitude(chars, is_digit, 30),
+        extras=_extras(buf, starts[keep], ends[keep]))
+
+
+def parse_B_records(lines):
+    """Parses B record lines in bulk.
+
+    Args:
+        lines: a list of strings or a list of bytes, the B record lines
+        of a single file, in file order, without line terminators
+
+    Returns:
+        A BRecords namedtuple of arrays, one row per accepted B record.
+    """
+    if lines and not isinstance(lines[0], bytes):
+        data = u'\n'.join(lines).encode('ISO-8859-1')
+    else:
+        data = b'\n'.join(lines)
+    lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+    starts = np.zeros(len(lines), dtype=np.int64)
+    starts[1:] = np.cumsum(lengths[:-1] + 1)
+    return decode_B_records(
+        np.frombuffer(data, dtype=np.uint8), starts, starts + lengths)
+
+
+def parse_I_records(i_records):
+    """Parses the layout of the B record extensions.
+
+    An I record is 'I', the number of extensions on two digits, then for
+    each extension its first and last byte in the B record (1-based, two
+    digits each) and its three letter code, e.g. 'I023638FXA3940SIU'.
+    Malformed extension declarations are skipped.
+
+    Args:
+        i_records: a list of strings, the I records of a file
+
+    Returns:
+        A list of ExtensionField namedtuples, with offsets relative to the
+        end of the fixed part of the B record, i.e. into the extras.
+    """
+    fields = []
+    for record in i_records:
+        record = record.strip()
+        if not record[1:3].isdigit():
+            continue
+        for n in range(int(record[1:3])):
+            declaration = record[3 + 7 * n:10 + 7 * n]
+            if (len(declaration) < 7 or not declaration[:4].isdigit() or
+                    not declaration[4:].isalnum()):
+                break
+            first, last = int(declaration[0:2]), int(declaration[2:4])
+            if first <= B_RECORD_LENGTH or last < first:
+                continue
+            fields.append(ExtensionField(
+                code=declaration[4:].upper(),
+                start=first - 1 - B_RECORD_LENGTH,
+                end=last - B_RECORD_LENGTH))
+    return fields
+
+
+def decode_extensions(extras, fields):
+    """Decodes the B record extensions of all fixes into numeric columns.
+
+    Args:
+        extras: an S array, the extensions of each fix, see BRecords
+        fields: a list of ExtensionField namedtuples, see parse_I_records
+
+    Returns:
+        An OrderedDict, extension code -> float64 array. Values which are
+        missing (short records) or not an optionally negative integer
+        are NaN.
+    """
+    columns = collections.OrderedDict()
+    if not fields:
+        return columns
+
+    extras = np.asarray(extras, dtype='S')
+    width = max(extras.dtype.itemsize, max(field.end for field in fields))
+    chars = np.zeros((len(extras), width), dtype=np.int16)
+    chars[:, :extras.dtype.itemsize] = extras.view(np.uint8).reshape(
+        len(extras), extras.dtype.itemsize)
+    is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+    for field in fields:
+        negative = chars[:, field.start] == ord('-')
+        digits_from = np.where(negative, field.start + 1, field.start)
+        ok = is_digit[:, field.start] | negative
+        value = np.zeros(len(extras), dtype=np.float64)
+        for column in range(field.start, field.end):
+            counted = column >= digits_from
+            ok &= is_digit[:, column] | ~counted
+            value = np.where(counted,
+                             value * 10 + (chars[:, column] - ord('0')), value)
+        value = np.where(negative, -value, value)
+        # The negative sign alone is not a number.
+        ok &= ~negative | (digits_from < field.end)
+        columns[field.code] = np.where(ok, value, np.nan)
+    return columns
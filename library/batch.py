@@ -0,0 +1,214 @@
+import collections
+import concurrent.futures
+import glob
+import os
+
+import igc_lib
+import lib.flight_cache as flight_cache
+import lib.igc_reader as igc_reader
+
+BatchResult = collections.namedtuple(
+    'BatchResult', ['filename', 'valid', 'notes', 'flight'])
+
+
+def _result(filename, flight, transform):
+    """Wraps a loaded flight in a BatchResult.
+
+    For valid flights `flight` is the Flight object, or the output of
+    transform(flight) if transform is set. For invalid flights `flight` is
+    None.
+    """
+    if not flight.valid:
+        return BatchResult(filename, False, flight.notes, None)
+    if transform is not None:
+        return BatchResult(filename, True, flight.notes, transform(flight))
+    return BatchResult(filename, True, flight.notes, flight)
+
+
+def _load_chunk(filenames, config_class, transform, cache_dir, lazy):
+    """Loads a chunk of flights, in a worker process.
+
+    The flights of the chunk are analysed together, see
+    igc_lib.analyze_flights, unless lazy flights are requested.
+
+    Returns:
+        A list of BatchResults, in the order of filenames.
+    """
+    cache = None
+    if cache_dir is not None:
+        cache = flight_cache.FlightCache(cache_dir, config_class=config_class)
+        # Cached flights are always fully analysed.
+        lazy = False
+
+    results = [None] * len(filenames)
+    # (position, filename, flight) of the flights to be analysed.
+    loaded = []
+    for position, filename in enumerate(filenames):
+        try:
+            flight = None
+            if cache is not None:
+                flight = cache.load(filename)
+            if flight is None:
+                cached = False
+                flight = igc_lib.Flight.create_from_file(
+                    filename, config_class, lazy=True)
+            else:
+                cached = True
+        except (IOError, OSError) as error:
+            results[position] = BatchResult(
+                filename, False,
+                ["Error: could not read the file: %s" % error], None)
+            continue
+        except ValueError as error:
+            # Malformed records, e.g. an impossible date.
+            results[position] = BatchResult(
+                filename, False,
+                ["Error: could not parse the file: %s" % error], None)
+            continue
+        if cached:
+            results[position] = _result(filename, flight, transform)
+            continue
+        loaded.append((position, filename, flight))
+
+    if not lazy:
+        igc_lib.analyze_flights([flight for _, _, flight in loaded])
+    for position, filename, flight in loaded:
+        if cache is not None:
+            cache.store(filename, flight)
+        results[position] = _result(filename, flight, transform)
+    return results
+
+
+def _chunks(items, chunk_size):
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def iter_flights(filenames, config_class=igc_lib.FlightParsingConfig,
+                 workers=None, chunk_size=8, ordered=False, transform=None,
+                 cache_dir=None, lazy=False):
+    """Loads many IGC files in parallel, yielding results as they finish.
+
+    Files are sent to a pool of worker processes in chunks of chunk_size
+    files, to amortise the inter-process communication. At most two chunks
+    per worker are in flight at any time, which bounds the memory used by
+    results waiting to be consumed.
+
+    Args:
+        filenames: a list of strings, the IGC files to be loaded; any
+        source accepted by igc_reader.open_source, e.g. archive members
+        config_class: a class that implements FlightParsingConfig, it must
+        be picklable (i.e. defined at the top level of a module)
+        workers: an int, the number of worker processes; defaults to the
+        number of CPUs. With workers=1 files are loaded in this process.
+        chunk_size: an int, the number of files sent to a worker at once;
+        the flights of a chunk are analysed together, see
+        igc_lib.analyze_flights: their Viterbi decoding is vectorized
+        across flights only for chunks of 4 flights or more, larger
+        chunks are faster for large corpora but delay the first results
+        ordered: a bool, whether to yield the results in the order of
+        filenames (otherwise in the order in which the chunks finish)
+        transform: an optional picklable function, applied to every valid
+        Flight in the worker; its output is sent back instead of the
+        Flight, e.g. to return only the thermals
+        cache_dir: an optional string, the directory of a
+        flight_cache.FlightCache used to skip parsing and analysis of
+        already seen files
+        lazy: a bool, whether to create lazy flights, which run only the
+        analysis stages needed by the caller; ignored when cache_dir is set,
+        as cached flights are always fully analysed
+
+    Yields:
+        BatchResult namedtuples (filename, valid, notes, flight). Invalid
+        flights are yielded too, with flight set to None and the reasons
+        in notes.
+    """
+    filenames = list(filenames)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = _chunks(filenames, max(1, chunk_size))
+
+    if workers <= 1:
+        for chunk in chunks:
+            for result in _load_chunk(
+                    chunk, config_class, transform, cache_dir, lazy):
+                yield result
+        return
+
+    max_pending = 2 * workers
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+
+        def submit_next():
+            chunk = next(chunks, None)
+            if chunk is not None:
+                pending.append(executor.submit(
+                    _load_chunk, chunk, config_class, transform, cache_dir,
+                    lazy))
+
+        for _ in range(max_pending):
+            submit_next()
+
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+            submit_next()
+            for result in future.result():
+                yield result
+
+
+def list_directory(directory, pattern=None):
+    """Lists the IGC sources of a directory.
+
+    Args:
+        directory: a string, the directory to be scanned
+        pattern: an optional string, the glob pattern of the files to be
+        loaded; by default all plain and compressed IGC files are listed,
+        and zip and tar archives are expanded to their IGC members, see
+        igc_reader.find_sources
+
+    Returns:
+        A sorted list of strings, the sources accepted by iter_flights.
+    """
+    if pattern is None:
+        return igc_reader.find_sources(directory)
+    return sorted(glob.glob(os.path.join(directory, pattern)))
+
+
+def iter_directory(directory, pattern=None, **kwargs):
+    """Loads all IGC files of a directory in parallel.
+
+    Archive members are loaded independently, so an archive is spread
+    over the workers like a directory of files.
+
+    Args:
+        directory: a string, the directory to be scanned
+        pattern: an optional string, see list_directory
+        **kwargs: passed to iter_flights
+
+    Yields:
+        BatchResult namedtuples, see iter_flights.
+    """
+    filenames = list_directory(directory, pattern)
+    return iter_flights(filenames, **kwargs)
+
+
+def load_flights(filenames, **kwargs):
+    """Loads many IGC files in parallel, keeping only the valid flights.
+
+    Args:
+        filenames: a list of strings, the IGC files to be loaded
+        **kwargs: passed to iter_flights; ordered defaults to True
+
+    Returns:
+        A list of Flight objects (or transform outputs), in the order
+        of filenames.
+    """
+    kwargs.setdefault('ordered', True)
+    return [result.flight for result in iter_flights(filenames, **kwargs)
+            if result.valid]
@@ -0,0 +1,298 @@
+import collections
+import concurrent.futures
+import os
+
+import numpy as np
+
+import igc_lib
+import lib.batch as batch
+
+# The expected counts of a hidden Markov model over a set of emission
+# sequences, i.e. the sufficient statistics of Baum-Welch. Statistics of
+# disjoint sets of sequences are merged by adding them, see
+# merge_statistics.
+#   init_counts: float64 array (N,), expected number of sequences starting
+#   in every state
+#   transition_counts: float64 array (N, N), expected number of transitions
+#   emission_counts: float64 array (N, M), expected number of emissions
+#   log_likelihood: a float, the log-likelihood of the sequences
+#   num_sequences: an int, the number of sequences
+BaumWelchStatistics = collections.namedtuple(
+    'BaumWelchStatistics',
+    ['init_counts', 'transition_counts', 'emission_counts', 'log_likelihood',
+     'num_sequences'])
+
+
+def _log(probs):
+    with np.errstate(divide='ignore'):
+        return np.log(np.asarray(probs, dtype=np.float64))
+
+
+def _logsumexp(values, axis):
+    """Computes log(sum(exp(values))) along an axis, without overflows."""
+    peak = np.max(values, axis=axis, keepdims=True)
+    peak[~np.isfinite(peak)] = 0.0
+    with np.errstate(divide='ignore'):
+        return (np.log(np.sum(np.exp(values - peak), axis=axis)) +
+                np.squeeze(peak, axis=axis))
+
+
+def empty_statistics(num_states, num_emissions):
+    """Returns the statistics of no sequence."""
+    return BaumWelchStatistics(
+        init_counts=np.zeros(num_states),
+        transition_counts=np.zeros((num_states, num_states)),
+        emission_counts=np.zeros((num_states, num_emissions)),
+        log_likelihood=0.0, num_sequences=0)
+
+
+def merge_statistics(statistics):
+    """Adds up a non-empty list of BaumWelchStatistics."""
+    statistics = list(statistics)
+    return BaumWelchStatistics(*[
+        sum(values[1:], values[0]) for values in zip(*statistics)])
+
+
+def _sorted_statistics(model, sequences):
+    """Computes the statistics of non-empty sequences sorted by
+    decreasing length, see expected_statistics."""
+    init_log, transition_log, emission_log = [_log(probs) for probs in model]
+    num_states, num_emissions = emission_log.shape
+    lengths = np.array([len(sequence) for sequence in sequences])
+    num_steps = lengths[0]
+    columns = np.arange(len(sequences))
+    # active[t] is the number of sequences longer than t, these are the
+    # first active[t] sequences.
+    active = np.searchsorted(-lengths, -np.arange(num_steps),
+                             side='left').tolist()
+    emissions = np.zeros((num_steps, len(sequences)), dtype=np.intp)
+    for column, sequence in enumerate(sequences):
+        emissions[:len(sequence), column] = sequence
+
+    # Forward pass: forward[t][j][s] is the log-probability of the first
+    # t + 1 emissions of sequence s, ending in state j.
+    forward = np.full((num_steps, num_states, len(sequences)), -np.inf)
+    forward[0] = init_log[:, np.newaxis] + emission_log[:, emissions[0]]
+    transition_log = transition_log[:, :, np.newaxis]
+    for step in range(1, num_steps):
+        count = active[step]
+        forward[step, :, :count] = (
+            _logsumexp(forward[step - 1, :, np.newaxis, :count] +
+                       transition_log, axis=0) +
+            emission_log[:, emissions[step, :count]])
+    log_likelihood = _logsumexp(forward[lengths - 1, :, columns], axis=1)
+
+    # Backward pass: backward[i][s] is the log-probability of the emissions
+    # of sequence s after the current step, given state i at this step.
+    # It is 0 at the last step of every sequence. The forward log-
+    # probabilities are replaced by the state probabilities on the way.
+    backward = np.zeros((num_states, len(sequences)))
+    transition_counts = np.zeros((num_states, num_states))
+    for step in range(num_steps - 1, 0, -1):
+        count = active[step]
+        # after[j][s]: the emission at step and all the following ones,
+        # given state j at step.
+        after = (emission_log[:, emissions[step, :count]] +
+                 backward[:, :count])
+        pairs = (forward[step - 1, :, np.newaxis, :count] + transition_log +
+                 after[np.newaxis] - log_likelihood[:count])
+        transition_counts += np.sum(np.exp(pairs), axis=-1)
+        forward[step, :, :count] = np.exp(
+            forward[step, :, :count] + backward[:, :count] -
+            log_likelihood[:count])
+        backward[:, :count] = _logsumexp(
+            transition_log + after[np.newaxis], axis=1)
+    forward[0] = np.exp(forward[0] + backward - log_likelihood)
+    state_probs = forward
+
+    valid = np.arange(num_steps)[:, np.newaxis] < lengths[np.newaxis, :]
+    emission_counts = np.stack([
+        np.bincount(emissions[valid], weights=state_probs[:, state][valid],
+                    minlength=num_emissions)
+        for state in range(num_states)])
+    return BaumWelchStatistics(
+        init_counts=np.sum(state_probs[0], axis=-1),
+        transition_counts=transition_counts,
+        emission_counts=emission_counts,
+        log_likelihood=float(np.sum(log_likelihood)),
+        num_sequences=len(sequences))
+
+
+def expected_statistics(model, sequences, batch_size=64):
+    """Runs the E step of Baum-Welch: forward-backward over sequences.
+
+    Everything is computed in log space, so long sequences do not
+    underflow. Like viterbi.ViterbiDecoder.decode_batch, the sequences are
+    sorted by length and processed in batches, stepping through time once
+    per batch, vectorized across the sequences and the states of the batch.
+
+    Args:
+        model: an (init, transition, emission) tuple of probabilities of an
+        HMM with N states and M emission letters, see
+        FlightParsingConfig.flying_model
+        sequences: a list of emission lists or int arrays, 0 .. M - 1
+        batch_size: an int, the number of sequences processed together; the
+        forward log-probabilities of a batch take 8 x N x batch_size x
+        (length of the longest sequence) bytes
+
+    Returns:
+        A BaumWelchStatistics namedtuple.
+    """
+    num_states, num_emissions = np.shape(model[2])
+    sequences = [np.asarray(sequence, dtype=np.intp)
+                 for sequence in sequences]
+    sequences = sorted((sequence for sequence in sequences if len(sequence)),
+                       key=len, reverse=True)
+    statistics = [empty_statistics(num_states, num_emissions)]
+    for start in range(0, len(sequences), batch_size):
+        statistics.append(_sorted_statistics(
+            model, sequences[start:start + batch_size]))
+    return merge_statistics(statistics)
+
+
+def maximize(statistics, pseudo_count=1.0):
+    """Runs the M step of Baum-Welch: estimates the probabilities of a model.
+
+    Args:
+        statistics: a BaumWelchStatistics namedtuple
+        pseudo_count: a float, added to every expected count, so that no
+        probability is estimated to 0 from a finite corpus
+
+    Returns:
+        An (init, transition, emission) tuple of probabilities, as nested
+        tuples of floats.
+    """
+    def normalize(counts):
+        counts = counts + pseudo_count
+        probs = counts / np.sum(counts, axis=-1, keepdims=True)
+        if probs.ndim == 1:
+            return tuple(probs.tolist())
+        return tuple(tuple(row) for row in probs.tolist())
+
+    return (normalize(statistics.init_counts),
+            normalize(statistics.transition_counts),
+            normalize(statistics.emission_counts))
+
+
+def train(sequences, model, max_iterations=50, tolerance=1e-7, workers=1,
+          chunk_size=64, pseudo_count=1.0):
+    """Fits the probabilities of an HMM to emission sequences (Baum-Welch).
+
+    The sequences are split in chunks of chunk_size sequences, whose
+    statistics are computed by a pool of worker processes and merged, at
+    every iteration.
+
+    Args:
+        sequences: a list of emission lists or int arrays
+        model: an (init, transition, emission) tuple of probabilities, the
+        initial model, see FlightParsingConfig.flying_model
+        max_iterations: an int, the maximum number of iterations
+        tolerance: a float, training stops when the log-likelihood improves
+        by less than tolerance, relative
+        workers: an int, the number of worker processes; with workers=1
+        the statistics are computed in this process
+        chunk_size: an int, the number of sequences sent to a worker at once
+        pseudo_count: a float, see maximize
+
+    Returns:
+        A (model, log_likelihoods) pair: the fitted model, as nested tuples,
+        and the list of the log-likelihoods of the sequences under the model
+        of every iteration (before its update).
+    """
+    sequences = list(sequences)
+    chunks = [sequences[start:start + chunk_size]
+              for start in range(0, len(sequences), chunk_size)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = None
+    if workers > 1 and len(chunks) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+    log_likelihoods = []
+    try:
+        for _ in range(max_iterations):
+            if executor is not None:
+                statistics = list(executor.map(
+                    expected_statistics, [model] * len(chunks), chunks))
+            else:
+                statistics = [expected_statistics(model, chunk)
+                              for chunk in chunks]
+            num_states, num_emissions = np.shape(model[2])
+            statistics = merge_statistics(
+                [empty_statistics(num_states, num_emissions)] + statistics)
+            log_likelihoods.append(statistics.log_likelihood)
+            model = maximize(statistics, pseudo_count)
+            if (len(log_likelihoods) > 1 and
+                    log_likelihoods[-1] - log_likelihoods[-2] <=
+                    tolerance * abs(log_likelihoods[-1])):
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return model, log_likelihoods
+
+
+def flying_emissions(flight):
+    """Returns the standing/flying emissions of a Flight, as int8 array."""
+    return flight._flying_emissions()
+
+
+def circling_emissions(flight):
+    """Returns the straight/circling emissions of a Flight, as int8 array.
+
+    They depend on the flight detection, i.e. on the flying model of the
+    configuration of the flight.
+    """
+    return flight._circling_emissions()
+
+
+def load_emissions(filenames, emissions=flying_emissions,
+                   config_class=igc_lib.FlightParsingConfig, **kwargs):
+    """Loads the emissions of the valid flights of many IGC files.
+
+    Only the analysis stages needed by the emissions are run.
+
+    Args:
+        filenames: a list of strings, the IGC files
+        emissions: flying_emissions or circling_emissions
+        config_class: a class that implements FlightParsingConfig
+        **kwargs: passed to batch.load_flights, e.g. workers
+
+    Returns:
+        A list of int8 arrays, one per valid flight.
+    """
+    return batch.load_flights(filenames, config_class=config_class,
+                              transform=emissions, lazy=True, **kwargs)
+
+
+def train_config_models(filenames, config_class=igc_lib.FlightParsingConfig,
+                        workers=None, **kwargs):
+    """Fits the flying and the circling models of a configuration.
+
+    Both models are fit on the flights of the files, starting from the
+    models of config_class. The circling emissions are taken from the
+    flight detection of config_class. To use the fitted models, set them
+    in a subclass of the configuration:
+
+        class TrainedConfig(igc_lib.FlightParsingConfig):
+            flying_model = ...
+            circling_model = ...
+
+    Args:
+        filenames: a list of strings, the IGC files
+        config_class: a class that implements FlightParsingConfig
+        workers: an int, the number of worker processes used to load the
+        files and to compute the statistics; defaults to the number of CPUs
+        **kwargs: passed to train
+
+    Returns:
+        A (flying_model, circling_model) pair.
+    """
+    config = config_class()
+    models = []
+    for emissions, model in [(flying_emissions, config.flying_model),
+                             (circling_emissions, config.circling_model)]:
+        sequences = load_emissions(filenames, emissions, config_class,
+                                   workers=workers)
+        model, _ = train(sequences, model, workers=workers, **kwargs)
+        models.append(model)
+    return tuple(models)
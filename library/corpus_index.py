@@ -0,0 +1,146 @@
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+
+import igc_lib
+import lib.batch as batch
+import lib.igc_reader as igc_reader
+
+INDEX_FIELDS = ['filename', 'size', 'mtime', 'date', 'glider_type',
+                'competition_class', 'fr_manuf_code', 'fr_uniq_id',
+                'fr_recorder_type']
+
+# A lightweight description of an IGC file, built from its header only.
+# Header fields missing from the file (or from unreadable files) are None.
+IndexRecord = collections.namedtuple('IndexRecord', INDEX_FIELDS)
+
+
+def scan_header(filename):
+    """Builds the IndexRecord of a single file from its header records.
+
+    Args:
+        filename: a string, the name of the IGC file
+
+    Returns:
+        An IndexRecord.
+    """
+    values = dict.fromkeys(INDEX_FIELDS)
+    values['filename'] = filename
+    try:
+        values['size'], values['mtime'] = igc_reader.source_stat(filename)
+        header = igc_lib.FlightHeader.create_from_file(filename)
+    except (IOError, OSError, ValueError):
+        # Unreadable file or malformed date record.
+        return IndexRecord(**values)
+    for field in INDEX_FIELDS[3:]:
+        values[field] = getattr(header, field, None)
+    return IndexRecord(**values)
+
+
+def build_index(filenames, workers=None, chunk_size=64, previous=None):
+    """Scans the headers of many IGC files in parallel.
+
+    Args:
+        filenames: a list of strings, the IGC files to be indexed
+        workers: an int, the number of worker processes; defaults to the
+        number of CPUs. With workers=1 files are scanned in this process.
+        chunk_size: an int, the number of files sent to a worker at once
+        previous: an optional list of IndexRecords, e.g. a loaded index;
+        records of files with unchanged size and modification time are
+        reused instead of being scanned again
+
+    Returns:
+        A list of IndexRecords, in the order of filenames.
+    """
+    filenames = list(filenames)
+    known = dict((record.filename, record) for record in previous or [])
+
+    def is_fresh(filename):
+        record = known.get(filename)
+        if record is None:
+            return False
+        try:
+            return (record.size, record.mtime) == igc_reader.source_stat(
+                filename)
+        except (IOError, OSError):
+            return False
+
+    to_scan = [filename for filename in filenames if not is_fresh(filename)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(to_scan) <= chunk_size:
+        scanned = [scan_header(filename) for filename in to_scan]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            scanned = list(executor.map(scan_header, to_scan,
+                                        chunksize=chunk_size))
+    known.update((record.filename, record) for record in scanned)
+    return [known[filename] for filename in filenames]
+
+
+def build_directory_index(directory, pattern=None, index_filename=None,
+                          **kwargs):
+    """Indexes all IGC files of a directory, optionally persisting the index.
+
+    Args:
+        directory: a string, the directory to be scanned
+        pattern: an optional string, see batch.list_directory
+        index_filename: an optional string, a JSON index file; if it exists
+        it is used to skip unchanged files, then it is updated
+        **kwargs: passed to build_index
+
+    Returns:
+        A list of IndexRecords, sorted by filename.
+    """
+    filenames = batch.list_directory(directory, pattern)
+    if index_filename is not None and os.path.isfile(index_filename):
+        kwargs.setdefault('previous', load_index(index_filename))
+    records = build_index(filenames, **kwargs)
+    if index_filename is not None:
+        save_index(records, index_filename)
+    return records
+
+
+def save_index(records, index_filename):
+    """Saves a list of IndexRecords to a JSON file."""
+    rows = []
+    for record in records:
+        row = record._asdict()
+        if row['date'] is not None:
+            row['date'] = row['date'].isoformat()
+        rows.append(row)
+    tmp_filename = index_filename + '.tmp'
+    with open(tmp_filename, 'w') as index_file:
+        json.dump(rows, index_file)
+    os.replace(tmp_filename, index_filename)
+
+
+def load_index(index_filename):
+    """Loads a list of IndexRecords saved by save_index."""
+    with open(index_filename, 'r') as index_file:
+        rows = json.load(index_file)
+    records = []
+    for row in rows:
+        if row['date'] is not None:
+            row['date'] = datetime.datetime.strptime(
+                row['date'], '%Y-%m-%d').date()
+        records.append(IndexRecord(**row))
+    return records
+
+
+def group_by(records, field):
+    """Groups index records by the value of one of their fields.
+
+    Args:
+        records: a list of IndexRecords
+        field: a string, the name of the field, e.g. 'date' or 'glider_type'
+
+    Returns:
+        A dict, field value -> list of IndexRecords, in input order.
+    """
+    groups = collections.OrderedDict()
+    for record in records:
+        groups.setdefault(getattr(record, field), []).append(record)
+    return groups
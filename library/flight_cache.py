@@ -0,0 +1,287 @@
+import collections
+import datetime
+import hashlib
+import importlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+import igc_lib
+import lib.igc_reader as igc_reader
+
+# Bump when the layout of the cache entries changes.
+CACHE_FORMAT_VERSION = 4
+
+# Modules whose source defines the content of a cached flight. A change in
+# any of them invalidates the whole cache.
+_LIBRARY_MODULES = ['igc_lib', 'lib.b_records', 'lib.igc_reader',
+                    'lib.geo', 'lib.viterbi']
+
+_FIX_REFERENCES = ['takeoff_fix', 'landing_fix']
+
+_SEGMENT_TABLES = ['thermal_segments', 'glide_segments']
+
+
+def _library_fingerprint():
+    """Computes a hash of the library version, i.e. of its source code."""
+    digest = hashlib.sha1(str(CACHE_FORMAT_VERSION).encode('ascii'))
+    for name in _LIBRARY_MODULES:
+        module = importlib.import_module(name)
+        with open(module.__file__, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def config_fingerprint(config):
+    """Computes a hash of the parameter values of a FlightParsingConfig."""
+    values = sorted(
+        (name, repr(getattr(config, name))) for name in dir(config)
+        if not name.startswith('_') and not callable(getattr(config, name)))
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def file_hash(filename):
+    """Computes a hash of the (decompressed) content of an IGC source."""
+    digest = hashlib.sha1()
+    with igc_reader.open_source(filename) as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _encode_meta(value):
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, list) and all(isinstance(x, str) for x in value):
+        return value
+    raise TypeError("can not cache flight attribute of type %s" % type(value))
+
+
+def _decode_meta(value):
+    if isinstance(value, dict) and '__date__' in value:
+        return datetime.datetime.strptime(
+            value['__date__'], '%Y-%m-%d').date()
+    return value
+
+
+def flight_to_arrays(flight):
+    """Serializes a Flight into a dict of arrays.
+
+    Lazy flights are analysed first, so that all the results are stored.
+
+    Args:
+        flight: an igc_lib.Flight, valid or not
+
+    Returns:
+        A dict of NumPy arrays, suitable for numpy.savez.
+    """
+    flight.analyze()
+    arrays = {}
+    for name, column in vars(flight.fixes).items():
+        if isinstance(column, np.ndarray):
+            arrays['fixes.' + name] = column
+    for code, column in flight.fixes.extensions.items():
+        arrays['extensions.' + code] = column
+
+    meta = {}
+    for name, value in vars(flight).items():
+        if name.startswith('_') or name in ['fixes', 'thermals', 'glides']:
+            continue
+        if name in _FIX_REFERENCES:
+            meta[name] = {'__fix__': value.index}
+        elif name in _SEGMENT_TABLES:
+            for field, column in zip(value._fields, value):
+                arrays[name + '.' + field] = column
+        elif isinstance(value, np.ndarray):
+            arrays['flight.' + name] = value
+        else:
+            meta[name] = _encode_meta(value)
+    arrays['meta'] = np.array(json.dumps(meta, sort_keys=True))
+    return arrays
+
+
+def flight_from_arrays(arrays, config):
+    """Rebuilds a Flight serialized by flight_to_arrays.
+
+    No parsing and no analysis is done, all the results are restored.
+
+    Args:
+        arrays: a dict-like of NumPy arrays
+        config: a FlightParsingConfig instance
+
+    Returns:
+        An igc_lib.Flight.
+    """
+    fixes = igc_lib.FixArray.__new__(igc_lib.FixArray)
+    fixes.extensions = collections.OrderedDict()
+    for key in arrays.keys():
+        if key.startswith('fixes.'):
+            setattr(fixes, key[len('fixes.'):], arrays[key])
+        elif key.startswith('extensions.'):
+            fixes.extensions[key[len('extensions.'):]] = arrays[key]
+
+    flight = igc_lib.Flight.__new__(igc_lib.Flight)
+    flight._config = config
+    # Thermal and Glide objects are built from the segment tables on
+    # first access.
+    flight._stages_done = set(igc_lib.Flight._STAGES) - {'thermals'}
+    flight.fixes = fixes
+    fixes.flight = flight
+    for key in arrays.keys():
+        if key.startswith('flight.'):
+            setattr(flight, key[len('flight.'):], arrays[key])
+    for name, value in json.loads(str(arrays['meta'])).items():
+        if isinstance(value, dict) and '__fix__' in value:
+            setattr(flight, name, fixes[value['__fix__']])
+        else:
+            setattr(flight, name, _decode_meta(value))
+
+    for name in _SEGMENT_TABLES:
+        if name + '.enter_index' in arrays:
+            setattr(flight, name, igc_lib.SegmentTable(*[
+                arrays[name + '.' + field]
+                for field in igc_lib.SegmentTable._fields]))
+    return flight
+
+
+class FlightCache(object):
+    """A persistent, content-addressed cache of parsed and analysed flights.
+
+    Entries are keyed by the hash of the IGC file content, the fingerprint
+    of the FlightParsingConfig values and the library version, so they are
+    invalidated automatically when any of these change. Each entry is an
+    uncompressed .npz file holding the fix columns (raw and derived), the
+    flight metadata, the thermals and the glides. The total size of the
+    cache is bounded, least recently used entries are evicted first.
+
+    The cache keeps a running estimate of its size, so the directory is
+    only scanned when the estimate crosses max_bytes, or every
+    rescan_stores stores (other processes may share the directory). An
+    eviction then shrinks the cache to low_water * max_bytes, so that
+    filling a full cache does not scan the directory at every store.
+
+    Attributes:
+        directory: a string, the directory holding the cache entries
+        max_bytes: an int, the maximum total size of the entries
+        config_class: a class that implements FlightParsingConfig
+        low_water: a float, the fraction of max_bytes left by an eviction
+        rescan_stores: an int, the number of stores between two scans of
+        the directory
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30,
+                 config_class=igc_lib.FlightParsingConfig, low_water=0.9,
+                 rescan_stores=256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.config_class = config_class
+        self.low_water = low_water
+        self.rescan_stores = rescan_stores
+        # The estimated total size of the entries, None until the directory
+        # is scanned, and the number of stores since the last scan.
+        self._total_bytes = None
+        self._stores = 0
+        self._config = config_class()
+        self._suffix = hashlib.sha1(
+            (config_fingerprint(self._config) +
+             _library_fingerprint()).encode('ascii')).hexdigest()[:16]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def entry_path(self, filename):
+        """Returns the path of the cache entry of the file."""
+        name = '%s-%s.npz' % (file_hash(filename), self._suffix)
+        return os.path.join(self.directory, name)
+
+    def _load_entry(self, path):
+        try:
+            with np.load(path, allow_pickle=False) as arrays:
+                flight = flight_from_arrays(
+                    {key: arrays[key] for key in arrays.files}, self._config)
+        except (IOError, OSError):
+            return None
+        except (ValueError, KeyError, zipfile.BadZipFile):
+            # A truncated or corrupt entry, counted as a miss.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return flight
+
+    def _store_entry(self, path, flight):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp_file:
+            np.savez(tmp_file, **flight_to_arrays(flight))
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        self._stores += 1
+        if self._total_bytes is not None:
+            self._total_bytes += size
+        if (self._total_bytes is None or
+                self._total_bytes > self.max_bytes or
+                self._stores >= self.rescan_stores):
+            self.evict()
+
+    def load(self, filename):
+        """Returns the cached Flight for the file, or None on a cache miss."""
+        return self._load_entry(self.entry_path(filename))
+
+    def store(self, filename, flight):
+        """Stores the Flight built from the file, then evicts old entries."""
+        self._store_entry(self.entry_path(filename), flight)
+
+    def get_flight(self, filename):
+        """Returns the Flight for the file, from the cache if possible."""
+        path = self.entry_path(filename)
+        flight = self._load_entry(path)
+        if flight is None:
+            flight = igc_lib.Flight.create_from_file(
+                filename, self.config_class)
+            self._store_entry(path, flight)
+        return flight
+
+    def evict(self):
+        """Scans the directory and, if the cache is larger than max_bytes,
+        removes least recently used entries down to low_water * max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.low_water * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        self._total_bytes = total
+        self._stores = 0
+
+    def clear(self):
+        """Removes all entries."""
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.directory, name))
+        self._total_bytes = 0
@@ -0,0 +1,205 @@
+import collections
+
+import numpy as np
+
+import lib.spatial_index as spatial_index
+
+# The per-thermal values needed by the season-wide analyses, as arrays.
+#   lat, lon: float64 arrays, the centres of the thermals, degrees
+#   vertical_velocity: float64 array, average climb rate, m/s
+#   alt_change: float64 array, altitude gained, meters
+#   timestamp: float64 array, entry time (since epoch), UTC, seconds
+ThermalTable = collections.namedtuple(
+    'ThermalTable',
+    ['lat', 'lon', 'vertical_velocity', 'alt_change', 'timestamp'])
+
+# Statistics of the hotspots, one row per cluster label.
+#   lat, lon: float64 arrays, the centroids of the clusters, degrees
+#   count: int64 array, the number of thermals
+#   mean_vertical_velocity: float64 array, m/s
+#   mean_alt_change: float64 array, meters
+#   hour_counts: int64 array of shape (num_clusters, 24), the number of
+#   thermals entered during each hour of the day, UTC
+#   num_dates: int64 array, the number of distinct days with thermals;
+#   hotspots found on a single day are likely coincidences
+Hotspots = collections.namedtuple(
+    'Hotspots',
+    ['lat', 'lon', 'count', 'mean_vertical_velocity', 'mean_alt_change',
+     'hour_counts', 'num_dates'])
+
+_DAY = 24.0 * 60.0 * 60.0
+
+
+def thermal_table(thermals):
+    """Extracts a ThermalTable from a list of igc_lib.Thermal objects."""
+    lat, lon = spatial_index.thermal_positions(thermals)
+    return ThermalTable(
+        lat=lat, lon=lon,
+        vertical_velocity=np.array(
+            [thermal.vertical_velocity() for thermal in thermals],
+            dtype=np.float64),
+        alt_change=np.array([thermal.alt_change() for thermal in thermals],
+                            dtype=np.float64),
+        timestamp=np.array([thermal.enter_fix.timestamp
+                            for thermal in thermals], dtype=np.float64))
+
+
+def _find(parent, nodes):
+    """Finds the roots of nodes in a union-find forest, compressing paths."""
+    roots = parent[nodes]
+    while True:
+        next_roots = parent[roots]
+        if np.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+    parent[nodes] = roots
+    return roots
+
+
+def _union(parent, a, b):
+    """Merges the sets of the nodes of every (a, b) edge.
+
+    Roots are always hooked to a smaller root, so the forest stays acyclic.
+    """
+    while len(a):
+        root_a, root_b = _find(parent, a), _find(parent, b)
+        apart = root_a != root_b
+        a, b = a[apart], b[apart]
+        root_a, root_b = root_a[apart], root_b[apart]
+        np.minimum.at(parent, np.maximum(root_a, root_b),
+                      np.minimum(root_a, root_b))
+
+
+def dbscan(lat, lon, eps, min_samples, chunk_size=1024):
+    """Clusters points on the Earth with DBSCAN.
+
+    Core points have at least min_samples points (themselves included)
+    within eps km. Core points within eps km of each other are in the same
+    cluster. Other points join the cluster of their nearest core point if
+    it is within eps km, otherwise they are noise.
+
+    Neighbourhoods are searched with a spatial_index.SphereKDTree and are
+    never stored for all the points at once: the points are processed in
+    chunks and the clusters are grown with a union-find forest, so memory
+    is linear in the number of points, plus the neighbours of one chunk.
+
+    Args:
+        lat, lon: float arrays, the coordinates of the points, degrees
+        eps: a float, the neighbourhood radius, km
+        min_samples: an int, the minimum neighbourhood size of core points
+        chunk_size: an int, the number of points whose neighbourhoods are
+        held in memory at once; lower it for very dense data
+
+    Returns:
+        An int64 array, the cluster label of every point, -1 for noise.
+        Clusters are numbered by decreasing size.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    tree = spatial_index.SphereKDTree(lat, lon)
+    core = np.zeros(len(lat), dtype=bool)
+    for start in range(0, len(lat), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        neighbors = tree.query_radius(lat[chunk], lon[chunk], eps,
+                                      sort=False)
+        core[chunk] = np.diff(neighbors.offsets) >= min_samples
+
+    core_points = np.flatnonzero(core)
+    core_tree = spatial_index.SphereKDTree(lat[core], lon[core])
+    parent = np.arange(len(core_points))
+    for start in range(0, len(core_points), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        chunk_points = core_points[chunk]
+        neighbors = core_tree.query_radius(
+            lat[chunk_points], lon[chunk_points], eps, sort=False)
+        sources = start + np.repeat(np.arange(len(chunk_points)),
+                                    np.diff(neighbors.offsets))
+        targets = neighbors.indices
+        later = targets > sources
+        _union(parent, sources[later], targets[later])
+
+    labels = np.full(len(lat), -1, dtype=np.int64)
+    labels[core_points] = _find(parent, np.arange(len(core_points)))
+    border = np.flatnonzero(~core)
+    for start in range(0, len(border), chunk_size):
+        chunk_points = border[start:start + chunk_size]
+        nearest, distance = core_tree.query_knn(lat[chunk_points],
+                                                lon[chunk_points], 1)
+        reached = distance[:, 0] <= eps
+        labels[chunk_points[reached]] = labels[core_points[
+            nearest[reached, 0]]]
+
+    clustered = labels >= 0
+    roots, inverse, sizes = np.unique(labels[clustered], return_inverse=True,
+                                      return_counts=True)
+    rank = np.empty(len(roots), dtype=np.int64)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(roots))
+    labels[clustered] = rank[inverse]
+    return labels
+
+
+def cluster_statistics(table, labels):
+    """Computes the statistics of clusters of thermals.
+
+    Args:
+        table: a ThermalTable
+        labels: an int array, the cluster label of every thermal, -1 for
+        thermals in no cluster
+
+    Returns:
+        A Hotspots namedtuple.
+    """
+    clustered = labels >= 0
+    labels = labels[clustered]
+    num_clusters = int(labels.max()) + 1 if len(labels) else 0
+
+    count = np.bincount(labels, minlength=num_clusters)
+    denominator = np.maximum(count, 1)
+
+    def mean(values):
+        return np.bincount(labels, weights=values[clustered],
+                           minlength=num_clusters) / denominator
+
+    vectors = spatial_index.to_unit_vectors(table.lat[clustered],
+                                            table.lon[clustered])
+    centre = np.stack([np.bincount(labels, weights=vectors[:, axis],
+                                   minlength=num_clusters)
+                       for axis in range(3)], axis=-1)
+    lat = np.degrees(np.arctan2(centre[:, 2], np.hypot(centre[:, 0],
+                                                       centre[:, 1])))
+    lon = np.degrees(np.arctan2(centre[:, 1], centre[:, 0]))
+
+    timestamp = table.timestamp[clustered]
+    hour = (np.fmod(timestamp, _DAY) // 3600.0).astype(np.int64) % 24
+    hour_counts = np.bincount(labels * 24 + hour,
+                              minlength=num_clusters * 24).reshape(-1, 24)
+    day = np.floor(timestamp / _DAY).astype(np.int64)
+    cluster_days = np.unique(np.stack([labels, day], axis=-1), axis=0)
+    num_dates = np.bincount(cluster_days[:, 0], minlength=num_clusters)
+
+    return Hotspots(
+        lat=lat, lon=lon, count=count,
+        mean_vertical_velocity=mean(table.vertical_velocity),
+        mean_alt_change=mean(table.alt_change),
+        hour_counts=hour_counts, num_dates=num_dates)
+
+
+def find_hotspots(thermals, eps=1.0, min_samples=5, chunk_size=1024):
+    """Clusters thermals into hotspots ("house thermals").
+
+    Args:
+        thermals: a list of igc_lib.Thermal, or a ThermalTable
+        eps: a float, the neighbourhood radius of DBSCAN, km
+        min_samples: an int, the minimum number of thermals within eps km
+        of a thermal at the core of a hotspot
+        chunk_size: an int, see dbscan
+
+    Returns:
+        A (labels, hotspots) pair: an int64 array, the hotspot of every
+        thermal (-1 for isolated thermals), and a Hotspots namedtuple.
+    """
+    table = thermals
+    if not isinstance(table, ThermalTable):
+        table = thermal_table(thermals)
+    labels = dbscan(table.lat, table.lon, eps, min_samples, chunk_size)
+    return labels, cluster_statistics(table, labels)
@@ -0,0 +1,300 @@
+import bz2
+import collections
+import contextlib
+import gzip
+import io
+import lzma
+import mmap
+import os
+import tarfile
+import zipfile
+
+import numpy as np
+
+import lib.b_records as b_records
+
+IgcRecords = collections.namedtuple(
+    'IgcRecords', ['a_records', 'h_records', 'i_records', 'b_records'])
+
+# Separates the archive path from the member name in archive member sources,
+# e.g. "day1.zip::pilot1.igc".
+MEMBER_SEPARATOR = '::'
+
+_DECOMPRESSORS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+_TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+                 '.txz')
+
+
+def split_lines(buf):
+    """Finds the lines in a byte buffer.
+
+    Lines are terminated by '\\n', '\\r' or '\\r\\n', like in files opened
+    in text mode with universal newlines. Empty lines are skipped.
+
+    Args:
+        buf: a uint8 array
+
+    Returns:
+        A (starts, ends) pair of int64 arrays, the offsets of the first
+        byte and past the last byte of every non-empty line.
+    """
+    terminators = np.flatnonzero((buf == ord('\n')) | (buf == ord('\r')))
+    starts = np.empty(len(terminators) + 1, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = terminators + 1
+    ends = np.empty(len(terminators) + 1, dtype=np.int64)
+    ends[:-1] = terminators
+    ends[-1] = len(buf)
+    non_empty = ends > starts
+    return starts[non_empty], ends[non_empty]
+
+
+def _decode_lines(buf, starts, ends):
+    """Decodes the selected lines to strings."""
+    return [buf[start:end].tobytes().decode('ISO-8859-1')
+            for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def read_records(buf):
+    """Classifies and parses the records of an IGC file held in memory.
+
+    Only the A, H and I records are decoded to strings, B records are
+    decoded in bulk straight from the bytes. Other records are ignored.
+
+    Args:
+        buf: a uint8 array, or a bytes-like object, the content of the file
+
+    Returns:
+        An IgcRecords namedtuple, with lists of A, H and I record strings
+        and a b_records.BRecords namedtuple of fix columns.
+    """
+    buf = np.frombuffer(buf, dtype=np.uint8)
+    starts, ends = split_lines(buf)
+    kinds = buf[starts] if len(buf) else np.zeros(0, dtype=np.uint8)
+
+    def select(kind):
+        selected = kinds == ord(kind)
+        return starts[selected], ends[selected]
+
+    b_starts, b_ends = select('B')
+    return IgcRecords(
+        a_records=_decode_lines(buf, *select('A')),
+        h_records=_decode_lines(buf, *select('H')),
+        i_records=_decode_lines(buf, *select('I')),
+        b_records=b_records.decode_B_records(buf, b_starts, b_ends))
+
+
+def _is_tar(path):
+    return path.lower().endswith(_TAR_SUFFIXES)
+
+
+def _is_igc(name):
+    return name.lower().endswith('.igc')
+
+
+def is_archive(path):
+    """Checks whether the path names a zip or a tar archive."""
+    return path.lower().endswith('.zip') or _is_tar(path)
+
+
+def is_compressed(path):
+    """Checks whether the path names a gzip, bz2 or xz compressed file."""
+    return (not _is_tar(path) and
+            os.path.splitext(path)[1].lower() in _DECOMPRESSORS)
+
+
+@contextlib.contextmanager
+def open_source(source):
+    """Opens an IGC source for binary reading, without temporary files.
+
+    Args:
+        source: a string, either the name of a plain or a gzip/bz2/xz
+        compressed file, or an archive member, "<archive>::<member>", where
+        the archive is a zip or a (possibly compressed) tar file
+
+    Yields:
+        A binary file object, decompressing the content on the fly.
+
+    Raises:
+        IOError: the source does not exist or the archive is corrupted.
+    """
+    if MEMBER_SEPARATOR not in source:
+        decompressor = open
+        if is_compressed(source):
+            decompressor = _DECOMPRESSORS[os.path.splitext(source)[1].lower()]
+        with decompressor(source, 'rb') as source_file:
+            yield source_file
+        return
+
+    archive_path, member = source.split(MEMBER_SEPARATOR, 1)
+    try:
+        if _is_tar(archive_path):
+            archive = tarfile.open(archive_path)
+            member_file = archive.extractfile(member)
+            if member_file is None:
+                raise KeyError(member)
+        else:
+            archive = zipfile.ZipFile(archive_path)
+            member_file = archive.open(member)
+    except (KeyError, tarfile.TarError, zipfile.BadZipfile) as error:
+        raise IOError("can not open %s: %r" % (source, error))
+    with archive, member_file:
+        yield member_file
+
+
+def source_stat(source):
+    """Returns the (size, mtime) of a source, see open_source.
+
+    The size of an archive member is its uncompressed size, its mtime is
+    the one of the archive. The size of a compressed file is the size
+    of the compressed data.
+    """
+    if MEMBER_SEPARATOR not in source:
+        stat = os.stat(source)
+        return stat.st_size, stat.st_mtime
+    archive_path, member = source.split(MEMBER_SEPARATOR, 1)
+    mtime = os.stat(archive_path).st_mtime
+    try:
+        if _is_tar(archive_path):
+            with tarfile.open(archive_path) as archive:
+                size = archive.getmember(member).size
+        else:
+            with zipfile.ZipFile(archive_path) as archive:
+                size = archive.getinfo(member).file_size
+    except (KeyError, tarfile.TarError, zipfile.BadZipfile) as error:
+        raise IOError("can not open %s: %r" % (source, error))
+    return size, mtime
+
+
+def list_archive(path):
+    """Lists the IGC files of a zip or tar archive.
+
+    Returns:
+        A list of "<archive>::<member>" sources, in archive order.
+    """
+    try:
+        if _is_tar(path):
+            with tarfile.open(path) as archive:
+                names = [member.name for member in archive.getmembers()
+                         if member.isfile()]
+        else:
+            with zipfile.ZipFile(path) as archive:
+                names = [info.filename for info in archive.infolist()
+                         if not info.filename.endswith('/')]
+    except (tarfile.TarError, zipfile.BadZipfile) as error:
+        raise IOError("can not read archive %s: %r" % (path, error))
+    return [path + MEMBER_SEPARATOR + name for name in names if _is_igc(name)]
+
+
+def find_sources(directory):
+    """Finds the IGC sources of a directory.
+
+    Plain and compressed IGC files (.igc, .igc.gz, .igc.bz2, .igc.xz) are
+    returned as they are, zip and tar archives are expanded to their IGC
+    members, so that each member can be loaded independently.
+
+    Returns:
+        A list of source strings, sorted by file name, see open_source.
+    """
+    sources = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        if is_archive(path):
+            sources.extend(list_archive(path))
+        elif _is_igc(name) or (is_compressed(name) and
+                               _is_igc(os.path.splitext(name)[0])):
+            sources.append(path)
+    return sources
+
+
+def iter_archive(path):
+    """Reads all IGC members of an archive in a single sequential pass.
+
+    Loading members one by one through open_source has to locate each
+    member in the archive, which for compressed tar archives means
+    decompressing everything before it. Use this function to read such
+    archives in one go.
+
+    Yields:
+        (source, IgcRecords) pairs, in archive order.
+    """
+    if _is_tar(path):
+        with tarfile.open(path) as archive:
+            for member in archive:
+                if member.isfile() and _is_igc(member.name):
+                    with archive.extractfile(member) as member_file:
+                        yield (path + MEMBER_SEPARATOR + member.name,
+                               read_records(member_file.read()))
+    else:
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if _is_igc(info.filename):
+                    with archive.open(info) as member_file:
+                        yield (path + MEMBER_SEPARATOR + info.filename,
+                               read_records(member_file.read()))
+
+
+def read_file(filename, use_mmap=True):
+    """Reads the records of an IGC file.
+
+    Args:
+        filename: a string, the name of the IGC file; compressed files and
+        archive members are decompressed in memory, see open_source
+        use_mmap: a bool, whether to memory-map the file instead of
+        reading it into memory; only plain files can be memory-mapped
+
+    Returns:
+        An IgcRecords namedtuple, see read_records.
+    """
+    if MEMBER_SEPARATOR in filename or is_compressed(filename):
+        with open_source(filename) as source_file:
+            return read_records(source_file.read())
+
+    with open(filename, 'rb') as igc_file:
+        if not use_mmap:
+            return read_records(igc_file.read())
+        try:
+            mapped = mmap.mmap(igc_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped.
+            return read_records(b'')
+        try:
+            return read_records(mapped)
+        finally:
+            mapped.close()
+
+
+def read_header(binary_file):
+    """Reads the A, H and I records of an IGC file, up to the first B record.
+
+    Args:
+        binary_file: a file object opened in binary mode
+
+    Returns:
+        An IgcRecords namedtuple, with b_records set to None.
+    """
+    records = {'A': [], 'H': [], 'I': []}
+    text = io.TextIOWrapper(binary_file, encoding='ISO-8859-1')
+    try:
+        for line in text:
+            line = line.replace('\n', '').replace('\r', '')
+            if not line:
+                continue
+            if line[0] == 'B':
+                break
+            if line[0] in records:
+                records[line[0]].append(line)
+    finally:
+        # Leave the binary file to the caller.
+        text.detach()
+    return IgcRecords(a_records=records['A'], h_records=records['H'],
+                      i_records=records['I'], b_records=None)
+
+
+def read_header_file(filename):
+    """Reads the A, H and I records of an IGC source, see read_header."""
+    with open_source(filename) as igc_file:
+        return read_header(igc_file)
@@ -0,0 +1,211 @@
+import collections
+
+import numpy as np
+
+import igc_lib
+import lib.geo as geo
+import lib.viterbi as viterbi
+
+# The states committed by a LiveTracker update, as two
+# viterbi.OnlineStates whose streams are glider ids and whose positions
+# are the indices of the fixes of the gliders, counting from 0.
+#   flying: the standing (0) / flying (1) states
+#   circling: the straight (0) / circling (1) states
+LiveStates = collections.namedtuple('LiveStates', ['flying', 'circling'])
+
+
+def _concatenate_states(states):
+    """Concatenates a list of viterbi.OnlineStates."""
+    return viterbi.OnlineStates(*[
+        np.concatenate(values) for values in zip(*states)])
+
+
+class LiveTracker(object):
+    """Detects the flight and the circling of live gliders.
+
+    Fixes are received one at a time per glider, for many gliders at once,
+    and decoded with the flying and the circling models of a configuration
+    by viterbi.OnlineViterbiDecoder, so the states of a fix are committed
+    at most lag fixes after it. Memory per glider is constant.
+
+    The emissions are the ones of igc_lib.Flight, computed incrementally:
+    the bearing of a fix is only known with the next fix, so the circling
+    emission of a fix is produced one fix later than its flying emission.
+    The circling emission of a fix uses the current flying state of the
+    fix when it was received, and the flying states are not post-processed
+    with FlightParsingConfig.min_landing_time.
+    """
+
+    def __init__(self, config_class=igc_lib.FlightParsingConfig, lag=60,
+                 history=64, capacity=16):
+        """Initializer for the class.
+
+        Args:
+            config_class: a class that implements FlightParsingConfig
+            lag: an int, see viterbi.OnlineViterbiDecoder
+            history: an int, the number of fixes whose bearings are kept
+            per glider; must cover min_time_for_bearing_change
+            capacity: an int, the number of gliders allocated at first
+        """
+        self._config = config_class()
+        self._backend = geo.DISTANCE_BACKENDS[self._config.distance_backend]
+        self._flying = viterbi.OnlineViterbiDecoder(
+            igc_lib._get_decoder(igc_lib._model_tuple(
+                self._config.flying_model)), lag, capacity)
+        self._circling = viterbi.OnlineViterbiDecoder(
+            igc_lib._get_decoder(igc_lib._model_tuple(
+                self._config.circling_model)), lag, capacity)
+        capacity = max(capacity, 1)
+        # The last fix of every glider.
+        self._num_fixes = np.zeros(capacity, dtype=np.int64)
+        self._timestamp = np.zeros(capacity)
+        self._lat = np.zeros(capacity)
+        self._lon = np.zeros(capacity)
+        # The current flying state of the last fix, when it was received.
+        self._last_flying = np.zeros(capacity, dtype=bool)
+        # The timestamps and the bearings of the last history fixes with
+        # a bearing, in a ring buffer.
+        self._bearing_time = np.zeros((capacity, history))
+        self._bearing = np.zeros((capacity, history))
+        self._num_bearings = np.zeros(capacity, dtype=np.int64)
+
+    def add_glider(self):
+        """Starts tracking a new glider.
+
+        Returns:
+            An int, the id of the glider, reused once the glider is
+            finished.
+        """
+        glider = self._flying.add_stream()
+        assert self._circling.add_stream() == glider
+        capacity = len(self._num_fixes)
+        if glider >= capacity:
+            for name in ['_num_fixes', '_timestamp', '_lat', '_lon',
+                         '_last_flying', '_bearing_time', '_bearing',
+                         '_num_bearings']:
+                values = getattr(self, name)
+                grown = np.zeros((2 * capacity,) + values.shape[1:],
+                                 dtype=values.dtype)
+                grown[:capacity] = values
+                setattr(self, name, grown)
+        self._num_fixes[glider] = 0
+        self._num_bearings[glider] = 0
+        return glider
+
+    def current_states(self, gliders):
+        """Returns the current flying and circling states of gliders.
+
+        These are the states of the most likely paths at the last decoded
+        fixes, they may change with the next fixes. Gliders without
+        decoded fixes get -1.
+
+        Returns:
+            A (flying, circling) pair of int8 arrays.
+        """
+        return (self._flying.current_states(gliders),
+                self._circling.current_states(gliders))
+
+    def _push_circling(self, gliders, timestamp, bearing):
+        """Receives the bearing of the last fixes but one of gliders, and
+        pushes their circling emissions."""
+        history = self._bearing.shape[1]
+        bearing_time = self._bearing_time[gliders]
+        known = (np.arange(history) <
+                 self._num_bearings[gliders][:, np.newaxis])
+        # The latest fix at least min_time_for_bearing_change before.
+        candidates = known & (
+            timestamp[:, np.newaxis] - bearing_time >
+            self._config.min_time_for_bearing_change - 1e-7)
+        found = np.any(candidates, axis=1)
+        prev = np.argmax(np.where(candidates, bearing_time, -np.inf), axis=1)
+        rows = np.arange(len(gliders))
+        bearing_change = self._bearing[gliders, prev] - bearing
+        bearing_change = (bearing_change + 180.0) % 360.0 - 180.0
+        time_change = bearing_time[rows, prev] - timestamp
+        rate = np.divide(bearing_change, time_change,
+                         out=np.zeros_like(bearing_change), where=found)
+
+        slot = self._num_bearings[gliders] % history
+        self._bearing_time[gliders, slot] = timestamp
+        self._bearing[gliders, slot] = bearing
+        self._num_bearings[gliders] += 1
+
+        circling = self._last_flying[gliders] & (
+            np.fabs(rate) > self._config.min_bearing_change_circling)
+        return self._circling.push(gliders, circling.astype(np.int8))
+
+    def update(self, gliders, timestamp, lat, lon):
+        """Receives the next fix of gliders.
+
+        Args:
+            gliders: an int array, distinct glider ids
+            timestamp: a float array, the times of the fixes (since
+            epoch), seconds
+            lat, lon: float arrays, the positions of the fixes, degrees
+
+        Returns:
+            A LiveStates namedtuple, the states committed by the fixes.
+        """
+        gliders = np.asarray(gliders, dtype=np.intp).ravel()
+        timestamp = np.asarray(timestamp, dtype=np.float64).ravel()
+        lat = np.asarray(lat, dtype=np.float64).ravel()
+        lon = np.asarray(lon, dtype=np.float64).ravel()
+
+        moved = gliders[self._num_fixes[gliders] > 0]
+        circling = self._circling.push([], [])
+        gsp = np.zeros(len(gliders))
+        if len(moved):
+            rows = self._num_fixes[gliders] > 0
+            prev_lat, prev_lon = self._lat[moved], self._lon[moved]
+            dist = self._backend.distances(prev_lat, prev_lon, lat[rows],
+                                           lon[rows])
+            time_change = timestamp[rows] - self._timestamp[moved]
+            gsp[rows] = np.divide(
+                dist, time_change, out=np.zeros_like(dist),
+                where=np.fabs(time_change) >= 1e-5) * 3600.0
+            bearing = self._backend.bearings_to(prev_lat, prev_lon,
+                                                lat[rows], lon[rows])
+            circling = self._push_circling(moved, self._timestamp[moved],
+                                           bearing)
+
+        flying_emissions = gsp > self._config.min_gsp_flight
+        flying = self._flying.push(gliders,
+                                   flying_emissions.astype(np.int8))
+        self._last_flying[gliders] = (
+            self._flying.current_states(gliders) == 1)
+        self._num_fixes[gliders] += 1
+        self._timestamp[gliders] = timestamp
+        self._lat[gliders] = lat
+        self._lon[gliders] = lon
+        return LiveStates(flying=flying, circling=circling)
+
+    def finish(self, gliders):
+        """Stops tracking gliders, committing their remaining states.
+
+        The last fix of a glider gets the bearing of the fix before it,
+        like in igc_lib.Flight.
+
+        Returns:
+            A LiveStates namedtuple.
+        """
+        gliders = np.asarray(gliders, dtype=np.intp).ravel()
+        circling = [self._circling.push([], [])]
+        ended = gliders[self._num_bearings[gliders] > 0]
+        if len(ended):
+            history = self._bearing.shape[1]
+            last = (self._num_bearings[ended] - 1) % history
+            circling.append(self._push_circling(
+                ended, self._timestamp[ended], self._bearing[ended, last]))
+        single = gliders[self._num_fixes[gliders] == 1]
+        if len(single):
+            circling.append(self._circling.push(
+                single, np.zeros(len(single), dtype=np.int8)))
+        circling.append(self._circling.flush(gliders))
+        states = LiveStates(flying=self._flying.flush(gliders),
+                            circling=_concatenate_states(circling))
+        for glider in gliders.tolist():
+            self._flying.remove_stream(glider)
+            self._circling.remove_stream(glider)
+            self._num_fixes[glider] = 0
+            self._num_bearings[glider] = 0
+        return states
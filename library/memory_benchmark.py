@@ -0,0 +1,103 @@
+"""Measures the memory and garbage collection cost of loading flights.
+
+Usage:
+    python -m lib.memory_benchmark [-n NUM_FLIGHTS] IGC_FILE [IGC_FILE ...]
+
+The files are loaded in turn until NUM_FLIGHTS flights are held in memory,
+then all the flights are released.
+"""
+import argparse
+import collections
+import gc
+import time
+import tracemalloc
+import weakref
+
+import igc_lib
+
+BenchmarkResult = collections.namedtuple(
+    'BenchmarkResult',
+    ['flights', 'fixes', 'thermals', 'load_seconds', 'peak_bytes',
+     'held_bytes', 'gc_collections', 'gc_seconds', 'alive_after_release'])
+
+
+class _GcTimer(object):
+    """Counts the garbage collections and the time spent in them."""
+
+    def __init__(self):
+        self.collections = 0
+        self.seconds = 0.0
+        self._started = None
+
+    def __call__(self, phase, info):
+        if phase == 'start':
+            self._started = time.perf_counter()
+        elif self._started is not None:
+            self.collections += 1
+            self.seconds += time.perf_counter() - self._started
+            self._started = None
+
+
+def run(filenames, num_flights, config_class=igc_lib.FlightParsingConfig):
+    """Loads num_flights flights and measures memory and GC activity.
+
+    Args:
+        filenames: a list of strings, the IGC files, loaded in turn
+        num_flights: an int, the number of flights to be held in memory
+        config_class: a class that implements FlightParsingConfig
+
+    Returns:
+        A BenchmarkResult namedtuple:
+            flights, fixes, thermals: ints, the number of loaded objects
+            load_seconds: a float, the time spent loading the flights
+            peak_bytes: an int, the peak of the traced memory while loading
+            held_bytes: an int, the traced memory held by the flights
+            gc_collections: an int, the number of garbage collections
+            (all generations) that ran while loading and releasing
+            gc_seconds: a float, the time spent in these collections
+            alive_after_release: an int, the number of flights still in
+            memory after the last reference to them was dropped, i.e.
+            waiting for the cyclic garbage collector
+    """
+    gc.collect()
+    timer = _GcTimer()
+    gc.callbacks.append(timer)
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        flights = [
+            igc_lib.Flight.create_from_file(
+                filenames[i % len(filenames)], config_class)
+            for i in range(num_flights)]
+        load_seconds = time.perf_counter() - started
+        held_bytes, peak_bytes = tracemalloc.get_traced_memory()
+
+        fixes = sum(len(flight.fixes) for flight in flights)
+        thermals = sum(len(getattr(flight, 'thermals', []))
+                       for flight in flights)
+        flight_refs = [weakref.ref(flight) for flight in flights]
+        del flights
+        alive = sum(flight_ref() is not None for flight_ref in flight_refs)
+    finally:
+        tracemalloc.stop()
+        gc.callbacks.remove(timer)
+    gc.collect()
+    return BenchmarkResult(
+        flights=num_flights, fixes=fixes, thermals=thermals,
+        load_seconds=load_seconds, peak_bytes=peak_bytes,
+        held_bytes=held_bytes, gc_collections=timer.collections,
+        gc_seconds=timer.seconds, alive_after_release=alive)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('filenames', nargs='+', metavar='IGC_FILE')
+    parser.add_argument('-n', '--num-flights', type=int, default=100)
+    args = parser.parse_args()
+    result = run(args.filenames, args.num_flights)
+    for name, value in zip(result._fields, result):
+        print('%-20s %s' % (name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+import collections
+
+import numpy as np
+
+import lib.geo as geo
+
+# Neighbours of many query points, in a compressed sparse row layout: the
+# neighbours of query i are indices[offsets[i]:offsets[i + 1]], at
+# distances[offsets[i]:offsets[i + 1]] kilometers, sorted by distance.
+RadiusNeighbors = collections.namedtuple(
+    'RadiusNeighbors', ['offsets', 'indices', 'distances'])
+
+
+def to_unit_vectors(lat, lon):
+    """Converts geographic coordinates, in degrees, to 3D unit vectors."""
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+def _chord2_from_km(distance):
+    """Converts great circle distances (km) to squared chord lengths."""
+    angle = np.minimum(np.asarray(distance, dtype=np.float64) /
+                       geo.EARTH_RADIUS_KM, np.pi)
+    return (2.0 * np.sin(angle / 2.0)) ** 2
+
+
+def _km_from_chord2(chord2):
+    """Converts squared chord lengths to great circle distances (km)."""
+    half_chord = np.minimum(np.sqrt(chord2) / 2.0, 1.0)
+    return 2.0 * geo.EARTH_RADIUS_KM * np.arcsin(half_chord)
+
+
+def _expand_ranges(rows, starts, sizes):
+    """Expands (row, [start, start + size)) ranges to (row, position) pairs."""
+    total = int(sizes.sum())
+    range_starts = np.cumsum(sizes) - sizes
+    positions = (np.arange(total) - np.repeat(range_starts, sizes) +
+                 np.repeat(starts, sizes))
+    return np.repeat(rows, sizes), positions
+
+
+class SphereKDTree(object):
+    """A KD-tree of points on the Earth, for bulk neighbour queries.
+
+    Points are stored as 3D unit vectors, where the Euclidean (chord)
+    distance is a monotonic function of the great circle distance, so
+    that bounding boxes can prune the search exactly. The tree is
+    balanced and implicit: the points are sorted so that every node
+    covers a contiguous range of them, and the nodes are laid out as a
+    binary heap. Coincident points are stored once, with the indices of
+    all of them, so that a block of duplicates does not defeat pruning.
+
+    Queries are answered in bulk, all the queries of a chunk walk down the
+    tree level by level together, so their cost is a few NumPy operations
+    per level. Memory use is bounded by the chunk size.
+
+    Attributes:
+        lat: a float64 array, latitudes of the points, degrees
+        lon: a float64 array, longitudes of the points, degrees
+    """
+
+    def __init__(self, lat, lon, leaf_size=32):
+        """Builds the tree.
+
+        Args:
+            lat, lon: float arrays, the coordinates of the points, degrees
+            leaf_size: an int, the maximum number of distinct points in a
+            leaf
+        """
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        points = to_unit_vectors(self.lat, self.lon).reshape(-1, 3)
+        points, inverse, counts = np.unique(
+            points, axis=0, return_inverse=True, return_counts=True)
+        # The indices of the coincident points, grouped by unique point.
+        members = np.argsort(inverse.reshape(-1), kind='stable')
+        n = self._size = len(points)
+        depth = 0
+        while (n >> depth) > max(1, leaf_size):
+            depth += 1
+        self._depth = depth
+
+        num_nodes = 2 ** (depth + 1) - 1
+        self._box_min = np.zeros((num_nodes, 3))
+        self._box_max = np.zeros((num_nodes, 3))
+        self._split_dim = np.zeros(2 ** depth - 1, dtype=np.int64)
+        self._split_value = np.zeros(2 ** depth - 1)
+        order = np.arange(n)
+        for level in range(depth + 1 if n else 0):
+            first = 2 ** level - 1
+            nodes = slice(first, first + 2 ** level)
+            edges = self._edges(level)
+            sorted_points = points[order]
+            self._box_min[nodes] = np.minimum.reduceat(
+                sorted_points, edges[:-1], axis=0)
+            self._box_max[nodes] = np.maximum.reduceat(
+                sorted_points, edges[:-1], axis=0)
+            if level == depth:
+                break
+            # Split every node at its median, along its widest dimension.
+            dims = np.argmax(self._box_max[nodes] - self._box_min[nodes],
+                             axis=1)
+            node_of_point = np.repeat(np.arange(2 ** level), np.diff(edges))
+            # Coordinates are within [-1, 1], offsetting them by 4 per node
+            # sorts the points by node, then by coordinate, in one pass.
+            key = (sorted_points[np.arange(n), dims[node_of_point]] +
+                   4.0 * node_of_point)
+            order = order[np.argsort(key)]
+            middles = self._edges(level + 1)[1:-1:2]
+            self._split_dim[nodes] = dims
+            self._split_value[nodes] = points[order[middles], dims]
+        self._points = points[order]
+        self._member_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts[order], out=self._member_offsets[1:])
+        starts = np.cumsum(counts) - counts
+        _, positions = _expand_ranges(order, starts[order], counts[order])
+        self._members = members[positions]
+
+    def __len__(self):
+        return len(self._members)
+
+    def _edges(self, level):
+        """Returns the boundaries of the point ranges of a tree level."""
+        return (np.arange(2 ** level + 1) * self._size) // 2 ** level
+
+    def _leaf_pairs(self, queries, rows, bound2):
+        """Finds the (query row, point position) pairs of the leaves that
+        may hold points within the bounds of the queries."""
+        nodes = np.zeros(len(rows), dtype=np.int64)
+        for level in range(self._depth + 1):
+            heap = 2 ** level - 1 + nodes
+            q = queries[rows]
+            outside = (np.maximum(self._box_min[heap] - q, 0.0) +
+                       np.maximum(q - self._box_max[heap], 0.0))
+            keep = (outside ** 2).sum(axis=1) <= bound2[rows]
+            rows, nodes = rows[keep], nodes[keep]
+            if level < self._depth:
+                rows = np.repeat(rows, 2)
+                nodes = (2 * nodes[:, np.newaxis] + [0, 1]).ravel()
+        edges = self._edges(self._depth)
+        return _expand_ranges(rows, edges[nodes], edges[nodes + 1] -
+                              edges[nodes])
+
+    def _initial_bound(self, queries, k, exclude):
+        """Bounds the distance to the k-th neighbour of every query, from
+        the points of the smallest node on the path of the query that
+        holds more than k points."""
+        n = self._size
+        level = 0
+        while level < self._depth and (n >> (level + 1)) > k:
+            level += 1
+        nodes = np.zeros(len(queries), dtype=np.int64)
+        for parent_level in range(level):
+            heap = 2 ** parent_level - 1 + nodes
+            right = (queries[np.arange(len(queries)), self._split_dim[heap]] >=
+                     self._split_value[heap])
+            nodes = 2 * nodes + right
+        edges = self._edges(level)
+        rows, positions = _expand_ranges(
+            np.arange(len(queries)), edges[nodes],
+            edges[nodes + 1] - edges[nodes])
+        return self._kth_chord2(queries, rows, positions, k, exclude)
+
+    def _sorted_pairs(self, queries, rows, positions, exclude, bound2=None,
+                      by_distance=True, limit=None):
+        """Expands candidate (query row, point position) pairs to (query
+        row, point index, squared chord) triples, sorted by query row, then
+        by distance and index (unless by_distance is False), dropping
+        excluded points and points beyond the bounds of the queries.
+
+        At most limit + 1 of the coincident points of a position are
+        expanded, when the nearest limit points are all that is needed."""
+        chord2 = ((self._points[positions] - queries[rows]) ** 2).sum(axis=1)
+        if bound2 is not None:
+            keep = chord2 <= bound2[rows]
+            rows, positions, chord2 = rows[keep], positions[keep], chord2[keep]
+        starts = self._member_offsets[positions]
+        if self._size == len(self._members):
+            indices = self._members[starts]
+        else:
+            sizes = self._member_offsets[positions + 1] - starts
+            if limit is not None:
+                # One more, in case the excluded point is among them.
+                sizes = np.minimum(sizes, limit + 1)
+            chord2 = np.repeat(chord2, sizes)
+            rows, members = _expand_ranges(rows, starts, sizes)
+            indices = self._members[members]
+        if exclude is not None:
+            keep = indices != exclude[rows]
+            rows, indices, chord2 = rows[keep], indices[keep], chord2[keep]
+        if by_distance:
+            order = np.lexsort((indices, chord2, rows))
+        else:
+            order = np.argsort(rows, kind='stable')
+        return rows[order], indices[order], chord2[order]
+
+    @staticmethod
+    def _ranks(rows, num_rows):
+        """Returns the rank of every pair within its (sorted) query row."""
+        counts = np.bincount(rows, minlength=num_rows)
+        return np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+
+    def _kth_chord2(self, queries, rows, positions, k, exclude):
+        rows, _, chord2 = self._sorted_pairs(queries, rows, positions,
+                                             exclude, limit=k)
+        bound2 = np.full(len(queries), np.inf)
+        kth = self._ranks(rows, len(queries)) == k - 1
+        bound2[rows[kth]] = chord2[kth]
+        return bound2
+
+    def _chunks(self, lat, lon, exclude, chunk_size):
+        queries = to_unit_vectors(lat, lon).reshape(-1, 3)
+        if exclude is not None:
+            exclude = np.asarray(exclude, dtype=np.int64).reshape(-1)
+        for start in range(0, len(queries), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            yield (queries[chunk],
+                   None if exclude is None else exclude[chunk])
+
+    def query_knn(self, lat, lon, k, exclude=None, chunk_size=4096):
+        """Finds the k nearest points of many query points.
+
+        Args:
+            lat, lon: float arrays, the coordinates of the queries, degrees
+            k: an int, the number of neighbours
+            exclude: an optional int array, for every query the index of a
+            point which is not a neighbour (e.g. the query itself when
+            querying the points of the tree), or -1
+            chunk_size: an int, the number of queries processed at once
+
+        Returns:
+            An (indices, distances) pair of (num_queries, k) arrays, the
+            indices of the neighbours in the tree points and their great
+            circle distances in kilometers, sorted by distance. Missing
+            neighbours (fewer than k points) have index -1 and an infinite
+            distance.
+        """
+        all_indices, all_distances = [], []
+        for queries, chunk_exclude in self._chunks(lat, lon, exclude,
+                                                   chunk_size):
+            indices = np.full((len(queries), k), -1, dtype=np.int64)
+            distances = np.full((len(queries), k), np.inf)
+            if self._size and k > 0:
+                bound2 = self._initial_bound(queries, k, chunk_exclude)
+                rows, positions = self._leaf_pairs(
+                    queries, np.arange(len(queries)), bound2)
+                rows, neighbors, chord2 = self._sorted_pairs(
+                    queries, rows, positions, chunk_exclude, bound2, limit=k)
+                ranks = self._ranks(rows, len(queries))
+                kept = ranks < k
+                indices[rows[kept], ranks[kept]] = neighbors[kept]
+                distances[rows[kept], ranks[kept]] = _km_from_chord2(
+                    chord2[kept])
+            all_indices.append(indices)
+            all_distances.append(distances)
+        if not all_indices:
+            return (np.zeros((0, k), dtype=np.int64), np.zeros((0, k)))
+        return np.concatenate(all_indices), np.concatenate(all_distances)
+
+    def query_radius(self, lat, lon, radius, exclude=None, chunk_size=4096,
+                     sort=True):
+        """Finds the points within a distance of many query points.
+
+        Args:
+            lat, lon: float arrays, the coordinates of the queries, degrees
+            radius: a float, or a float array (one per query), kilometers
+            exclude: an optional int array, see query_knn
+            chunk_size: an int, the number of queries processed at once
+            sort: a bool, whether to sort the neighbours of every query by
+            distance; skipping it is faster when the order is not needed
+
+        Returns:
+            A RadiusNeighbors namedtuple.
+        """
+        num_queries = np.size(lat)
+        bound2 = np.broadcast_to(_chord2_from_km(radius), (num_queries,))
+        counts, all_indices, all_distances = [], [], []
+        start = 0
+        for queries, chunk_exclude in self._chunks(lat, lon, exclude,
+                                                   chunk_size):
+            chunk_bound2 = bound2[start:start + len(queries)]
+            start += len(queries)
+            rows, positions = self._leaf_pairs(
+                queries, np.arange(len(queries) if self._size else 0),
+                chunk_bound2)
+            rows, indices, chord2 = self._sorted_pairs(
+                queries, rows, positions, chunk_exclude, chunk_bound2, sort)
+            counts.append(np.bincount(rows, minlength=len(queries)))
+            all_indices.append(indices)
+            all_distances.append(_km_from_chord2(chord2))
+        offsets = np.zeros(num_queries + 1, dtype=np.int64)
+        if counts:
+            np.cumsum(np.concatenate(counts), out=offsets[1:])
+        return RadiusNeighbors(
+            offsets=offsets,
+            indices=np.concatenate(all_indices or [np.zeros(0, np.int64)]),
+            distances=np.concatenate(all_distances or [np.zeros(0)]))
+
+
+def thermal_positions(thermals):
+    """Returns the (lat, lon) arrays of the centres of thermals.
+
+    The centre of a thermal is the midpoint of its entry and exit fixes,
+    like in Thermal.distance.
+    """
+    lat = np.array([(thermal.enter_fix.lat + thermal.exit_fix.lat) / 2
+                    for thermal in thermals], dtype=np.float64)
+    lon = np.array([(thermal.enter_fix.lon + thermal.exit_fix.lon) / 2
+                    for thermal in thermals], dtype=np.float64)
+    return lat, lon
+
+
+class ThermalIndex(SphereKDTree):
+    """A spatial index of thermals, for neighbour queries in kilometers.
+
+    Attributes:
+        thermals: a list of igc_lib.Thermal, the indexed thermals
+    """
+
+    def __init__(self, thermals, leaf_size=32):
+        self.thermals = list(thermals)
+        lat, lon = thermal_positions(self.thermals)
+        super(ThermalIndex, self).__init__(lat, lon, leaf_size)
+
+    def find_k_neighbors(self, k, chunk_size=4096):
+        """Finds the k nearest neighbours of every indexed thermal.
+
+        Returns:
+            A list with, for every thermal, a list of up to k
+            (thermal, distance in km) tuples sorted by distance, like
+            data_analysis.find_k_neighbors (which measures degrees).
+        """
+        indices, distances = self.query_knn(
+            self.lat, self.lon, k, exclude=np.arange(len(self.thermals)),
+            chunk_size=chunk_size)
+        return [[(self.thermals[index], distance)
+                 for index, distance in zip(row_indices, row_distances)
+                 if index >= 0]
+                for row_indices, row_distances in zip(indices.tolist(),
+                                                      distances.tolist())]
+
+    def find_neighbors_within(self, radius, chunk_size=4096):
+        """Finds the neighbours within radius km of every indexed thermal.
+
+        Returns:
+            A list with, for every thermal, a list of (thermal, distance
+            in km) tuples sorted by distance, see find_k_neighbors.
+        """
+        neighbors = self.query_radius(
+            self.lat, self.lon, radius, exclude=np.arange(len(self.thermals)),
+            chunk_size=chunk_size)
+        offsets = neighbors.offsets.tolist()
+        indices = neighbors.indices.tolist()
+        distances = neighbors.distances.tolist()
+        return [[(self.thermals[index], distance)
+                 for index, distance in zip(indices[start:end],
+                                            distances[start:end])]
+                for start, end in zip(offsets[:-1], offsets[1:])]
@@ -0,0 +1,146 @@
+import glob
+import math
+import unittest
+
+import igc_lib
+import lib.b_records as b_records
+
+
+def _parse_with_regex(lines):
+    """Reference parser: per-line regex, as igc_lib used to do it."""
+    fixes = []
+    for line in lines:
+        fix = igc_lib.GNSSFix.build_from_B_record(line, index=len(fixes))
+        if fix is None:
+            continue
+        if fixes and math.fabs(fix.rawtime - fixes[-1].rawtime) < 1e-5:
+            continue
+        fixes.append(fix)
+    return fixes
+
+
+class TestParseBRecords(unittest.TestCase):
+
+    def assertParity(self, lines):
+        expected = _parse_with_regex(lines)
+        records = b_records.parse_B_records(lines)
+        self.assertEqual(len(records.rawtime), len(expected))
+        for i, fix in enumerate(expected):
+            self.assertEqual(records.rawtime[i], fix.rawtime)
+            self.assertEqual(records.lat[i], fix.lat)
+            self.assertEqual(records.lon[i], fix.lon)
+            self.assertEqual(records.validity[i].decode(), fix.validity)
+            self.assertEqual(records.press_alt[i], fix.press_alt)
+            self.assertEqual(records.gnss_alt[i], fix.gnss_alt)
+            self.assertEqual(records.extras[i].decode(), fix.extras)
+
+    def testParityOnTestFiles(self):
+        filenames = glob.glob('testfiles/*.igc')
+        self.assertTrue(filenames)
+        for filename in filenames:
+            with open(filename, 'r', encoding='ISO-8859-1') as igc_file:
+                lines = [line.replace('\n', '').replace('\r', '')
+                         for line in igc_file]
+            self.assertParity([line for line in lines if line[:1] == 'B'])
+
+    def testEmpty(self):
+        records = b_records.parse_B_records([])
+        self.assertEqual(len(records.rawtime), 0)
+        self.assertEqual(len(records.extras), 0)
+
+    def testSingleRecord(self):
+        records = b_records.parse_B_records(
+            ['B1101355206343N00006198WA0058700558'])
+        self.assertEqual(records.rawtime[0], 11 * 3600.0 + 60.0 + 35.0)
+        self.assertAlmostEqual(records.lat[0], 52.10571667)
+        self.assertAlmostEqual(records.lon[0], -0.1033)
+        self.assertEqual(records.validity[0], b'A')
+        self.assertEqual(records.press_alt[0], 587.0)
+        self.assertEqual(records.gnss_alt[0], 558.0)
+        self.assertEqual(records.extras[0], b'')
+
+    def testMalformedRecords(self):
+        self.assertParity([
+            'B1101355206343N00006198WA0058700558',
+            'B1101365206343N00006198WX0058700558',  # bad validity
+            'B1101375206343Q00006198WA0058700558',  # bad hemisphere
+            'B11013752063',  # truncated
+            'B1101385206343N00006198WA-005800558',  # negative press alt
+            'B1101395206343N00006198WA005870-558',  # misplaced sign
+            'B1101405206343N00006198WA00587-0055',  # negative gnss alt
+            'B11014a5206343N00006198WA0058700558',  # letter in time
+            'B1101415206343S00006198EV0058700558',
+            'B1101425206343N00006198WA0058700558\xe9',  # latin-1 tail
+        ])
+
+    def testExtras(self):
+        self.assertParity([
+            'B1101355206343N00006198WA0058700558012-abcXYZ',
+            'B1101365206343N00006198WA0058700558012 abc',
+            'B1101375206343N00006198WA0058700558\xe9012',
+            'B1101385206343N00006198WA0058700558',
+        ])
+
+    def testDuplicateRawtimeDropped(self):
+        lines = [
+            'B1101355206343N00006198WA0058700558',
+            'B1101355206344N00006198WA0058700558',
+            'B11013552063',
+            'B1101355206345N00006198WA0058700558',
+            'B1101365206346N00006198WA0058700558',
+        ]
+        self.assertParity(lines)
+        records = b_records.parse_B_records(lines)
+        self.assertEqual(len(records.rawtime), 2)
+
+    def testBytesInput(self):
+        lines = ['B1101355206343N00006198WA0058700558',
+                 'B1101365206343N00006198WA0058700558FXA']
+        from_str = b_records.parse_B_records(lines)
+        from_bytes = b_records.parse_B_records(
+            [line.encode('ascii') for line in lines])
+        for column_str, column_bytes in zip(from_str, from_bytes):
+            self.assertListEqual(list(column_str), list(column_bytes))
+
+
+class TestExtensions(unittest.TestCase):
+
+    def testParseIRecords(self):
+        self.assertListEqual(
+            b_records.parse_I_records(['I033638FXA3940SIU4143enl']),
+            [b_records.ExtensionField('FXA', 0, 3),
+             b_records.ExtensionField('SIU', 3, 5),
+             b_records.ExtensionField('ENL', 5, 8)])
+        self.assertListEqual(b_records.parse_I_records(['I02363', 'Ixx']), [])
+
+    def testDecodeExtensions(self):
+        fields = b_records.parse_I_records(['I033638FXA3940SIU4143ENL'])
+        extras = ['01203999', '012-3-12', '0120', '0a2', '']
+        records = b_records.parse_B_records(
+            ['B1101%02d5206343N00006198WA0058700558%s' % (second, extra)
+             for second, extra in enumerate(extras)])
+        columns = b_records.decode_extensions(records.extras, fields)
+        self.assertListEqual(list(columns), ['FXA', 'SIU', 'ENL'])
+        nan = float('nan')
+        for code, expected in [('FXA', [12, 12, 12, nan, nan]),
+                               ('SIU', [3, -3, nan, nan, nan]),
+                               ('ENL', [999, -12, nan, nan, nan])]:
+            self.assertListEqual(
+                [None if math.isnan(value) else value
+                 for value in columns[code].tolist()],
+                [None if math.isnan(value) else value for value in expected])
+
+    def testNoIRecordsNoColumns(self):
+        records = b_records.parse_B_records(
+            ['B1101355206343N00006198WA0058700558123'])
+        self.assertEqual(len(b_records.decode_extensions(records.extras, [])),
+                         0)
+
+    def testFlightColumns(self):
+        flight = igc_lib.Flight.create_from_file('testfiles/napret.igc')
+        self.assertListEqual(list(flight.fixes.extensions),
+                             ['FXA', 'SIU', 'ENL'])
+        fix = flight.fixes[0]
+        self.assertEqual(fix.extension('FXA'), float(fix.extras[0:3]))
+        self.assertEqual(fix.extension('ENL'), float(fix.extras[5:8]))
+        self.assertIsNone(fix.extension('TAS'))
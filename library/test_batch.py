@@ -0,0 +1,106 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import igc_lib
+import lib.batch as batch
+
+
+def _count_thermals(flight):
+    return len(flight.thermals)
+
+
+class TestIterFlights(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filenames = sorted(glob.glob('testfiles/*.igc'))
+        invalid = os.path.join(self.tmp_dir, 'invalid.igc')
+        with open(invalid, 'w') as igc_file:
+            igc_file.write('HFDTE150718\nB1101355206343N00006198WA0058700558\n')
+        self.filenames.append(invalid)
+        # Enough valid fixes to reach the date record, day 32.
+        self.bad_date = os.path.join(self.tmp_dir, 'bad_date.igc')
+        with open(self.bad_date, 'w') as igc_file:
+            igc_file.write('HFDTE320718\n')
+            for second in range(200):
+                igc_file.write(
+                    'B11%02d%02d5206343N00006198WA%05d%05d\n' %
+                    (second // 60, second % 60, 500 + second, 520 + second))
+        self.filenames.append(os.path.join(self.tmp_dir, 'missing.igc'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def testOrderedMatchesSerialLoading(self):
+        results = list(batch.iter_flights(
+            self.filenames, workers=2, chunk_size=2, ordered=True))
+        self.assertListEqual([result.filename for result in results],
+                             self.filenames)
+        for result in results[:-1]:
+            flight = igc_lib.Flight.create_from_file(result.filename)
+            self.assertEqual(result.valid, flight.valid)
+            self.assertListEqual(result.notes, flight.notes)
+            if result.valid:
+                self.assertEqual(len(result.flight.fixes), len(flight.fixes))
+                self.assertEqual(len(result.flight.thermals),
+                                 len(flight.thermals))
+            else:
+                self.assertIsNone(result.flight)
+
+    def testUnorderedReturnsAllFiles(self):
+        results = list(batch.iter_flights(
+            self.filenames, workers=3, chunk_size=1))
+        self.assertListEqual(
+            sorted(result.filename for result in results),
+            sorted(self.filenames))
+
+    def testInvalidFlightsComeWithNotes(self):
+        results = list(batch.iter_flights(
+            [self.filenames[-2], self.bad_date, self.filenames[-1]],
+            workers=2, chunk_size=3))
+        self.assertFalse(results[0].valid)
+        self.assertIn('less than the minimum', results[0].notes[0])
+        self.assertFalse(results[1].valid)
+        self.assertIn('could not parse', results[1].notes[0])
+        self.assertIsNone(results[1].flight)
+        self.assertFalse(results[2].valid)
+        self.assertIn('could not read', results[2].notes[0])
+
+    def testTransform(self):
+        counts = batch.load_flights(
+            self.filenames, workers=2, transform=_count_thermals)
+        expected = [len(flight.thermals)
+                    for flight in batch.load_flights(self.filenames, workers=1)]
+        self.assertListEqual(counts, expected)
+
+    def testCacheDir(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        expected = [(result.valid, result.notes)
+                    for result in batch.iter_flights(self.filenames, workers=1)]
+        for _ in range(2):
+            results = list(batch.iter_flights(
+                self.filenames, workers=2, ordered=True, cache_dir=cache_dir))
+            self.assertListEqual(
+                [(result.valid, result.notes) for result in results], expected)
+        self.assertTrue(os.listdir(cache_dir))
+
+    def testArchiveMembersAreLoadedInParallel(self):
+        archive_dir = os.path.join(self.tmp_dir, 'archived')
+        os.mkdir(archive_dir)
+        with zipfile.ZipFile(os.path.join(archive_dir, 'day.zip'), 'w',
+                             zipfile.ZIP_DEFLATED) as archive:
+            for filename in self.filenames[:-2]:
+                archive.write(filename, os.path.basename(filename))
+        results = list(batch.iter_directory(
+            archive_dir, workers=2, chunk_size=1, ordered=True))
+        self.assertEqual(len(results), len(self.filenames) - 2)
+        for result, filename in zip(results, self.filenames):
+            self.assertTrue(result.filename.endswith(
+                '::' + os.path.basename(filename)))
+            flight = igc_lib.Flight.create_from_file(filename)
+            self.assertEqual(result.valid, flight.valid)
+            self.assertListEqual(result.notes, flight.notes)
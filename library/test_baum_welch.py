@@ -0,0 +1,145 @@
+import itertools
+import unittest
+
+import numpy as np
+
+import igc_lib
+import lib.baum_welch as baum_welch
+
+
+def _brute_force_statistics(model, sequences):
+    """Expected counts by enumeration of all the state sequences."""
+    init_probs, transition_probs, emission_probs = [
+        np.array(probs) for probs in model]
+    num_states, num_emissions = emission_probs.shape
+    statistics = baum_welch.empty_statistics(num_states, num_emissions)
+    init_counts, transition_counts, emission_counts, log_likelihood, _ = (
+        statistics)
+    for emissions in sequences:
+        paths = list(itertools.product(range(num_states),
+                                       repeat=len(emissions)))
+        probs = []
+        for states in paths:
+            prob = (init_probs[states[0]] *
+                    emission_probs[states[0], emissions[0]])
+            for step in range(1, len(emissions)):
+                prob *= transition_probs[states[step - 1], states[step]]
+                prob *= emission_probs[states[step], emissions[step]]
+            probs.append(prob)
+        total = sum(probs)
+        log_likelihood += np.log(total)
+        for states, prob in zip(paths, probs):
+            weight = prob / total
+            init_counts[states[0]] += weight
+            for previous, state in zip(states, states[1:]):
+                transition_counts[previous, state] += weight
+            for state, emission in zip(states, emissions):
+                emission_counts[state, emission] += weight
+    return statistics._replace(log_likelihood=log_likelihood,
+                               num_sequences=len(sequences))
+
+
+def _sample(random, model, length):
+    init_probs, transition_probs, emission_probs = [
+        np.array(probs) for probs in model]
+    state = random.choice(len(init_probs), p=init_probs)
+    emissions = []
+    for _ in range(length):
+        emissions.append(random.choice(emission_probs.shape[1],
+                                       p=emission_probs[state]))
+        state = random.choice(len(init_probs), p=transition_probs[state])
+    return np.array(emissions)
+
+
+class TestExpectedStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.model = (
+            (0.6, 0.3, 0.1),
+            ((0.8, 0.15, 0.05), (0.1, 0.8, 0.1), (0.0, 0.3, 0.7)),
+            ((0.6, 0.3, 0.1, 0.0), (0.2, 0.5, 0.2, 0.1),
+             (0.1, 0.1, 0.3, 0.5)))
+        random = np.random.RandomState(0)
+        self.sequences = [random.randint(0, 4, length)
+                          for length in [5, 1, 6, 3, 6, 2]]
+
+    def assertSameStatistics(self, statistics, expected):
+        for values, expected_values in zip(statistics, expected):
+            np.testing.assert_allclose(values, expected_values, atol=1e-10)
+
+    def testMatchesBruteForce(self):
+        self.assertSameStatistics(
+            baum_welch.expected_statistics(
+                self.model, self.sequences + [[]], batch_size=4),
+            _brute_force_statistics(self.model, self.sequences))
+
+    def testMergeStatistics(self):
+        merged = baum_welch.merge_statistics([
+            baum_welch.expected_statistics(self.model, self.sequences[:2]),
+            baum_welch.expected_statistics(self.model, self.sequences[2:])])
+        self.assertSameStatistics(
+            merged,
+            baum_welch.expected_statistics(self.model, self.sequences))
+
+    def testLongSequencesDoNotUnderflow(self):
+        random = np.random.RandomState(1)
+        sequences = [random.randint(0, 4, 5000)]
+        statistics = baum_welch.expected_statistics(self.model, sequences)
+        self.assertTrue(np.isfinite(statistics.log_likelihood))
+        np.testing.assert_allclose(
+            [statistics.init_counts.sum(),
+             statistics.transition_counts.sum(),
+             statistics.emission_counts.sum()],
+            [1.0, 4999.0, 5000.0], rtol=1e-7)
+
+
+class TestTrain(unittest.TestCase):
+
+    def testRecoversModel(self):
+        random = np.random.RandomState(2)
+        model = ((0.7, 0.3),
+                 ((0.99, 0.01), (0.02, 0.98)),
+                 ((0.9, 0.1), (0.15, 0.85)))
+        sequences = [_sample(random, model, 2000) for _ in range(30)]
+        initial = ((0.5, 0.5), ((0.9, 0.1), (0.1, 0.9)),
+                   ((0.7, 0.3), (0.3, 0.7)))
+        fitted, log_likelihoods = baum_welch.train(sequences, initial,
+                                                   chunk_size=15)
+        self.assertTrue(np.all(np.diff(log_likelihoods) > -1e-6))
+        np.testing.assert_allclose(fitted[1], model[1], atol=0.005)
+        np.testing.assert_allclose(fitted[2], model[2], atol=0.02)
+        self.assertIsInstance(fitted[1][0], tuple)
+
+    def testPseudoCount(self):
+        statistics = baum_welch.empty_statistics(2, 3)._replace(
+            emission_counts=np.array([[3.0, 0.0, 1.0], [0.0, 0.0, 0.0]]))
+        model = baum_welch.maximize(statistics, pseudo_count=1.0)
+        self.assertEqual(model[0], (0.5, 0.5))
+        np.testing.assert_allclose(model[2], [[4.0 / 7, 1.0 / 7, 2.0 / 7],
+                                              [1.0 / 3, 1.0 / 3, 1.0 / 3]])
+
+
+class TestTrainConfigModels(unittest.TestCase):
+
+    def testFitsModelsOfTestFlights(self):
+        filenames = ['testfiles/napret.igc', 'testfiles/olsztyn.igc',
+                     'testfiles/south.igc']
+        flying_model, circling_model = baum_welch.train_config_models(
+            filenames, workers=1, max_iterations=3)
+
+        class TrainedConfig(igc_lib.FlightParsingConfig):
+            pass
+
+        TrainedConfig.flying_model = flying_model
+        TrainedConfig.circling_model = circling_model
+        flight = igc_lib.Flight.create_from_file(filenames[0], TrainedConfig)
+        self.assertTrue(flight.valid)
+        self.assertEqual(flight._flying_model(), flying_model)
+        self.assertEqual(flight._circling_model(), circling_model)
+        # Circling is sticky in straight flight and in thermals.
+        self.assertGreater(circling_model[1][0][0], 0.9)
+        self.assertGreater(circling_model[1][1][1], 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import igc_lib
+import lib.corpus_index as corpus_index
+
+
+class TestCorpusIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for filename in glob.glob('testfiles/*.igc'):
+            shutil.copy(filename, self.tmp_dir)
+        self.filenames = sorted(glob.glob(os.path.join(self.tmp_dir, '*.igc')))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def testHeaderMatchesFlight(self):
+        for filename in self.filenames:
+            flight = igc_lib.Flight.create_from_file(filename)
+            if not flight.valid:
+                continue
+            record = corpus_index.scan_header(filename)
+            self.assertEqual(record.date, flight.date)
+            self.assertEqual(record.glider_type, flight.glider_type)
+            self.assertEqual(record.competition_class,
+                             flight.competition_class)
+
+    def testStopsAtFirstBRecord(self):
+        filename = os.path.join(self.tmp_dir, 'late_header.igc')
+        with open(filename, 'w') as igc_file:
+            igc_file.write('HFDTE150718\r\n'
+                           'B1101355206343N00006198WA0058700558\r\n'
+                           'HFGTYGLIDERTYPE:Late\r\n')
+        record = corpus_index.scan_header(filename)
+        self.assertEqual(str(record.date), '2018-07-15')
+        self.assertIsNone(record.glider_type)
+
+    def testUnreadableFile(self):
+        record = corpus_index.scan_header(
+            os.path.join(self.tmp_dir, 'missing.igc'))
+        self.assertIsNone(record.size)
+        self.assertIsNone(record.date)
+
+    def testParallelMatchesSerial(self):
+        self.assertListEqual(
+            corpus_index.build_index(self.filenames, workers=2, chunk_size=1),
+            corpus_index.build_index(self.filenames, workers=1))
+
+    def testPersistAndReuse(self):
+        index_filename = os.path.join(self.tmp_dir, 'index.json')
+        records = corpus_index.build_directory_index(
+            self.tmp_dir, index_filename=index_filename, workers=1)
+        self.assertEqual(len(records), len(self.filenames))
+        self.assertListEqual(corpus_index.load_index(index_filename), records)
+
+        # Unchanged files are not scanned again.
+        stale = [record._replace(glider_type='cached') for record in records]
+        reused = corpus_index.build_index(
+            self.filenames, workers=1, previous=stale)
+        self.assertListEqual(reused, stale)
+
+    def testGroupBy(self):
+        records = corpus_index.build_index(self.filenames, workers=1)
+        groups = corpus_index.group_by(records, 'date')
+        self.assertEqual(sum(len(group) for group in groups.values()),
+                         len(records))
+        for date, group in groups.items():
+            for record in group:
+                self.assertEqual(record.date, date)
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import igc_lib
+import lib.flight_cache as flight_cache
+
+
+class StricterConfig(igc_lib.FlightParsingConfig):
+    min_time_for_thermal = 120.0
+
+
+class TestFlightCache(unittest.TestCase):
+
+    def setUp(self):
+        self.igc_file = 'testfiles/napret.igc'
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = flight_cache.FlightCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def entries(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if name.endswith('.npz')]
+
+    def testMissThenHit(self):
+        self.assertIsNone(self.cache.load(self.igc_file))
+        self.cache.get_flight(self.igc_file)
+        self.assertEqual(len(self.entries()), 1)
+        self.assertIsNotNone(self.cache.load(self.igc_file))
+
+    def testWarmLoadMatchesParsing(self):
+        expected = igc_lib.Flight.create_from_file(self.igc_file)
+        self.cache.get_flight(self.igc_file)
+        flight = self.cache.get_flight(self.igc_file)
+
+        self.assertTrue(flight.valid)
+        self.assertEqual(flight.date, expected.date)
+        self.assertEqual(flight.glider_type, expected.glider_type)
+        self.assertEqual(flight.alt_source, expected.alt_source)
+        self.assertListEqual(flight.notes, expected.notes)
+        for name in ['rawtime', 'lat', 'lon', 'validity', 'extras', 'alt',
+                     'gsp', 'bearing', 'bearing_change_rate', 'flying',
+                     'circling']:
+            np.testing.assert_array_equal(getattr(flight.fixes, name),
+                                          getattr(expected.fixes, name))
+        self.assertEqual(flight.takeoff_fix.index, expected.takeoff_fix.index)
+        self.assertEqual(flight.landing_fix.index, expected.landing_fix.index)
+        np.testing.assert_array_equal(flight.flying_segments,
+                                      expected.flying_segments)
+        for name in ['thermal_segments', 'glide_segments']:
+            for column, expected_column in zip(getattr(flight, name),
+                                               getattr(expected, name)):
+                np.testing.assert_array_equal(column, expected_column)
+        self.assertListEqual(
+            [(t.enter_fix.index, t.exit_fix.index) for t in flight.thermals],
+            [(t.enter_fix.index, t.exit_fix.index) for t in expected.thermals])
+        self.assertListEqual(
+            [g.track_length for g in flight.glides],
+            [g.track_length for g in expected.glides])
+        self.assertIs(flight.thermals[0].enter_fix.flight, flight)
+
+    def testInvalidFlightIsCached(self):
+        invalid_file = os.path.join(self.cache_dir, 'invalid.igc')
+        with open(invalid_file, 'w') as igc_file:
+            igc_file.write('B1101355206343N00006198WA0058700558\n')
+        self.cache.get_flight(invalid_file)
+        flight = self.cache.load(invalid_file)
+        self.assertFalse(flight.valid)
+        self.assertIn('less than the minimum', flight.notes[0])
+
+    def testConfigChangeInvalidates(self):
+        self.cache.get_flight(self.igc_file)
+        stricter = flight_cache.FlightCache(
+            self.cache_dir, config_class=StricterConfig)
+        self.assertIsNone(stricter.load(self.igc_file))
+        self.assertNotEqual(stricter.entry_path(self.igc_file),
+                            self.cache.entry_path(self.igc_file))
+
+    def testEviction(self):
+        self.cache.get_flight(self.igc_file)
+        entry_size = os.path.getsize(self.cache.entry_path(self.igc_file))
+        small = flight_cache.FlightCache(
+            self.cache_dir, max_bytes=int(entry_size * 1.5),
+            config_class=StricterConfig)
+        small.get_flight(self.igc_file)
+        self.assertListEqual(
+            self.entries(),
+            [os.path.basename(small.entry_path(self.igc_file))])
+
+    def testEvictionDownToLowWater(self):
+        flight = self.cache.get_flight(self.igc_file)
+        entry_size = os.path.getsize(self.cache.entry_path(self.igc_file))
+        self.cache.clear()
+        cache = flight_cache.FlightCache(
+            self.cache_dir, max_bytes=int(entry_size * 4.5), low_water=0.5)
+        for index in range(4):
+            cache._store_entry(
+                os.path.join(self.cache_dir, '%d.npz' % index), flight)
+        # Stores below the limit do not scan the directory.
+        self.assertEqual(cache._stores, 3)
+        cache._store_entry(os.path.join(self.cache_dir, '4.npz'), flight)
+        self.assertEqual(len(self.entries()), 2)
+        self.assertEqual(cache._total_bytes, 2 * entry_size)
+
+    def testCorruptEntryIsAMiss(self):
+        self.cache.get_flight(self.igc_file)
+        path = self.cache.entry_path(self.igc_file)
+        with open(path, 'r+b') as entry_file:
+            entry_file.truncate(os.path.getsize(path) // 2)
+        self.assertIsNone(self.cache.load(self.igc_file))
+        self.assertListEqual(self.entries(), [])
+        self.assertTrue(self.cache.get_flight(self.igc_file).valid)
+
+    def testExtensionsAreCached(self):
+        expected = igc_lib.Flight.create_from_file(self.igc_file)
+        self.cache.get_flight(self.igc_file)
+        flight = self.cache.load(self.igc_file)
+        self.assertListEqual(list(flight.fixes.extensions),
+                             list(expected.fixes.extensions))
+        for code, column in expected.fixes.extensions.items():
+            np.testing.assert_array_equal(flight.fixes.extensions[code],
+                                          column)
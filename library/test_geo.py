@@ -1,6 +1,8 @@
 import math
 import unittest
 
+import numpy as np
+
 import lib.geo as geo
 
 
@@ -172,3 +174,118 @@ class TestSphereAngle(unittest.TestCase):
                 lat=51.507222, lon=-0.1275,
                 lat2=48.856667, lon2=2.350833),
             46.704, places=3)
+
+
+class TestVectorized(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        n = 500
+        self.lat1 = random.uniform(-89.0, 89.0, n)
+        self.lon1 = random.uniform(-180.0, 180.0, n)
+        # Half far away points, half points less than 1 km away.
+        self.lat2 = np.where(np.arange(n) % 2, random.uniform(-89.0, 89.0, n),
+                             self.lat1 + random.uniform(-0.005, 0.005, n))
+        self.lon2 = np.where(np.arange(n) % 2,
+                             random.uniform(-180.0, 180.0, n),
+                             self.lon1 + random.uniform(-0.005, 0.005, n))
+
+    def assertMatchesScalar(self, vectorized, scalar, *args):
+        expected = [scalar(*values) for values in zip(*args)]
+        np.testing.assert_allclose(vectorized(*args), expected,
+                                   rtol=1e-9, atol=1e-9)
+
+    def testSphereDistances(self):
+        self.assertMatchesScalar(
+            geo.sphere_distances, geo.sphere_distance,
+            *map(np.radians, [self.lat1, self.lon1, self.lat2, self.lon2]))
+
+    def testEarthDistances(self):
+        self.assertMatchesScalar(geo.earth_distances, geo.earth_distance,
+                                 self.lat1, self.lon1, self.lat2, self.lon2)
+
+    def testBearingsTo(self):
+        self.assertMatchesScalar(geo.bearings_to, geo.bearing_to,
+                                 self.lat1, self.lon1, self.lat2, self.lon2)
+
+    def testSphereAngles(self):
+        # The law of cosines is ill-conditioned for very short sides, both
+        # versions lose precision there, compare distant points only.
+        far = slice(1, None, 2)
+        self.assertMatchesScalar(
+            geo.sphere_angles, geo.sphere_angle, self.lat1[far],
+            self.lon1[far], self.lat2[far], self.lon2[far],
+            self.lat1[::-2], self.lon1[::-2])
+
+    def testBroadcasting(self):
+        distances = geo.earth_distances(
+            51.507222, -0.1275, [40.7127, 51.507222], [-74.0059, -0.1275])
+        np.testing.assert_allclose(distances, [5570.249, 0.0], atol=1e-3)
+
+    def testConsecutivePairs(self):
+        lat, lon = self.lat1[::2], self.lon1[::2]
+        np.testing.assert_allclose(
+            geo.consecutive_distances(lat, lon),
+            [geo.earth_distance(lat[i], lon[i], lat[i+1], lon[i+1])
+             for i in range(len(lat) - 1)], rtol=1e-9)
+        np.testing.assert_allclose(
+            geo.consecutive_bearings(lat, lon),
+            [geo.bearing_to(lat[i], lon[i], lat[i+1], lon[i+1])
+             for i in range(len(lat) - 1)], rtol=1e-9, atol=1e-9)
+        self.assertEqual(len(geo.consecutive_distances([1.0], [2.0])), 0)
+
+
+class TestLocalBackend(unittest.TestCase):
+
+    def makePairs(self, max_distance, max_lat=70.0, n=20000):
+        random = np.random.RandomState(1)
+        lat1 = random.uniform(-max_lat, max_lat, n)
+        lon1 = random.uniform(-180.0, 180.0, n)
+        distance = random.uniform(0.001, max_distance, n)
+        bearing = random.uniform(0.0, 2.0 * math.pi, n)
+        arc = distance / geo.EARTH_RADIUS_KM
+        lat2 = lat1 + np.degrees(arc * np.cos(bearing))
+        lon2 = lon1 + np.degrees(arc * np.sin(bearing) /
+                                 np.cos(np.radians(lat1)))
+        return lat1, lon1, lat2, lon2
+
+    def testDistanceErrorBound(self):
+        for max_distance, max_error in [(1.0, 1e-8), (10.0, 1e-6)]:
+            pairs = self.makePairs(max_distance)
+            exact = geo.earth_distances(*pairs)
+            approx = geo.local_distances(*pairs)
+            self.assertLess(np.max(np.fabs(approx - exact) / exact),
+                            max_error)
+
+    def testBearingErrorBound(self):
+        for max_distance, max_error in [(1.0, 0.015), (10.0, 0.15)]:
+            pairs = self.makePairs(max_distance)
+            error = (geo.local_bearings_to(*pairs) -
+                     geo.bearings_to(*pairs) + 180.0) % 360.0 - 180.0
+            self.assertLess(np.max(np.fabs(error)), max_error)
+
+    def testAntimeridian(self):
+        self.assertAlmostEqual(
+            float(geo.local_distances(0.0, 179.999, 0.0, -179.999)),
+            geo.earth_distance(0.0, 179.999, 0.0, -179.999), places=9)
+        self.assertAlmostEqual(
+            float(geo.local_bearings_to(0.0, 179.999, 0.0, -179.999)), 90.0)
+
+    def testConsecutiveBackends(self):
+        lat, lon = self.makePairs(1.0, n=100)[:2]
+        for backend in geo.DISTANCE_BACKENDS:
+            np.testing.assert_array_equal(
+                geo.consecutive_distances(lat, lon, backend),
+                geo.DISTANCE_BACKENDS[backend].distances(
+                    lat[:-1], lon[:-1], lat[1:], lon[1:]))
+
+    def testLocalOffsetsRoundTrip(self):
+        lat1, lon1, lat2, lon2 = self.makePairs(10.0, n=1000)
+        east, north = geo.local_offsets(lat1, lon1, lat2, lon2)
+        np.testing.assert_allclose(np.hypot(east, north),
+                                   geo.earth_distances(lat1, lon1, lat2,
+                                                       lon2), rtol=1e-3)
+        lat, lon = geo.from_local_offsets(lat1, lon1, east, north)
+        np.testing.assert_allclose(lat, lat2, rtol=0.0, atol=1e-9)
+        np.testing.assert_allclose((lon - lon2 + 180.0) % 360.0 - 180.0,
+                                   0.0, atol=1e-9)
@@ -0,0 +1,115 @@
+import unittest
+
+import numpy as np
+
+import lib.geo as geo
+import lib.hotspots as hotspots
+
+
+def _dbscan_brute_force(lat, lon, eps, min_samples):
+    """A reference DBSCAN on the full distance matrix."""
+    distances = geo.earth_distances(
+        lat[:, np.newaxis], lon[:, np.newaxis],
+        lat[np.newaxis, :], lon[np.newaxis, :])
+    within = distances <= eps
+    core = within.sum(axis=1) >= min_samples
+    labels = np.full(len(lat), -1)
+    num_clusters = 0
+    for seed in np.flatnonzero(core):
+        if labels[seed] >= 0:
+            continue
+        labels[seed] = num_clusters
+        stack = [seed]
+        while stack:
+            point = stack.pop()
+            for neighbor in np.flatnonzero(within[point] & core):
+                if labels[neighbor] < 0:
+                    labels[neighbor] = num_clusters
+                    stack.append(neighbor)
+        num_clusters += 1
+    core_distances = np.where(core[np.newaxis, :], distances, np.inf)
+    nearest = np.argmin(core_distances, axis=1)
+    border = (~core) & (core_distances[np.arange(len(lat)), nearest] <= eps)
+    labels[border] = labels[nearest[border]]
+    return core, labels
+
+
+class TestDbscan(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        centres_lat = random.uniform(45.0, 46.0, 12)
+        centres_lon = random.uniform(6.0, 7.5, 12)
+        cluster = random.randint(0, 12, 900)
+        self.lat = np.concatenate([
+            centres_lat[cluster] + random.normal(0.0, 0.004, 900),
+            random.uniform(45.0, 46.0, 300)])
+        self.lon = np.concatenate([
+            centres_lon[cluster] + random.normal(0.0, 0.006, 900),
+            random.uniform(6.0, 7.5, 300)])
+
+    def assertSamePartition(self, labels, expected):
+        np.testing.assert_array_equal(labels < 0, expected < 0)
+        pairs = set(zip(labels[labels >= 0], expected[expected >= 0]))
+        self.assertEqual(len(pairs), len(set(labels[labels >= 0])))
+        self.assertEqual(len(pairs), len(set(expected[expected >= 0])))
+
+    def testMatchesBruteForce(self):
+        for eps, min_samples in [(0.3, 5), (0.8, 20), (2.0, 3)]:
+            labels = hotspots.dbscan(self.lat, self.lon, eps, min_samples,
+                                     chunk_size=100)
+            _, expected = _dbscan_brute_force(self.lat, self.lon, eps,
+                                              min_samples)
+            self.assertSamePartition(labels, expected)
+
+    def testLabelsBySize(self):
+        labels = hotspots.dbscan(self.lat, self.lon, 0.5, 5)
+        sizes = np.bincount(labels[labels >= 0])
+        self.assertTrue(np.all(np.diff(sizes) <= 0))
+        self.assertEqual(len(sizes), 12)
+
+    def testAllNoise(self):
+        labels = hotspots.dbscan(self.lat[900:], self.lon[900:], 0.01, 2)
+        self.assertTrue(np.all(labels == -1))
+
+
+class TestClusterStatistics(unittest.TestCase):
+
+    def testStatistics(self):
+        day = 24 * 3600.0
+        table = hotspots.ThermalTable(
+            lat=np.array([45.0, 45.002, 45.001, 46.0, 46.0, 10.0]),
+            lon=np.array([6.0, 6.0, 6.001, 7.0, 7.0, 10.0]),
+            vertical_velocity=np.array([1.0, 2.0, 3.0, 0.5, 1.5, 9.0]),
+            alt_change=np.array([100.0, 200.0, 300.0, 50.0, 150.0, 9.0]),
+            timestamp=np.array([12.5 * 3600, day + 13.2 * 3600,
+                                day + 13.9 * 3600, 3 * day + 15 * 3600,
+                                3 * day + 15.5 * 3600, 0.0]))
+        labels, stats = hotspots.find_hotspots(table, eps=1.0,
+                                               min_samples=2)
+        np.testing.assert_array_equal(labels, [0, 0, 0, 1, 1, -1])
+        np.testing.assert_array_equal(stats.count, [3, 2])
+        np.testing.assert_allclose(stats.mean_vertical_velocity, [2.0, 1.0])
+        np.testing.assert_allclose(stats.mean_alt_change, [200.0, 100.0])
+        np.testing.assert_allclose(stats.lat, [45.001, 46.0], atol=1e-6)
+        np.testing.assert_allclose(stats.lon, [6.000333, 7.0], atol=1e-6)
+        self.assertEqual(stats.hour_counts.shape, (2, 24))
+        self.assertEqual(stats.hour_counts[0, 12], 1)
+        self.assertEqual(stats.hour_counts[0, 13], 2)
+        self.assertEqual(stats.hour_counts[1, 15], 2)
+        np.testing.assert_array_equal(stats.num_dates, [2, 1])
+
+    def testNoClusters(self):
+        table = hotspots.ThermalTable(
+            lat=np.array([45.0, 46.0]), lon=np.array([6.0, 7.0]),
+            vertical_velocity=np.ones(2), alt_change=np.ones(2),
+            timestamp=np.zeros(2))
+        labels, stats = hotspots.find_hotspots(table, eps=1.0,
+                                               min_samples=2)
+        np.testing.assert_array_equal(labels, [-1, -1])
+        self.assertEqual(len(stats.count), 0)
+        self.assertEqual(stats.hour_counts.shape, (0, 24))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import bz2
+import glob
+import gzip
+import lzma
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+import lib.b_records as b_records
+import lib.igc_reader as igc_reader
+
+
+def _read_text_mode(filename):
+    """Reference reader: text mode, line by line."""
+    records = {'A': [], 'B': [], 'H': [], 'I': []}
+    with open(filename, 'r', encoding='ISO-8859-1') as igc_file:
+        for line in igc_file:
+            line = line.replace('\n', '').replace('\r', '')
+            if line and line[0] in records:
+                records[line[0]].append(line)
+    return records
+
+
+class RecordsAssertions(object):
+
+    def assertSameRecords(self, left, right):
+        self.assertListEqual(left.a_records, right.a_records)
+        self.assertListEqual(left.h_records, right.h_records)
+        self.assertListEqual(left.i_records, right.i_records)
+        for left_column, right_column in zip(left.b_records, right.b_records):
+            self.assertListEqual(list(left_column), list(right_column))
+
+
+class TestReadFile(RecordsAssertions, unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def writeFile(self, content):
+        filename = os.path.join(self.tmp_dir, 'flight.igc')
+        with open(filename, 'wb') as igc_file:
+            igc_file.write(content)
+        return filename
+
+    def assertMatchesTextMode(self, filename):
+        expected = _read_text_mode(filename)
+        for use_mmap in [True, False]:
+            records = igc_reader.read_file(filename, use_mmap=use_mmap)
+            self.assertListEqual(records.a_records, expected['A'])
+            self.assertListEqual(records.h_records, expected['H'])
+            self.assertListEqual(records.i_records, expected['I'])
+            self.assertSameRecords(
+                records,
+                igc_reader.IgcRecords(
+                    expected['A'], expected['H'], expected['I'],
+                    b_records.parse_B_records(expected['B'])))
+
+    def testTestFilesMatchTextMode(self):
+        filenames = glob.glob('testfiles/*.igc')
+        self.assertTrue(filenames)
+        for filename in filenames:
+            self.assertMatchesTextMode(filename)
+
+    def testLineTerminators(self):
+        lines = [b'AXCTabc', b'HFDTE150718',
+                 b'B1101355206343N00006198WA0058700558',
+                 b'B1101365206343N00006198WA0058700559',
+                 b'B1101375206343N00006198WA0058700560']
+        for separator in [b'\n', b'\r\n', b'\r', b'\n\n', b'\r\r\n']:
+            content = separator.join(lines)
+            for trailer in [b'', separator]:
+                records = igc_reader.read_file(
+                    self.writeFile(content + trailer))
+                self.assertListEqual(records.a_records, ['AXCTabc'])
+                self.assertListEqual(records.h_records, ['HFDTE150718'])
+                self.assertListEqual(
+                    list(records.b_records.gnss_alt), [558.0, 559.0, 560.0])
+
+    def testMixedTerminatorsMatchTextMode(self):
+        self.assertMatchesTextMode(self.writeFile(
+            b'\r\nHFDTE150718\rHFGTYGLIDERTYPE:Caf\xe9\r\n\n'
+            b'I013638FXA\n'
+            b'B1101355206343N00006198WA0058700558012\r'
+            b'LXXX comment\r\n'
+            b'B1101365206343N00006198WA00587'))
+
+    def testEmptyFile(self):
+        records = igc_reader.read_file(self.writeFile(b''))
+        self.assertListEqual(records.h_records, [])
+        self.assertEqual(len(records.b_records.rawtime), 0)
+
+    def testReadRecordsFromBytes(self):
+        filename = glob.glob('testfiles/*.igc')[0]
+        with open(filename, 'rb') as igc_file:
+            content = igc_file.read()
+        self.assertSameRecords(igc_reader.read_records(content),
+                               igc_reader.read_file(filename))
+
+
+class TestCompressedSources(RecordsAssertions, unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.igc_files = sorted(glob.glob('testfiles/*.igc'))
+        self.contents = {}
+        for filename in self.igc_files:
+            with open(filename, 'rb') as igc_file:
+                self.contents[os.path.basename(filename)] = igc_file.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def tmpPath(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def writeZip(self, name):
+        with zipfile.ZipFile(self.tmpPath(name), 'w',
+                             zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('README.txt', 'not an IGC file')
+            for filename in self.igc_files:
+                archive.write(filename, 'day/' + os.path.basename(filename))
+        return self.tmpPath(name)
+
+    def writeTar(self, name, mode):
+        with tarfile.open(self.tmpPath(name), mode) as archive:
+            for filename in self.igc_files:
+                archive.add(filename, 'day/' + os.path.basename(filename))
+        return self.tmpPath(name)
+
+    def testCompressedFiles(self):
+        name, content = sorted(self.contents.items())[0]
+        for suffix, module in [('.gz', gzip), ('.bz2', bz2), ('.xz', lzma)]:
+            filename = self.tmpPath(name + suffix)
+            with module.open(filename, 'wb') as compressed_file:
+                compressed_file.write(content)
+            self.assertTrue(igc_reader.is_compressed(filename))
+            self.assertSameRecords(igc_reader.read_file(filename),
+                                   igc_reader.read_records(content))
+            header = igc_reader.read_header_file(filename)
+            self.assertListEqual(header.h_records,
+                                 igc_reader.read_records(content).h_records)
+
+    def testArchiveMembers(self):
+        for archive in [self.writeZip('day.zip'),
+                        self.writeTar('day.tar', 'w'),
+                        self.writeTar('day.tar.gz', 'w:gz'),
+                        self.writeTar('day.tar.xz', 'w:xz')]:
+            sources = igc_reader.list_archive(archive)
+            self.assertListEqual(
+                sources, [archive + '::day/' + name
+                          for name in sorted(self.contents)])
+            for source in sources:
+                content = self.contents[source.rsplit('/', 1)[1]]
+                self.assertSameRecords(igc_reader.read_file(source),
+                                       igc_reader.read_records(content))
+                self.assertEqual(igc_reader.source_stat(source)[0],
+                                 len(content))
+            self.assertListEqual(
+                [source for source, _ in igc_reader.iter_archive(archive)],
+                sources)
+
+    def testMissingMember(self):
+        archive = self.writeZip('day.zip')
+        with self.assertRaises(IOError):
+            igc_reader.read_file(archive + '::day/missing.igc')
+
+    def testFindSources(self):
+        archive = self.writeZip('day.zip')
+        plain = self.tmpPath('plain.igc')
+        shutil.copy(self.igc_files[0], plain)
+        with gzip.open(self.tmpPath('packed.IGC.gz'), 'wb') as packed:
+            packed.write(b'')
+        with open(self.tmpPath('notes.txt'), 'w') as notes:
+            notes.write('not an IGC file')
+        self.assertListEqual(
+            igc_reader.find_sources(self.tmp_dir),
+            igc_reader.list_archive(archive) +
+            [self.tmpPath('packed.IGC.gz'), plain])
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+import igc_lib
+import lib.live_tracking as live_tracking
+
+
+class TestLiveTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = [
+            igc_lib.Flight.create_from_file('testfiles/napret.igc'),
+            igc_lib.Flight.create_from_file('testfiles/olsztyn.igc')]
+
+    def track(self, tracker):
+        gliders = [tracker.add_glider() for _ in self.flights]
+        states = {glider: ({}, {}) for glider in gliders}
+
+        def collect(committed):
+            for kind, kind_states in enumerate(committed):
+                for glider, position, state in zip(*kind_states):
+                    self.assertNotIn(position, states[glider][kind])
+                    states[glider][kind][position] = state
+
+        num_fixes = [len(flight.fixes) for flight in self.flights]
+        for step in range(max(num_fixes)):
+            rows = [row for row, count in enumerate(num_fixes)
+                    if step < count]
+            fixes = [self.flights[row].fixes for row in rows]
+            collect(tracker.update(
+                [gliders[row] for row in rows],
+                [fix.timestamp[step] for fix in fixes],
+                [fix.lat[step] for fix in fixes],
+                [fix.lon[step] for fix in fixes]))
+            ended = [gliders[row] for row in rows
+                     if step == num_fixes[row] - 1]
+            if ended:
+                collect(tracker.finish(ended))
+        return [[np.array([values[position] for position in range(count)])
+                 for values in states[glider]]
+                for glider, count in zip(gliders, num_fixes)]
+
+    def testMatchesFlight(self):
+        tracker = live_tracking.LiveTracker(lag=120, capacity=1)
+        for flight, (flying, circling) in zip(self.flights,
+                                              self.track(tracker)):
+            decoder = igc_lib._get_decoder(flight._flying_model())
+            np.testing.assert_array_equal(
+                flying, decoder.decode(flight._flying_emissions()))
+            # Circling is detected from the current flying states, not
+            # from the post-processed ones.
+            self.assertGreater(np.mean(circling == flight.fixes.circling),
+                               0.99)
+
+    def testGlidersAreReused(self):
+        tracker = live_tracking.LiveTracker(lag=10)
+        first = tracker.add_glider()
+        tracker.update([first], [0.0], [46.0], [7.0])
+        tracker.finish([first])
+        self.assertEqual(tracker.add_glider(), first)
+        flying, circling = tracker.current_states([first])
+        self.assertListEqual(flying.tolist(), [-1])
+        self.assertListEqual(circling.tolist(), [-1])
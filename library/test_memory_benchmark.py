@@ -0,0 +1,14 @@
+import unittest
+
+import lib.memory_benchmark as memory_benchmark
+
+
+class TestMemoryBenchmark(unittest.TestCase):
+
+    def testRun(self):
+        result = memory_benchmark.run(['testfiles/napret.igc'], 2)
+        self.assertEqual(result.flights, 2)
+        self.assertGreater(result.fixes, 0)
+        self.assertGreater(result.held_bytes, 0)
+        self.assertGreaterEqual(result.peak_bytes, result.held_bytes)
+        self.assertEqual(result.alive_after_release, 0)
@@ -0,0 +1,145 @@
+import unittest
+
+import numpy as np
+
+import igc_lib
+import lib.geo as geo
+import lib.spatial_index as spatial_index
+
+
+class TestSphereKDTree(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        n = 1500
+        # A dense soaring area, duplicates and points all over the globe.
+        self.lat = np.concatenate([random.normal(45.0, 0.2, n - 500),
+                                   random.uniform(-85.0, 85.0, 500)])
+        self.lon = np.concatenate([random.normal(6.0, 0.2, n - 500),
+                                   random.uniform(-180.0, 180.0, 500)])
+        self.lat[10:20] = self.lat[0]
+        self.lon[10:20] = self.lon[0]
+        self.tree = spatial_index.SphereKDTree(self.lat, self.lon,
+                                               leaf_size=8)
+        self.distances = geo.earth_distances(
+            self.lat[:, np.newaxis], self.lon[:, np.newaxis],
+            self.lat[np.newaxis, :], self.lon[np.newaxis, :])
+        np.fill_diagonal(self.distances, np.inf)
+
+    def testKnnMatchesBruteForce(self):
+        for k in [1, 7, 60]:
+            indices, distances = self.tree.query_knn(
+                self.lat, self.lon, k, exclude=np.arange(len(self.lat)),
+                chunk_size=300)
+            np.testing.assert_allclose(
+                distances, np.sort(self.distances, axis=1)[:, :k], atol=1e-6)
+            np.testing.assert_allclose(
+                np.take_along_axis(self.distances, indices, axis=1),
+                distances, atol=1e-6)
+
+    def testRadiusMatchesBruteForce(self):
+        for radius in [0.0, 2.0, 25.0]:
+            neighbors = self.tree.query_radius(
+                self.lat, self.lon, radius, exclude=np.arange(len(self.lat)),
+                chunk_size=400)
+            for i in [0, 15, 700, 1400]:
+                start, end = neighbors.offsets[i], neighbors.offsets[i + 1]
+                expected = np.flatnonzero(self.distances[i] <= radius)
+                self.assertSetEqual(set(neighbors.indices[start:end]),
+                                    set(expected))
+                self.assertTrue(np.all(np.diff(
+                    neighbors.distances[start:end]) >= 0.0))
+            self.assertListEqual(
+                np.diff(neighbors.offsets).tolist(),
+                (self.distances <= radius).sum(axis=1).tolist())
+
+    def testUnsortedRadiusHasSameNeighbors(self):
+        radius = np.linspace(0.1, 50.0, len(self.lat))
+        expected = self.tree.query_radius(self.lat, self.lon, radius,
+                                          chunk_size=200)
+        neighbors = self.tree.query_radius(self.lat, self.lon, radius,
+                                           chunk_size=200, sort=False)
+        np.testing.assert_array_equal(neighbors.offsets, expected.offsets)
+        for row in range(len(self.lat)):
+            rows = slice(neighbors.offsets[row], neighbors.offsets[row + 1])
+            order = np.argsort(neighbors.indices[rows])
+            np.testing.assert_array_equal(
+                neighbors.indices[rows][order],
+                np.sort(expected.indices[rows]))
+            np.testing.assert_allclose(
+                neighbors.distances[rows][order],
+                expected.distances[rows][np.argsort(expected.indices[rows])])
+
+    def testCoincidentPoints(self):
+        # A block of duplicates, larger than many leaves.
+        lat = np.concatenate([self.lat, np.full(3000, 45.5)])
+        lon = np.concatenate([self.lon, np.full(3000, 6.5)])
+        tree = spatial_index.SphereKDTree(lat, lon, leaf_size=8)
+        self.assertEqual(len(tree), len(lat))
+        block = len(self.lat) + np.arange(3000)
+        indices, distances = tree.query_knn(lat, lon, 5,
+                                            exclude=np.arange(len(lat)))
+        self.assertTrue(np.all(distances[block] == 0.0))
+        self.assertListEqual(indices[block[0]].tolist(),
+                             block[1:6].tolist())
+        self.assertListEqual(indices[block[3]].tolist(),
+                             block[[0, 1, 2, 4, 5]].tolist())
+        rows = [0, 15, 700, 1400]
+        expected = geo.earth_distances(
+            lat[rows, np.newaxis], lon[rows, np.newaxis],
+            lat[np.newaxis, :], lon[np.newaxis, :])
+        expected[np.arange(len(rows)), rows] = np.inf
+        np.testing.assert_allclose(distances[rows],
+                                   np.sort(expected, axis=1)[:, :5],
+                                   atol=1e-6)
+        neighbors = tree.query_radius([45.5], [6.5], 0.0)
+        self.assertListEqual(neighbors.indices.tolist(), block.tolist())
+
+    def testTooFewPoints(self):
+        tree = spatial_index.SphereKDTree([45.0, 45.1], [6.0, 6.0])
+        indices, distances = tree.query_knn([45.0], [6.0], 3)
+        self.assertListEqual(indices.tolist(), [[0, 1, -1]])
+        self.assertEqual(distances[0, 2], np.inf)
+        empty = spatial_index.SphereKDTree([], [])
+        self.assertListEqual(empty.query_knn([45.0], [6.0], 2)[0].tolist(),
+                             [[-1, -1]])
+        self.assertListEqual(
+            empty.query_radius([45.0], [6.0], 1.0).offsets.tolist(), [0, 0])
+
+
+class TestThermalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.thermals = []
+        for filename in ['testfiles/napret.igc', 'testfiles/south.igc']:
+            self.thermals += igc_lib.Flight.create_from_file(
+                filename).thermals
+        self.index = spatial_index.ThermalIndex(self.thermals)
+
+    def distance(self, thermal, other):
+        lat, lon = spatial_index.thermal_positions([thermal, other])
+        return geo.earth_distance(lat[0], lon[0], lat[1], lon[1])
+
+    def testFindKNeighbors(self):
+        neighbors = self.index.find_k_neighbors(3)
+        self.assertEqual(len(neighbors), len(self.thermals))
+        for thermal, thermal_neighbors in zip(self.thermals, neighbors):
+            self.assertEqual(len(thermal_neighbors), 3)
+            expected = sorted(self.distance(thermal, other)
+                              for other in self.thermals
+                              if other is not thermal)[:3]
+            np.testing.assert_allclose(
+                [distance for _, distance in thermal_neighbors], expected,
+                atol=1e-6)
+            for other, distance in thermal_neighbors:
+                self.assertIsNot(other, thermal)
+                self.assertAlmostEqual(self.distance(thermal, other),
+                                       distance, places=6)
+
+    def testFindNeighborsWithin(self):
+        neighbors = self.index.find_neighbors_within(5.0)
+        for thermal, thermal_neighbors in zip(self.thermals, neighbors):
+            self.assertEqual(
+                len(thermal_neighbors),
+                sum(1 for other in self.thermals if other is not thermal and
+                    self.distance(thermal, other) <= 5.0))
@@ -0,0 +1,138 @@
+import math
+import unittest
+
+import numpy as np
+
+import igc_lib
+import lib.geo as geo
+import lib.thermal_analysis as thermal_analysis
+
+
+def circling_fixes(num_fixes=200, radius=40.0, period=25.0,
+                   wind=(3.0, -1.0), climb=2.0, lat0=46.0, lon0=7.0,
+                   upper_wind=None, band_top=None):
+    """Fixes of a glider circling left in a drifting thermal, every second.
+
+    The wind changes to upper_wind above the altitude band_top, if set.
+    """
+    time = np.arange(num_fixes, dtype=np.float64)
+    alt = 1000.0 + climb * time
+    wind_east = np.full(num_fixes, wind[0])
+    wind_north = np.full(num_fixes, wind[1])
+    if upper_wind is not None:
+        above = alt >= band_top
+        wind_east[above], wind_north[above] = upper_wind
+    angle = 2.0 * math.pi * time / period
+    east = radius * np.cos(angle) + np.cumsum(wind_east) - wind_east[0]
+    north = radius * np.sin(angle) + np.cumsum(wind_north) - wind_north[0]
+    lat, lon = geo.from_local_offsets(lat0, lon0, east / 1000.0,
+                                      north / 1000.0)
+    bearing = np.empty(num_fixes)
+    bearing[:-1] = geo.consecutive_bearings(lat, lon)
+    bearing[-1] = bearing[-2]
+    return 1.5e9 + time, lat, lon, alt, bearing
+
+
+class TestAnalyzeFixes(unittest.TestCase):
+
+    def setUp(self):
+        self.fixes = circling_fixes()
+        self.analysis = thermal_analysis.analyze_fixes(
+            *self.fixes, enter=[0], exit=[199])
+
+    def testGeometry(self):
+        geometry = self.analysis.geometry
+        self.assertEqual(geometry.num_turns[0], 7)
+        self.assertAlmostEqual(geometry.radius[0], 40.0, delta=0.5)
+        self.assertAlmostEqual(geometry.period[0], 25.0, delta=0.5)
+        self.assertAlmostEqual(geometry.drift_east[0], 3.0, delta=0.05)
+        self.assertAlmostEqual(geometry.drift_north[0], -1.0, delta=0.05)
+        # The centre of the circles at the middle of the thermal.
+        self.assertEqual(geometry.core_timestamp[0], 1.5e9 + 99.5)
+        east, north = geo.local_offsets(46.0, 7.0, geometry.core_lat[0],
+                                        geometry.core_lon[0])
+        self.assertLess(math.hypot(east * 1000.0 - 3.0 * 99.5,
+                                   north * 1000.0 + 1.0 * 99.5), 2.0)
+
+    def testTurns(self):
+        turns = self.analysis.turns
+        self.assertTrue(np.all(turns.thermal == 0))
+        self.assertTrue(np.all(turns.direction == -1))
+        np.testing.assert_array_equal(turns.enter_index[1:],
+                                      turns.exit_index[:-1])
+        np.testing.assert_allclose(turns.period, 25.0, atol=1.0)
+        np.testing.assert_allclose(turns.radius, 40.0, atol=1.0)
+        # The centres drift with the wind.
+        east, north = geo.local_offsets(46.0, 7.0, turns.lat, turns.lon)
+        timestamp = turns.timestamp - 1.5e9
+        np.testing.assert_allclose(east * 1000.0, 3.0 * timestamp, atol=3.0)
+        np.testing.assert_allclose(north * 1000.0, -1.0 * timestamp,
+                                   atol=3.0)
+        np.testing.assert_allclose(turns.alt, 1000.0 + 2.0 * timestamp)
+
+    def testClimbProfile(self):
+        profile = self.analysis.profile
+        np.testing.assert_array_equal(profile.band_bottom,
+                                      np.arange(1000.0, 1400.0, 100.0))
+        np.testing.assert_allclose(profile.climb_rate, 2.0)
+        self.assertAlmostEqual(np.sum(profile.time), 199.0)
+        self.assertAlmostEqual(np.sum(profile.alt_change), 398.0)
+
+    def testStraightFlightHasNoTurn(self):
+        timestamp, lat, lon, alt, bearing = circling_fixes(radius=0.0)
+        analysis = thermal_analysis.analyze_fixes(
+            timestamp, lat, lon, alt, bearing, enter=[0], exit=[199])
+        self.assertEqual(analysis.geometry.num_turns[0], 0)
+        self.assertTrue(np.isnan(analysis.geometry.core_lat[0]))
+        self.assertEqual(len(analysis.turns.thermal), 0)
+
+    def testNoThermals(self):
+        analysis = thermal_analysis.analyze_fixes(*self.fixes, enter=[],
+                                                  exit=[])
+        for records in analysis:
+            for column in records:
+                self.assertEqual(len(column), 0)
+
+
+class TestAnalyzeFlights(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = [
+            igc_lib.Flight.create_from_file('testfiles/napret.igc'),
+            igc_lib.Flight.create_from_file('testfiles/no_date.igc'),
+            igc_lib.Flight.create_from_file('testfiles/south.igc')]
+
+    def testThermalsOfFlights(self):
+        owner, analysis = thermal_analysis.analyze_flights(self.flights)
+        self.assertListEqual(
+            np.bincount(owner, minlength=3).tolist(),
+            [len(self.flights[0].thermals), 0, len(self.flights[2].thermals)])
+        for thermal, flight_index in enumerate(owner.tolist()):
+            # The profile covers the whole thermal.
+            segment = thermal - np.flatnonzero(owner == flight_index)[0]
+            segments = self.flights[flight_index].thermal_segments
+            in_thermal = analysis.profile.thermal == thermal
+            self.assertAlmostEqual(
+                np.sum(analysis.profile.time[in_thermal]),
+                segments.time_change[segment])
+            self.assertAlmostEqual(
+                np.sum(analysis.profile.alt_change[in_thermal]),
+                segments.alt_change[segment])
+            # Turns are within their thermal.
+            turns = analysis.turns.thermal == thermal
+            self.assertTrue(np.all(
+                analysis.turns.enter_index[turns] >=
+                segments.enter_index[segment]))
+            self.assertTrue(np.all(
+                analysis.turns.exit_index[turns] <=
+                segments.exit_index[segment]))
+        self.assertTrue(np.all(analysis.geometry.num_turns > 0))
+
+    def testChunksGiveSameResults(self):
+        _, expected = thermal_analysis.analyze_flights(self.flights)
+        _, analysis = thermal_analysis.analyze_flights(self.flights,
+                                                       chunk_fixes=100)
+        for records, expected_records in zip(analysis, expected):
+            for column, expected_column in zip(records, expected_records):
+                np.testing.assert_allclose(column, expected_column,
+                                           rtol=1e-9)
@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lib.hotspots as hotspots
+import lib.thermal_grid as thermal_grid
+
+
+def _random_table(random, n, first_day=0, num_days=10):
+    return hotspots.ThermalTable(
+        lat=random.uniform(44.0, 47.0, n),
+        lon=random.uniform(5.0, 9.0, n),
+        vertical_velocity=random.gamma(3.0, 0.6, n),
+        alt_change=random.gamma(3.0, 300.0, n),
+        timestamp=random.uniform(first_day, first_day + num_days, n) *
+        24.0 * 3600.0)
+
+
+def _select(table, selected):
+    return hotspots.ThermalTable(*[column[selected] for column in table])
+
+
+class TestCellKeys(unittest.TestCase):
+
+    def testParentKeys(self):
+        random = np.random.RandomState(0)
+        lat = random.uniform(-90.0, 90.0, 1000)
+        lon = random.uniform(-180.0, 180.0, 1000)
+        for level in [1, 5, 12]:
+            np.testing.assert_array_equal(
+                thermal_grid.cell_keys(lat, lon, level) >> 2,
+                thermal_grid.cell_keys(lat, lon, level - 1))
+        self.assertTrue(np.all(thermal_grid.cell_keys(lat, lon, 0) == 0))
+
+    def testBoundsHoldPoints(self):
+        random = np.random.RandomState(1)
+        lat = random.uniform(-90.0, 90.0, 1000)
+        lon = random.uniform(-180.0, 180.0, 1000)
+        lat_min, lat_max, lon_min, lon_max = thermal_grid.cell_bounds(
+            thermal_grid.cell_keys(lat, lon, 9), 9)
+        self.assertTrue(np.all((lat_min <= lat) & (lat < lat_max)))
+        self.assertTrue(np.all((lon_min <= lon) & (lon < lon_max)))
+        np.testing.assert_allclose(lon_max - lon_min, 360.0 / 512)
+
+    def testInvalidLevel(self):
+        with self.assertRaises(ValueError):
+            thermal_grid.cell_keys([45.0], [6.0], thermal_grid.MAX_LEVEL + 1)
+
+
+class TestThermalGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.table = _random_table(np.random.RandomState(2), 5000)
+        self.grid = thermal_grid.ThermalGrid(10)
+        self.grid.add(self.table)
+
+    def assertSameGrid(self, grid, other):
+        self.assertEqual(grid.level, other.level)
+        np.testing.assert_array_equal(grid.keys, other.keys)
+        np.testing.assert_array_equal(grid.counts, other.counts)
+        np.testing.assert_array_equal(grid.days, other.days)
+        for field in grid.sums:
+            np.testing.assert_allclose(grid.sums[field], other.sums[field])
+            np.testing.assert_array_equal(grid.histograms[field],
+                                          other.histograms[field])
+
+    def testCounts(self):
+        self.assertEqual(self.grid.counts.sum(), 5000)
+        self.assertTrue(np.all(np.diff(self.grid.keys) > 0))
+        keys = thermal_grid.cell_keys(self.table.lat, self.table.lon, 10)
+        cell = self.grid.keys[3]
+        self.assertEqual(self.grid.counts[3], np.sum(keys == cell))
+        np.testing.assert_allclose(
+            self.grid.mean('alt_change')[3],
+            self.table.alt_change[keys == cell].mean())
+        np.testing.assert_array_equal(self.grid.days, np.arange(10))
+
+    def testIncrementalDays(self):
+        grid = thermal_grid.ThermalGrid(10)
+        days = np.floor(self.table.timestamp / (24.0 * 3600.0))
+        for day in range(10):
+            grid.add(_select(self.table, days == day))
+        self.assertSameGrid(grid, self.grid)
+
+    def testMerge(self):
+        first = thermal_grid.ThermalGrid(10)
+        first.add(_select(self.table, slice(0, 2000)))
+        second = thermal_grid.ThermalGrid(10)
+        second.add(_select(self.table, slice(2000, None)))
+        first.merge(second)
+        self.assertSameGrid(first, self.grid)
+        with self.assertRaises(ValueError):
+            first.merge(thermal_grid.ThermalGrid(9))
+
+    def testCoarsenMatchesDirectAggregation(self):
+        pyramid = self.grid.pyramid(min_level=4)
+        self.assertListEqual(sorted(pyramid), list(range(4, 11)))
+        for level in [4, 7]:
+            grid = thermal_grid.ThermalGrid(level)
+            grid.add(self.table)
+            self.assertSameGrid(pyramid[level], grid)
+        with self.assertRaises(ValueError):
+            self.grid.coarsen(11)
+
+    def testQuantiles(self):
+        grid = self.grid.coarsen(3)
+        keys = thermal_grid.cell_keys(self.table.lat, self.table.lon, 3)
+        q = np.array([0.1, 0.5, 0.9])
+        for field, width in [('vertical_velocity', 0.05),
+                             ('alt_change', 20.0)]:
+            quantiles = grid.quantiles(field, q)
+            self.assertEqual(quantiles.shape, (len(grid), 3))
+            for cell, key in enumerate(grid.keys):
+                values = getattr(self.table, field)[keys == key]
+                np.testing.assert_allclose(
+                    quantiles[cell], np.quantile(values, q), atol=width)
+        self.assertEqual(grid.quantiles('alt_change', 0.5).shape,
+                         (len(grid),))
+        with self.assertRaises(KeyError):
+            grid.quantiles('timestamp', 0.5)
+
+    def testQuantilesOfSingleValue(self):
+        table = hotspots.ThermalTable(
+            lat=np.array([45.0]), lon=np.array([6.0]),
+            vertical_velocity=np.array([1.52]), alt_change=np.array([500.0]),
+            timestamp=np.array([0.0]))
+        grid = thermal_grid.ThermalGrid(12)
+        grid.add(table)
+        quantiles = grid.quantiles('vertical_velocity', [0.0, 0.5, 1.0])
+        np.testing.assert_allclose(quantiles, 1.525, atol=0.025 + 1e-9)
+
+    def testSaveLoad(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'grid.npz')
+            self.grid.save(filename)
+            loaded = thermal_grid.ThermalGrid.load(filename)
+            self.assertEqual(loaded.sketches, self.grid.sketches)
+            self.assertSameGrid(loaded, self.grid)
+            loaded.add(_random_table(np.random.RandomState(3), 10, 20, 1))
+            self.assertEqual(loaded.counts.sum(), 5010)
+            self.assertEqual(loaded.days[-1], 20)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,9 @@
+import itertools
+import math
 import unittest
 
+import numpy as np
+
 import lib.viterbi as viterbi
 
 
@@ -50,3 +54,235 @@ class TestSimpleViterbiDecoder(unittest.TestCase):
         data = [1, 0, 1, 1, 0, 0, 1, 1, 1]
         expected_result = [1, 1, 1, 1, 1, 1, 1, 1, 1]
         self.assertDecode(data, expected_result)
+
+
+class TestViterbiDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.init_probs = [0.6, 0.3, 0.1]
+        self.transition_probs = [
+            [0.8, 0.15, 0.05],
+            [0.1, 0.8, 0.1],
+            [0.0, 0.3, 0.7],
+        ]
+        self.emission_probs = [
+            [0.6, 0.3, 0.1, 0.0],
+            [0.2, 0.5, 0.2, 0.1],
+            [0.1, 0.1, 0.3, 0.5],
+        ]
+        self.decoder = viterbi.ViterbiDecoder(
+            init_probs=self.init_probs,
+            transition_probs=self.transition_probs,
+            emission_probs=self.emission_probs)
+
+    def pathLogProb(self, emissions, states):
+        probs = self.init_probs[states[0]]
+        probs *= self.emission_probs[states[0]][emissions[0]]
+        for previous, state, emission in zip(states, states[1:],
+                                             emissions[1:]):
+            probs *= self.transition_probs[previous][state]
+            probs *= self.emission_probs[state][emission]
+        return math.log(probs) if probs > 0.0 else -float('inf')
+
+    def testMatchesBruteForce(self):
+        random = np.random.RandomState(0)
+        for n in range(1, 7):
+            for _ in range(10):
+                emissions = random.randint(0, 4, n).tolist()
+                best = max(
+                    self.pathLogProb(emissions, states)
+                    for states in itertools.product(range(3), repeat=n))
+                states = self.decoder.decode(emissions)
+                self.assertEqual(states.dtype, np.int8)
+                self.assertEqual(len(states), n)
+                self.assertAlmostEqual(
+                    self.pathLogProb(emissions, states.tolist()), best)
+
+    def testNoStateLeakage(self):
+        emissions = np.array([0, 3, 3, 1, 2, 0, 0, 3])
+        first = self.decoder.decode(emissions)
+        self.decoder.decode([3] * 50)
+        np.testing.assert_array_equal(self.decoder.decode(emissions), first)
+        simple = viterbi.SimpleViterbiDecoder(
+            [0.5, 0.5], [[0.9, 0.1], [0.1, 0.9]], [[0.7, 0.3], [0.3, 0.7]])
+        self.assertListEqual(simple.decode([1, 1, 1]), [1, 1, 1])
+        self.assertListEqual(simple.decode([0, 0, 0]), [0, 0, 0])
+
+    def testImpossibleTransitions(self):
+        # State 2 can not be left for state 0 and state 0 can not emit 3.
+        emissions = [2, 3, 3, 0, 0, 0, 0, 0, 0]
+        states = self.decoder.decode(emissions).tolist()
+        self.assertListEqual(states[:3], [2, 2, 2])
+        self.assertNotIn((2, 0), list(zip(states, states[1:])))
+        self.assertGreater(self.pathLogProb(emissions, states),
+                           -float('inf'))
+
+    def testTiesPickHigherState(self):
+        decoder = viterbi.ViterbiDecoder(
+            [0.5, 0.5], [[0.5, 0.5], [0.5, 0.5]], [[0.5, 0.5], [0.5, 0.5]])
+        self.assertListEqual(decoder.decode([0] * 5).tolist(), [1] * 5)
+
+    def testCloseScoresAreNotTies(self):
+        # A long path with a slightly less likely state 1.
+        decoder = viterbi.ViterbiDecoder(
+            [0.5, 0.5], [[0.5, 0.5], [0.5, 0.5]],
+            [[0.5, 0.5], [0.5 - 1e-6, 0.5 + 1e-6]])
+        emissions = np.zeros(100000, dtype=np.int8)
+        self.assertTrue(np.all(decoder.decode(emissions) == 0))
+        for states in decoder.decode_batch([emissions], min_batch_size=1):
+            self.assertTrue(np.all(states == 0))
+
+    def testLongSequence(self):
+        random = np.random.RandomState(1)
+        emissions = np.repeat(random.randint(0, 4, 500), 40)
+        states = self.decoder.decode(emissions)
+        # A reference forward pass, one fix at a time.
+        init_log = np.log(self.init_probs)
+        with np.errstate(divide='ignore'):
+            transition_log = np.log(self.transition_probs)
+            emission_log = np.log(self.emission_probs)
+            state_log = init_log + emission_log[:, emissions[0]]
+        for emission in emissions[1:]:
+            state_log = (np.max(state_log[:, np.newaxis] + transition_log,
+                                axis=0) + emission_log[:, emission])
+        with np.errstate(divide='ignore'):
+            path_log = (init_log[states[0]] +
+                        emission_log[states[0], emissions[0]] +
+                        np.sum(transition_log[states[:-1], states[1:]]) +
+                        np.sum(emission_log[states[1:], emissions[1:]]))
+        self.assertAlmostEqual(path_log / np.max(state_log), 1.0, places=12)
+
+    def testDecodeBatchMatchesDecode(self):
+        random = np.random.RandomState(2)
+        sequences = [random.randint(0, 4, length)
+                     for length in [0, 1, 7, 300, 2, 0, 150, 299, 1, 40]]
+        sequences.append([0, 3, 3, 1])
+        for min_batch_size in [1, 3, 64]:
+            decoded = self.decoder.decode_batch(
+                sequences, batch_size=3, min_batch_size=min_batch_size)
+            self.assertEqual(len(decoded), len(sequences))
+            for emissions, states in zip(sequences, decoded):
+                self.assertEqual(states.dtype, np.int8)
+                np.testing.assert_array_equal(
+                    states, self.decoder.decode(emissions))
+        self.assertListEqual(self.decoder.decode_batch([]), [])
+
+    def testDecodeBatchTies(self):
+        decoder = viterbi.ViterbiDecoder(
+            [0.5, 0.5], [[0.9, 0.1], [0.1, 0.9]], [[0.7, 0.3], [0.3, 0.7]])
+        random = np.random.RandomState(3)
+        sequences = [random.randint(0, 2, random.randint(1, 200))
+                     for _ in range(50)]
+        for emissions, states in zip(
+                sequences, decoder.decode_batch(sequences, min_batch_size=1)):
+            np.testing.assert_array_equal(states, decoder.decode(emissions))
+
+
+class TestOnlineViterbiDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = viterbi.ViterbiDecoder(
+            [0.6, 0.3, 0.1],
+            [[0.8, 0.15, 0.05], [0.1, 0.8, 0.1], [0.0, 0.3, 0.7]],
+            [[0.6, 0.3, 0.1, 0.0], [0.2, 0.5, 0.2, 0.1],
+             [0.1, 0.1, 0.3, 0.5]])
+
+    def decodeOnline(self, online, sequences):
+        """Pushes interleaved sequences, returns the committed states and
+        the number of emissions received when every state was committed."""
+        streams = [online.add_stream() for _ in sequences]
+        states = [{} for _ in sequences]
+        received = [{} for _ in sequences]
+
+        def collect(committed, step):
+            for stream, position, state in zip(*committed):
+                index = streams.index(stream)
+                self.assertNotIn(position, states[index])
+                states[index][position] = state
+                received[index][position] = step
+
+        for step in range(max(len(sequence) for sequence in sequences)):
+            pushed = [index for index, sequence in enumerate(sequences)
+                      if step < len(sequence)]
+            collect(online.push([streams[index] for index in pushed],
+                                [sequences[index][step]
+                                 for index in pushed]), step + 1)
+            ended = [index for index in pushed
+                     if step == len(sequences[index]) - 1]
+            if ended:
+                collect(online.flush([streams[index] for index in ended]),
+                        None)
+        for index, sequence in enumerate(sequences):
+            self.assertListEqual(sorted(states[index]),
+                                 list(range(len(sequence))))
+        return ([np.array([values[position] for position in sorted(values)])
+                 for values in states], received)
+
+    def testMatchesDecodeWithLongLag(self):
+        random = np.random.RandomState(4)
+        sequences = [random.randint(0, 4, length)
+                     for length in [1, 7, 300, 2, 150, 299, 40]]
+        online = viterbi.OnlineViterbiDecoder(self.decoder, lag=300,
+                                              capacity=2)
+        decoded, _ = self.decodeOnline(online, sequences)
+        for emissions, states in zip(sequences, decoded):
+            self.assertEqual(states.dtype, np.int8)
+            np.testing.assert_array_equal(states,
+                                          self.decoder.decode(emissions))
+
+    def testCommitsWithinLag(self):
+        random = np.random.RandomState(5)
+        sequences = [random.randint(0, 4, 200) for _ in range(3)]
+        lag = 10
+        online = viterbi.OnlineViterbiDecoder(self.decoder, lag=lag)
+        decoded, received = self.decodeOnline(online, sequences)
+        for states, steps in zip(decoded, received):
+            for position, step in steps.items():
+                if position < len(states) - lag:
+                    self.assertIsNotNone(step)
+                    self.assertLessEqual(step, position + lag + 1)
+        # The lag is long enough for the most likely paths to merge.
+        for emissions, states in zip(sequences, decoded):
+            self.assertGreater(np.mean(states ==
+                                       self.decoder.decode(emissions)), 0.95)
+
+    def testMergedPathsCommitEarly(self):
+        # Emission 2 reveals state 1, so the survivor paths merge there.
+        decoder = viterbi.ViterbiDecoder(
+            [0.5, 0.5], [[0.9, 0.1], [0.1, 0.9]],
+            [[0.7, 0.3, 0.0], [0.3, 0.5, 0.2]])
+        online = viterbi.OnlineViterbiDecoder(decoder, lag=100)
+        stream = online.add_stream()
+        emissions = [1, 0, 1, 1, 0, 2]
+        committed = [online.push([stream], [emission])
+                     for emission in emissions]
+        positions = np.concatenate([states.positions for states in committed])
+        np.testing.assert_array_equal(positions, np.arange(6))
+        np.testing.assert_array_equal(
+            np.concatenate([states.states for states in committed]),
+            decoder.decode(emissions))
+        self.assertListEqual(online.current_states([stream]).tolist(), [1])
+
+    def testConstantMemory(self):
+        online = viterbi.OnlineViterbiDecoder(self.decoder, lag=20,
+                                              capacity=4)
+        streams = [online.add_stream() for _ in range(4)]
+        random = np.random.RandomState(6)
+        arrays = [online._state_log, online._ancestors, online._counts]
+        sizes = [values.nbytes for values in arrays]
+        for _ in range(500):
+            online.push(streams, random.randint(0, 4, len(streams)))
+        self.assertListEqual([values.nbytes for values in arrays], sizes)
+
+    def testStreamReuse(self):
+        online = viterbi.OnlineViterbiDecoder(self.decoder, lag=5,
+                                              capacity=1)
+        first, second = online.add_stream(), online.add_stream()
+        self.assertNotEqual(first, second)
+        online.push([first, second], [0, 3])
+        online.remove_stream(first)
+        self.assertEqual(online.add_stream(), first)
+        self.assertListEqual(online.current_states([first, second]).tolist(),
+                             [-1, 2])
+        with self.assertRaises(ValueError):
+            online.push([second, second], [0, 0])
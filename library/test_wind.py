@@ -0,0 +1,214 @@
+import unittest
+
+import numpy as np
+
+import igc_lib
+import lib.geo as geo
+import lib.test_thermal_analysis as test_thermal_analysis
+import lib.thermal_analysis as thermal_analysis
+import lib.wind as wind
+
+_DAY = 24.0 * 3600.0
+
+
+def _circling_fixes(**kwargs):
+    """Circling fixes for ten minutes, the wind changes at 1600 m."""
+    kwargs.setdefault('upper_wind', (6.0, 2.0))
+    return test_thermal_analysis.circling_fixes(
+        num_fixes=600, band_top=1600.0, **kwargs)
+
+
+def _estimates(lat, lon, alt, timestamp, wind_east, wind_north,
+               num_turns):
+    return wind.WindEstimates(
+        segment=np.arange(len(lat)), lat=np.asarray(lat, dtype=float),
+        lon=np.asarray(lon, dtype=float), alt=np.asarray(alt, dtype=float),
+        timestamp=np.asarray(timestamp, dtype=float),
+        wind_east=np.asarray(wind_east, dtype=float),
+        wind_north=np.asarray(wind_north, dtype=float),
+        num_turns=np.asarray(num_turns, dtype=np.int64))
+
+
+class TestSpeedDirection(unittest.TestCase):
+
+    def testDirections(self):
+        speed, direction = wind.speed_direction(
+            [0.0, -5.0, 0.0, 3.0], [-4.0, 0.0, 2.0, 0.0])
+        np.testing.assert_allclose(speed, [4.0, 5.0, 2.0, 3.0])
+        # Blowing to the south, west, north and east.
+        np.testing.assert_allclose(direction, [0.0, 90.0, 180.0, 270.0])
+
+
+class TestCorrectDrift(unittest.TestCase):
+
+    def testMovesWithTheWind(self):
+        lat, lon = wind.correct_drift(
+            [46.0, 46.0], [7.0, 7.0], [1000.0, 1000.0], 1600.0,
+            [5.0, np.nan], [-2.0, np.nan])
+        east, north = geo.local_offsets(46.0, 7.0, lat, lon)
+        np.testing.assert_allclose(east, [3.0, 0.0], atol=1e-9)
+        np.testing.assert_allclose(north, [-1.2, 0.0], atol=1e-9)
+
+
+class TestEstimateWind(unittest.TestCase):
+
+    def setUp(self):
+        analysis = thermal_analysis.analyze_fixes(
+            *_circling_fixes(), enter=[0], exit=[599])
+        self.wind = wind.estimate_wind(analysis)
+
+    def testSegment(self):
+        segments = self.wind.segments
+        self.assertEqual(segments.segment.tolist(), [0])
+        self.assertEqual(segments.num_turns[0], 23)
+        # Between the winds of the two bands, 300 s each.
+        self.assertAlmostEqual(segments.wind_east[0], 4.5, delta=0.3)
+        self.assertAlmostEqual(segments.wind_north[0], 0.5, delta=0.3)
+        self.assertAlmostEqual(segments.alt[0], 1600.0, delta=30.0)
+
+    def testBands(self):
+        bands = self.wind.bands
+        self.assertEqual(bands.segment.tolist(), [0, 0, 0])
+        np.testing.assert_array_equal(np.floor(bands.alt / 500.0),
+                                      [2, 3, 4])
+        # The band from 1500 to 2000 meters has both winds.
+        np.testing.assert_allclose(bands.wind_east[[0, 2]], [3.0, 6.0],
+                                   atol=0.1)
+        np.testing.assert_allclose(bands.wind_north[[0, 2]], [-1.0, 2.0],
+                                   atol=0.1)
+        self.assertTrue(np.all(bands.num_turns >= 3))
+
+    def testMinTurns(self):
+        analysis = thermal_analysis.analyze_fixes(
+            *_circling_fixes(), enter=[0], exit=[599])
+        estimates = wind.estimate_wind(analysis, min_turns=24)
+        self.assertEqual(len(estimates.segments.segment), 0)
+        self.assertEqual(len(estimates.bands.segment), 0)
+
+    def testMaxSpeed(self):
+        analysis = thermal_analysis.analyze_fixes(
+            *_circling_fixes(wind=(40.0, 0.0), upper_wind=(40.0, 0.0)),
+            enter=[0], exit=[599])
+        estimates = wind.estimate_wind(analysis)
+        self.assertEqual(len(estimates.segments.segment), 0)
+
+
+class TestEstimateFlights(unittest.TestCase):
+
+    def setUp(self):
+        self.filenames = ['testfiles/napret.igc', 'testfiles/no_date.igc',
+                          'testfiles/south.igc']
+        self.flights = [igc_lib.Flight.create_from_file(filename)
+                        for filename in self.filenames]
+
+    def testCirclingSegments(self):
+        flight = self.flights[0]
+        enter, exit = wind.circling_segments(flight)
+        self.assertTrue(np.all(flight.fixes.circling[enter]))
+        self.assertFalse(np.any(flight.fixes.circling[enter - 1]))
+        # Every thermal is a circling segment.
+        self.assertTrue(set(flight.thermal_segments.enter_index.tolist()) <=
+                        set(enter.tolist()))
+
+    def testEstimates(self):
+        owner, estimates = wind.estimate_flights(self.flights)
+        self.assertEqual(np.bincount(owner, minlength=3)[1], 0)
+        for table in estimates:
+            self.assertGreater(len(table.segment), 0)
+            self.assertTrue(np.all(table.num_turns >= 3))
+            speed, _ = wind.speed_direction(table.wind_east,
+                                            table.wind_north)
+            self.assertTrue(np.all(speed <= 30.0))
+        self.assertTrue(np.all(
+            np.diff(estimates.segments.segment) > 0))
+
+    def testFilesGiveSameEstimates(self):
+        owner, expected = wind.estimate_flights(self.flights)
+        sources, estimates = wind.estimate_files(self.filenames, workers=1)
+        np.testing.assert_array_equal(sources, owner)
+        for table, expected_table in zip(estimates, expected):
+            for column, expected_column in zip(table, expected_table):
+                np.testing.assert_allclose(column, expected_column)
+
+
+class TestWindField(unittest.TestCase):
+
+    def setUp(self):
+        day = 17000
+        self.start = day * _DAY
+        self.estimates = _estimates(
+            lat=[46.1, 46.1, 46.1, 46.1, 44.0],
+            lon=[7.1, 7.1, 7.1, 7.1, 5.0],
+            alt=[1200.0, 1300.0, 2200.0, 1200.0, 1100.0],
+            timestamp=self.start + np.array(
+                [12.2, 12.5, 12.5, 15.5, 12.5]) * 3600.0,
+            wind_east=[2.0, 4.0, 8.0, -1.0, 0.0],
+            wind_north=[1.0, 1.0, 0.0, 0.0, -2.0],
+            num_turns=[3, 1, 4, 2, 4])
+        self.field = wind.WindField(day)
+        self.field.add(self.estimates)
+
+    def testFallbacks(self):
+        east, north = self.field.wind(
+            [46.1, 46.1, 46.1, 40.0, 40.0],
+            [7.1, 7.1, 7.1, 0.0, 0.0],
+            [1250.0, 3000.0, 1250.0, 1250.0, 5000.0],
+            self.start + np.array([12.0, 12.9, 15.9, 12.0, 12.0]) * 3600.0)
+        # Weighted mean of the cell, the cell without altitude band, the
+        # altitude band, the day.
+        np.testing.assert_allclose(east, [
+            2.5, (6.0 + 4.0 + 32.0) / 8.0, -1.0,
+            (6.0 + 4.0 - 2.0 + 0.0) / 10.0,
+            (6.0 + 4.0 + 32.0 - 2.0) / 14.0])
+        np.testing.assert_allclose(north, [
+            1.0, 4.0 / 8.0, 0.0, -4.0 / 10.0, -4.0 / 14.0])
+
+    def testEmptyField(self):
+        east, north = wind.WindField(17000).wind([46.0], [7.0], [1000.0],
+                                                 [self.start])
+        self.assertTrue(np.isnan(east[0]))
+        self.assertTrue(np.isnan(north[0]))
+
+    def testMerge(self):
+        first = wind.WindField(17000)
+        second = wind.WindField(17000)
+        first.add(wind.WindEstimates(*[column[:2]
+                                       for column in self.estimates]))
+        second.add(wind.WindEstimates(*[column[2:]
+                                        for column in self.estimates]))
+        first.merge(second)
+        self.assertEqual(len(first), len(self.field))
+        points = ([46.1, 44.0, 40.0], [7.1, 5.0, 0.0],
+                  [1250.0, 1000.0, 2000.0],
+                  self.start + np.array([12.0, 12.0, 20.0]) * 3600.0)
+        for values, expected in zip(first.wind(*points),
+                                    self.field.wind(*points)):
+            np.testing.assert_allclose(values, expected)
+        with self.assertRaises(ValueError):
+            first.merge(wind.WindField(17000, level=10))
+
+    def testOtherDay(self):
+        with self.assertRaises(ValueError):
+            wind.WindField(17001).add(self.estimates)
+
+    def testWindFields(self):
+        estimates = self.estimates._replace(
+            timestamp=self.estimates.timestamp +
+            np.array([0, 0, 0, 0, 1]) * _DAY)
+        fields = wind.wind_fields(estimates)
+        self.assertEqual(sorted(fields), [17000, 17001])
+        east, _ = fields[17001].wind([46.1], [7.1], [1200.0],
+                                     [17001 * _DAY])
+        self.assertEqual(east[0], 0.0)
+
+    def testCorrectDrift(self):
+        lat, lon = self.field.correct_drift(
+            [46.1], [7.1], [1250.0], [self.start + 12.0 * 3600.0],
+            self.start + 12.0 * 3600.0 + 1000.0)
+        east, north = geo.local_offsets(46.1, 7.1, lat, lon)
+        np.testing.assert_allclose(east, [2.5], atol=1e-9)
+        np.testing.assert_allclose(north, [1.0], atol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
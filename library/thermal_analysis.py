@@ -0,0 +1,361 @@
+import collections
+
+import numpy as np
+
+import igc_lib
+import lib.geo as geo
+
+# Per-thermal geometry, one row per thermal.
+#   core_lat, core_lon: float64 arrays, the centre of the thermal core at
+#   core_timestamp, degrees, from the drift-corrected circle fits of its
+#   turns; NaN for thermals without a fitted turn
+#   core_timestamp: float64 array, the middle of the thermal (since
+#   epoch), seconds
+#   drift_east, drift_north: float64 arrays, the drift of the circles,
+#   m/s; NaN for thermals with less than two fitted turns
+#   radius: float64 array, the mean radius of the turns, meters
+#   period: float64 array, the mean duration of the turns, seconds
+#   num_turns: int64 array, the number of fitted turns
+ThermalGeometry = collections.namedtuple(
+    'ThermalGeometry',
+    ['core_lat', 'core_lon', 'core_timestamp', 'drift_east', 'drift_north',
+     'radius', 'period', 'num_turns'])
+
+# The fitted turns (full circles) of the thermals, one row per turn,
+# sorted by thermal and time.
+#   thermal: int64 array, the thermal of the turn
+#   enter_index, exit_index: int64 arrays, the first fix of the turn and
+#   the first fix of the next turn
+#   timestamp: float64 array, the mean time of the fixes of the turn
+#   period: float64 array, the duration of the turn, seconds
+#   lat, lon: float64 arrays, the centre of the turn at timestamp, degrees
+#   alt: float64 array, the mean altitude of the fixes of the turn, meters
+#   radius: float64 array, meters
+#   direction: int8 array, 1 for right (clockwise) turns, -1 for left ones
+TurnTable = collections.namedtuple(
+    'TurnTable',
+    ['thermal', 'enter_index', 'exit_index', 'timestamp', 'period', 'lat',
+     'lon', 'alt', 'radius', 'direction'])
+
+# The climb of the thermals per altitude band, one row per thermal and
+# band crossed, sorted by thermal and band.
+#   thermal: int64 array, the thermal
+#   band_bottom: float64 array, the lower altitude of the band, meters
+#   time: float64 array, the time spent in the band, seconds
+#   alt_change: float64 array, the altitude gained in the band, meters
+#   climb_rate: float64 array, alt_change / time, m/s
+ClimbProfile = collections.namedtuple(
+    'ClimbProfile',
+    ['thermal', 'band_bottom', 'time', 'alt_change', 'climb_rate'])
+
+ThermalAnalysis = collections.namedtuple(
+    'ThermalAnalysis', ['geometry', 'turns', 'profile'])
+
+
+def _group_sums(groups, num_groups, *values):
+    return [np.bincount(groups, weights=value,
+                        minlength=num_groups).astype(np.float64)
+            for value in values]
+
+
+def _fit_circles(groups, num_groups, x, y):
+    """Fits circles to groups of points, by linear least squares.
+
+    Minimizes the algebraic distances (x - a)**2 + (y - b)**2 - r**2
+    (Kasa fit), from the sums of the moments of every group, so all the
+    groups are fit at once.
+
+    Args:
+        groups: an int array, the group of every point, 0 .. num_groups - 1
+        num_groups: an int
+        x, y: float arrays, the points
+
+    Returns:
+        An (a, b, r) tuple of float64 arrays, the centres and the radii of
+        the circles, NaN for groups of aligned or less than 3 points.
+    """
+    count, sum_x, sum_y = _group_sums(groups, num_groups, None, x, y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = sum_x / count
+        mean_y = sum_y / count
+    # Centred coordinates decouple the equations of the centre.
+    u = x - mean_x[groups]
+    v = y - mean_y[groups]
+    z = u * u + v * v
+    suu, suv, svv, suz, svz, sz = _group_sums(
+        groups, num_groups, u * u, u * v, v * v, u * z, v * z, z)
+    det = suu * svv - suv * suv
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = (suz * svv - svz * suv) / (2.0 * det)
+        b = (svz * suu - suz * suv) / (2.0 * det)
+        r = np.sqrt(a * a + b * b + sz / count)
+    degenerate = ~(det > 1e-12 * (suu + svv) ** 2) | (count < 3)
+    a[degenerate] = np.nan
+    b[degenerate] = np.nan
+    r[degenerate] = np.nan
+    return a + mean_x, b + mean_y, r
+
+
+def _drift(groups, num_groups, time, x, y):
+    """Fits x and y as linear functions of time in every group.
+
+    Returns:
+        The (x, y) slopes, NaN for groups with less than 2 distinct times.
+    """
+    count, sum_t, sum_x, sum_y = _group_sums(groups, num_groups, None,
+                                             time, x, y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_t = sum_t / count
+        dt = time - mean_t[groups]
+        stt, stx, sty = _group_sums(groups, num_groups, dt * dt, dt * x,
+                                    dt * y)
+        valid = (count >= 2) & (stt > 0.0)
+        return (np.where(valid, stx / stt, np.nan),
+                np.where(valid, sty / stt, np.nan))
+
+
+def _analyze_chunk(timestamp, lat, lon, alt, bearing, enter, exit,
+                   band_width, min_turn_fixes):
+    """Analyzes thermals, see analyze_fixes; thermals are numbered from 0.
+    """
+    num_thermals = len(enter)
+    lengths = exit - enter + 1
+    offsets = np.cumsum(lengths) - lengths
+    # The fixes of the thermals, one after the other.
+    owner = np.repeat(np.arange(num_thermals), lengths)
+    rows = enter[owner] + np.arange(len(owner)) - offsets[owner]
+    time = timestamp[rows]
+    fix_alt = alt[rows]
+    # Coordinates in meters, relative to the entry of the thermal.
+    east, north = geo.local_offsets(lat[enter][owner], lon[enter][owner],
+                                    lat[rows], lon[rows])
+    east *= 1000.0
+    north *= 1000.0
+    # Pairs of consecutive fixes of a thermal.
+    pairs = np.flatnonzero(owner[:-1] == owner[1:])
+
+    # Turns: every 360 degrees of heading change, in any direction.
+    change = np.zeros(len(rows))
+    heading = bearing[rows]
+    change[pairs + 1] = (heading[pairs + 1] - heading[pairs] +
+                         180.0) % 360.0 - 180.0
+    # Accumulated in micro-degrees, so that the sums are exact, whatever
+    # thermals are processed together.
+    cumulative = np.cumsum(np.round(np.fabs(change) * 1e6).astype(np.int64))
+    cumulative -= cumulative[offsets][owner]
+    turn = cumulative // 360000000
+    # Turns of the last fix of a thermal are not complete.
+    num_turns = turn[offsets + lengths - 1]
+    first_turn = np.cumsum(num_turns + 1) - (num_turns + 1)
+    starts, stops, _ = igc_lib._run_lengths(first_turn[owner] + turn)
+    turn_owner = owner[starts]
+    fitted = ((turn[starts] < num_turns[turn_owner]) &
+              (stops - starts >= min_turn_fixes))
+    starts, stops = starts[fitted], stops[fitted]
+    turn_owner = turn_owner[fitted]
+    num_fitted = len(starts)
+    # The fixes of the fitted turns.
+    turn_lengths = stops - starts
+    turn_of_fix = np.repeat(np.arange(num_fitted), turn_lengths)
+    fit_fixes = (starts[turn_of_fix] + np.arange(len(turn_of_fix)) -
+                 np.repeat(np.cumsum(turn_lengths) - turn_lengths,
+                           turn_lengths))
+    fit_time = time[fit_fixes]
+    turn_time, turn_alt = [
+        sums / np.maximum(turn_lengths, 1) for sums in _group_sums(
+            turn_of_fix, num_fitted, fit_time, fix_alt[fit_fixes])]
+
+    # First pass: circles over the ground, whose centres drift with the
+    # air mass.
+    centre_x, centre_y, _ = _fit_circles(
+        turn_of_fix, num_fitted, east[fit_fixes], north[fit_fixes])
+    ok = np.isfinite(centre_x)
+    drift_x, drift_y = _drift(turn_owner[ok], num_thermals, turn_time[ok],
+                              centre_x[ok], centre_y[ok])
+    # Second pass: circles in the air mass, i.e. with the fixes moved back
+    # to their position at the middle of the thermal.
+    core_time = (timestamp[enter] + timestamp[exit]) / 2.0
+    shift_x = np.nan_to_num(drift_x)
+    shift_y = np.nan_to_num(drift_y)
+    fix_owner = owner[fit_fixes]
+    elapsed = fit_time - core_time[fix_owner]
+    centre_x, centre_y, radius = _fit_circles(
+        turn_of_fix, num_fitted,
+        east[fit_fixes] - shift_x[fix_owner] * elapsed,
+        north[fit_fixes] - shift_y[fix_owner] * elapsed)
+
+    ok = np.isfinite(centre_x)
+    count, sum_x, sum_y, sum_radius, sum_period = _group_sums(
+        turn_owner[ok], num_thermals, None, centre_x[ok], centre_y[ok],
+        radius[ok], (time[stops] - time[starts])[ok])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        core_lat, core_lon = geo.from_local_offsets(
+            lat[enter], lon[enter], sum_x / count / 1000.0,
+            sum_y / count / 1000.0)
+        geometry = ThermalGeometry(
+            core_lat=core_lat, core_lon=core_lon, core_timestamp=core_time,
+            drift_east=np.where(count >= 2, drift_x, np.nan),
+            drift_north=np.where(count >= 2, drift_y, np.nan),
+            radius=sum_radius / count, period=sum_period / count,
+            num_turns=count.astype(np.int64))
+
+    # The turns, with their centres moved to the time of the turn.
+    turn_owner, starts, stops = turn_owner[ok], starts[ok], stops[ok]
+    turn_time = turn_time[ok]
+    elapsed = turn_time - core_time[turn_owner]
+    turn_lat, turn_lon = geo.from_local_offsets(
+        lat[enter][turn_owner], lon[enter][turn_owner],
+        (centre_x[ok] + shift_x[turn_owner] * elapsed) / 1000.0,
+        (centre_y[ok] + shift_y[turn_owner] * elapsed) / 1000.0)
+    turned = np.cumsum(change)
+    direction = np.where(turned[stops] - turned[starts] >= 0.0, 1, -1)
+    turns = TurnTable(
+        thermal=turn_owner.astype(np.int64),
+        enter_index=rows[starts].astype(np.int64),
+        exit_index=rows[stops].astype(np.int64),
+        timestamp=turn_time, period=time[stops] - time[starts],
+        lat=turn_lat, lon=turn_lon, alt=turn_alt[ok], radius=radius[ok],
+        direction=direction.astype(np.int8))
+
+    # Climb per altitude band, the band of a pair of fixes is the one of
+    # its mean altitude.
+    band = np.floor((fix_alt[pairs] + fix_alt[pairs + 1]) /
+                    (2.0 * band_width)).astype(np.int64)
+    lowest = band.min() if len(band) else 0
+    span = band.max() - lowest + 1 if len(band) else 1
+    keys, inverse = np.unique(owner[pairs] * span + band - lowest,
+                              return_inverse=True)
+    inverse = inverse.ravel()
+    band_time, band_alt = _group_sums(
+        inverse, len(keys), time[pairs + 1] - time[pairs],
+        fix_alt[pairs + 1] - fix_alt[pairs])
+    profile = ClimbProfile(
+        thermal=keys // span,
+        band_bottom=((keys % span + lowest) * band_width).astype(np.float64),
+        time=band_time, alt_change=band_alt,
+        climb_rate=np.divide(band_alt, band_time,
+                             out=np.zeros_like(band_alt),
+                             where=band_time > 0.0))
+    return ThermalAnalysis(geometry, turns, profile)
+
+
+def _concatenate(records, offsets):
+    """Concatenates namedtuples of arrays, adding offsets to thermals."""
+    columns = []
+    for field, values in zip(records[0]._fields, zip(*records)):
+        if field == 'thermal':
+            values = [value + offset for value, offset in
+                      zip(values, offsets)]
+        columns.append(np.concatenate(values))
+    return type(records[0])(*columns)
+
+
+def analyze_fixes(timestamp, lat, lon, alt, bearing, enter, exit,
+                  band_width=100.0, min_turn_fixes=5, chunk_fixes=1 << 22):
+    """Analyzes the climb and the geometry of thermals, in batch.
+
+    The fixes of every thermal are split into turns, every 360 degrees of
+    heading change. Circles are fit to the fixes of every complete turn:
+    first over the ground, which gives the drift of the circles with the
+    wind, then in the air mass, i.e. on the fixes moved back by the drift
+    to the middle of the thermal. The core of a thermal is the mean centre
+    of its turns in the air mass.
+
+    All the thermals are processed together, vectorized across thermals
+    and fixes, in chunks of about chunk_fixes fixes.
+
+    Args:
+        timestamp, lat, lon, alt, bearing: float arrays, the columns of the
+        fixes, see igc_lib.FixArray
+        enter, exit: int arrays, the indices of the entry and the exit
+        fixes of the thermals, see igc_lib.SegmentTable
+        band_width: a float, the height of the altitude bands, meters
+        min_turn_fixes: an int, the minimum number of fixes of a fitted
+        turn
+        chunk_fixes: an int, the number of fixes processed at once
+
+    Returns:
+        A ThermalAnalysis namedtuple, the thermals are numbered in the
+        order of enter.
+    """
+    timestamp, lat, lon, alt, bearing = [
+        np.asarray(column, dtype=np.float64)
+        for column in (timestamp, lat, lon, alt, bearing)]
+    enter = np.asarray(enter, dtype=np.int64)
+    exit = np.asarray(exit, dtype=np.int64)
+    ends = np.cumsum(exit - enter + 1)
+    results = []
+    offsets = []
+    start = 0
+    while True:
+        stop = int(np.searchsorted(
+            ends, (ends[start - 1] if start else 0) + chunk_fixes,
+            side='right'))
+        stop = min(max(stop, start + 1), len(enter))
+        results.append(_analyze_chunk(
+            timestamp, lat, lon, alt, bearing, enter[start:stop],
+            exit[start:stop], band_width, min_turn_fixes))
+        offsets.append(start)
+        start = stop
+        if start >= len(enter):
+            break
+    return ThermalAnalysis(*[
+        _concatenate(records, offsets) for records in zip(*results)])
+
+
+def _thermal_segments(flight):
+    return (flight.thermal_segments.enter_index,
+            flight.thermal_segments.exit_index)
+
+
+def analyze_flights(flights, segments=_thermal_segments, **kwargs):
+    """Analyzes the thermals of many flights at once, see analyze_fixes.
+
+    Args:
+        flights: a list of igc_lib.Flight; invalid flights are skipped
+        segments: a function, returning the (enter, exit) int arrays of
+        the segments of a flight to be analyzed; by default the entry and
+        exit fixes of its thermal_segments
+        **kwargs: passed to analyze_fixes
+
+    Returns:
+        A (flights, analysis) pair: an int64 array, the index in flights
+        of every thermal, and a ThermalAnalysis namedtuple. The thermals
+        of a flight are in the order of its segments, the fix indices of
+        the turns are the ones of the fixes of their flight.
+    """
+    flights = [(index, flight) for index, flight in enumerate(flights)
+               if flight.valid]
+    columns = ([], [], [], [], [])
+    enter, exit, owner, fix_offsets = [], [], [], []
+    offset = 0
+    for index, flight in flights:
+        fixes = flight.fixes
+        for values, column in zip(columns, (
+                fixes.timestamp, fixes.lat, fixes.lon, fixes.alt,
+                fixes.bearing)):
+            values.append(column)
+        flight_enter, flight_exit = segments(flight)
+        enter.append(np.asarray(flight_enter, dtype=np.int64) + offset)
+        exit.append(np.asarray(flight_exit, dtype=np.int64) + offset)
+        owner.append(np.full(len(flight_enter), index, dtype=np.int64))
+        fix_offsets.append(np.full(len(flight_enter), offset,
+                                   dtype=np.int64))
+        offset += len(fixes)
+
+    def concatenate(values, dtype):
+        return (np.concatenate(values) if values
+                else np.zeros(0, dtype=dtype))
+
+    analysis = analyze_fixes(
+        *[concatenate(values, np.float64) for values in columns],
+        enter=concatenate(enter, np.int64), exit=concatenate(exit, np.int64),
+        **kwargs)
+    fix_offsets = concatenate(fix_offsets, np.int64)
+    turns = analysis.turns._replace(
+        enter_index=(analysis.turns.enter_index -
+                     fix_offsets[analysis.turns.thermal]),
+        exit_index=(analysis.turns.exit_index -
+                    fix_offsets[analysis.turns.thermal]))
+    return (concatenate(owner, np.int64),
+            analysis._replace(turns=turns))
@@ -0,0 +1,296 @@
+import collections
+
+import numpy as np
+
+import lib.hotspots as hotspots
+
+# The finest level of the grid: cells of 360 / 2**26 degrees of longitude,
+# i.e. less than a meter. Keys of all levels fit in an int64.
+MAX_LEVEL = 26
+
+# A fixed-bin histogram of one field of a hotspots.ThermalTable. Fixed bins
+# make the histograms of two cells, or of two days, exactly mergeable, and
+# quantiles are estimated within a bin width. Values below start or above
+# stop are counted in the first or the last bin.
+SketchSpec = collections.namedtuple(
+    'SketchSpec', ['field', 'start', 'stop', 'num_bins'])
+
+DEFAULT_SKETCHES = (
+    SketchSpec('vertical_velocity', -2.0, 8.0, 200),
+    SketchSpec('alt_change', 0.0, 4000.0, 200),
+)
+
+_DAY = 24.0 * 60.0 * 60.0
+
+
+def cell_keys(lat, lon, level):
+    """Computes the keys of the grid cells holding points.
+
+    The grid of a level splits longitudes and latitudes in 2**level
+    intervals each. Keys interleave the bits of the longitude and the
+    latitude intervals, longitude first, like geohashes do: a cell of a
+    level is the parent of the 4 cells of the next level whose keys
+    differ in the last 2 bits, i.e. the key of the parent is key >> 2.
+
+    Args:
+        lat, lon: float arrays, the coordinates of the points, degrees
+        level: an int, from 0 (a single cell) to MAX_LEVEL
+
+    Returns:
+        An int64 array, the cell keys.
+    """
+    if not 0 <= level <= MAX_LEVEL:
+        raise ValueError("level must be between 0 and %d" % MAX_LEVEL)
+    scale = 1 << level
+    x = np.clip(np.floor((np.asarray(lon, dtype=np.float64) + 180.0) /
+                         360.0 * scale), 0, scale - 1).astype(np.int64)
+    y = np.clip(np.floor((np.asarray(lat, dtype=np.float64) + 90.0) /
+                         180.0 * scale), 0, scale - 1).astype(np.int64)
+    keys = np.zeros(np.broadcast(x, y).shape, dtype=np.int64)
+    for bit in range(level):
+        keys |= ((x >> bit) & 1) << (2 * bit + 1)
+        keys |= ((y >> bit) & 1) << (2 * bit)
+    return keys
+
+
+def cell_bounds(keys, level):
+    """Returns the (lat_min, lat_max, lon_min, lon_max) arrays of cells."""
+    keys = np.asarray(keys, dtype=np.int64)
+    x = np.zeros_like(keys)
+    y = np.zeros_like(keys)
+    for bit in range(level):
+        x |= ((keys >> (2 * bit + 1)) & 1) << bit
+        y |= ((keys >> (2 * bit)) & 1) << bit
+    lon_size = 360.0 / (1 << level)
+    lat_size = 180.0 / (1 << level)
+    lat_min = y * lat_size - 90.0
+    lon_min = x * lon_size - 180.0
+    return lat_min, lat_min + lat_size, lon_min, lon_min + lon_size
+
+
+def _reduce_cells(keys, counts, sums, histograms):
+    """Sums the statistics of cells with equal keys, sorting the keys."""
+    if not len(keys):
+        return keys, counts, sums, histograms
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], np.diff(keys) != 0]))
+
+    def reduce(values):
+        return np.add.reduceat(values[order], starts, axis=0)
+
+    return (keys[starts], reduce(counts),
+            collections.OrderedDict(
+                (field, reduce(values)) for field, values in sums.items()),
+            collections.OrderedDict(
+                (field, reduce(values))
+                for field, values in histograms.items()))
+
+
+class ThermalGrid(object):
+    """Per-cell statistics of thermals at one level of a hierarchical grid.
+
+    Only the cells holding thermals are stored, sorted by key. Every cell
+    keeps mergeable sketches: the number of thermals, the sum of every
+    sketched field (for exact means) and a fixed-bin histogram of every
+    sketched field (for quantiles). Thermals of new days can thus be added
+    to a grid, grids built in parallel can be merged, and grids of coarser
+    levels are derived from finer ones, all without the thermals.
+
+    Attributes:
+        level: an int, see cell_keys
+        sketches: a tuple of SketchSpec
+        keys: an int64 array, the keys of the cells
+        counts: an int64 array, the number of thermals of every cell
+        sums: an OrderedDict, field -> float64 array, the sum of the field
+        over the thermals of every cell
+        histograms: an OrderedDict, field -> int64 array of shape
+        (num_cells, num_bins), the histogram of the field in every cell
+        days: an int64 array, the sorted UTC days (since epoch) of the
+        added thermals
+    """
+
+    def __init__(self, level, sketches=DEFAULT_SKETCHES):
+        if not 0 <= level <= MAX_LEVEL:
+            raise ValueError("level must be between 0 and %d" % MAX_LEVEL)
+        self.level = level
+        self.sketches = tuple(SketchSpec(*sketch) for sketch in sketches)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = collections.OrderedDict(
+            (sketch.field, np.zeros(0, dtype=np.float64))
+            for sketch in self.sketches)
+        self.histograms = collections.OrderedDict(
+            (sketch.field, np.zeros((0, sketch.num_bins), dtype=np.int64))
+            for sketch in self.sketches)
+        self.days = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _sketch(self, field):
+        for sketch in self.sketches:
+            if sketch.field == field:
+                return sketch
+        raise KeyError("no sketch of %r" % field)
+
+    def _combine(self, keys, counts, sums, histograms, days):
+        self.keys, self.counts, self.sums, self.histograms = _reduce_cells(
+            np.concatenate([self.keys, keys]),
+            np.concatenate([self.counts, counts]),
+            collections.OrderedDict(
+                (field, np.concatenate([values, sums[field]]))
+                for field, values in self.sums.items()),
+            collections.OrderedDict(
+                (field, np.concatenate([values, histograms[field]]))
+                for field, values in self.histograms.items()))
+        self.days = np.union1d(self.days, days)
+
+    def add(self, thermals):
+        """Adds thermals to the grid.
+
+        Args:
+            thermals: a list of igc_lib.Thermal, or a hotspots.ThermalTable
+        """
+        table = thermals
+        if not isinstance(table, hotspots.ThermalTable):
+            table = hotspots.thermal_table(thermals)
+        keys, inverse = np.unique(
+            cell_keys(table.lat, table.lon, self.level), return_inverse=True)
+        inverse = inverse.ravel()
+        num_cells = len(keys)
+        sums = collections.OrderedDict()
+        histograms = collections.OrderedDict()
+        for sketch in self.sketches:
+            values = np.asarray(getattr(table, sketch.field),
+                                dtype=np.float64)
+            sums[sketch.field] = np.bincount(inverse, weights=values,
+                                             minlength=num_cells)
+            width = (sketch.stop - sketch.start) / sketch.num_bins
+            bins = np.clip(np.floor((values - sketch.start) / width),
+                           0, sketch.num_bins - 1).astype(np.int64)
+            histograms[sketch.field] = np.bincount(
+                inverse * sketch.num_bins + bins,
+                minlength=num_cells * sketch.num_bins).reshape(
+                    num_cells, sketch.num_bins)
+        days = np.unique(np.floor(np.asarray(table.timestamp) / _DAY))
+        self._combine(keys, np.bincount(inverse, minlength=num_cells),
+                      sums, histograms, days.astype(np.int64))
+
+    def merge(self, other):
+        """Adds the statistics of another grid of the same level."""
+        if other.level != self.level or other.sketches != self.sketches:
+            raise ValueError("can not merge grids of different levels or "
+                             "sketches")
+        self._combine(other.keys, other.counts, other.sums,
+                      other.histograms, other.days)
+
+    def coarsen(self, level):
+        """Derives the grid of a coarser level.
+
+        Args:
+            level: an int, not greater than the level of this grid
+
+        Returns:
+            A new ThermalGrid.
+        """
+        if not 0 <= level <= self.level:
+            raise ValueError("can not coarsen a grid of level %d to %d" %
+                             (self.level, level))
+        grid = ThermalGrid(level, self.sketches)
+        grid._combine(self.keys >> (2 * (self.level - level)), self.counts,
+                      self.sums, self.histograms, self.days)
+        return grid
+
+    def pyramid(self, min_level=0):
+        """Derives the grids of all levels from min_level to this one.
+
+        Every level is derived from the next finer one.
+
+        Returns:
+            A dict, level -> ThermalGrid, including this grid.
+        """
+        grids = {self.level: self}
+        for level in range(self.level - 1, min_level - 1, -1):
+            grids[level] = grids[level + 1].coarsen(level)
+        return grids
+
+    def bounds(self):
+        """Returns the bounds of the cells, see cell_bounds."""
+        return cell_bounds(self.keys, self.level)
+
+    def mean(self, field):
+        """Returns the mean of a sketched field in every cell."""
+        self._sketch(field)
+        return self.sums[field] / np.maximum(self.counts, 1)
+
+    def quantiles(self, field, q):
+        """Estimates quantiles of a sketched field in every cell.
+
+        Quantiles are interpolated linearly within the histogram bins.
+
+        Args:
+            field: a string, the name of a sketched field
+            q: a float or a float array, the quantiles, between 0 and 1
+
+        Returns:
+            A float64 array of shape (num_cells,) + shape of q.
+        """
+        sketch = self._sketch(field)
+        q = np.asarray(q, dtype=np.float64)
+        histograms = self.histograms[field]
+        cumulative = np.cumsum(histograms, axis=1)
+        target = (self.counts.reshape((-1,) + (1,) * q.ndim) * q)[..., None]
+        cumulative = cumulative.reshape(
+            (len(self.keys),) + (1,) * q.ndim + (sketch.num_bins,))
+        # The bin holding the target rank; the first non-empty bin when
+        # the target is 0.
+        bins = np.where(target[..., 0] > 0,
+                        (cumulative < target).sum(axis=-1),
+                        (cumulative == 0).sum(axis=-1))
+        bins = np.minimum(bins, sketch.num_bins - 1)
+        histograms = histograms.reshape(cumulative.shape)
+        below = np.take_along_axis(cumulative, bins[..., None],
+                                   axis=-1)[..., 0]
+        in_bin = np.take_along_axis(histograms, bins[..., None],
+                                    axis=-1)[..., 0]
+        below = below - in_bin
+        fraction = np.clip((target[..., 0] - below) / np.maximum(in_bin, 1),
+                           0.0, 1.0)
+        width = (sketch.stop - sketch.start) / sketch.num_bins
+        return sketch.start + (bins + fraction) * width
+
+    def save(self, filename):
+        """Saves the grid to a .npz file."""
+        arrays = {
+            'level': np.array(self.level),
+            'sketch_fields': np.array([s.field for s in self.sketches]),
+            'sketch_starts': np.array([s.start for s in self.sketches]),
+            'sketch_stops': np.array([s.stop for s in self.sketches]),
+            'sketch_num_bins': np.array([s.num_bins for s in self.sketches]),
+            'keys': self.keys, 'counts': self.counts, 'days': self.days}
+        for field in self.sums:
+            arrays['sums.' + field] = self.sums[field]
+            arrays['histograms.' + field] = self.histograms[field]
+        with open(filename, 'wb') as grid_file:
+            np.savez_compressed(grid_file, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a grid saved by save."""
+        with np.load(filename, allow_pickle=False) as arrays:
+            sketches = [
+                SketchSpec(str(field), float(start), float(stop),
+                           int(num_bins))
+                for field, start, stop, num_bins in zip(
+                    arrays['sketch_fields'], arrays['sketch_starts'],
+                    arrays['sketch_stops'], arrays['sketch_num_bins'])]
+            grid = cls(int(arrays['level']), sketches)
+            grid.keys = arrays['keys']
+            grid.counts = arrays['counts']
+            grid.days = arrays['days']
+            for sketch in grid.sketches:
+                grid.sums[sketch.field] = arrays['sums.' + sketch.field]
+                grid.histograms[sketch.field] = arrays[
+                    'histograms.' + sketch.field]
+        return grid
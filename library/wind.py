@@ -0,0 +1,427 @@
+import collections
+import functools
+import math
+
+import numpy as np
+
+import igc_lib
+import lib.batch as batch
+import lib.geo as geo
+import lib.thermal_analysis as thermal_analysis
+import lib.thermal_grid as thermal_grid
+
+# Wind estimates from the drift of the circles of circling segments, one
+# row per estimate.
+#   segment: int64 array, the circling segment of the estimate
+#   lat, lon: float64 arrays, the mean centre of the circles, degrees
+#   alt: float64 array, the mean altitude of the circles, meters
+#   timestamp: float64 array, the mean time of the circles (since epoch),
+#   seconds
+#   wind_east, wind_north: float64 arrays, the velocity of the air mass,
+#   m/s (the direction the wind blows to, see speed_direction)
+#   num_turns: int64 array, the number of circles of the estimate
+WindEstimates = collections.namedtuple(
+    'WindEstimates',
+    ['segment', 'lat', 'lon', 'alt', 'timestamp', 'wind_east', 'wind_north',
+     'num_turns'])
+
+# The estimates of a set of circling segments.
+#   segments: WindEstimates, one per segment, from all its circles
+#   bands: WindEstimates, one per segment and altitude band, from the
+#   circles whose mean altitude is in the band
+WindAnalysis = collections.namedtuple('WindAnalysis', ['segments', 'bands'])
+
+_DAY = 24.0 * 60.0 * 60.0
+
+
+def _empty_estimates():
+    return WindEstimates(
+        *[np.zeros(0, dtype=np.int64)] +
+        [np.zeros(0, dtype=np.float64)] * 6 +
+        [np.zeros(0, dtype=np.int64)])
+
+
+def speed_direction(wind_east, wind_north):
+    """Converts wind vectors to speeds and meteorological directions.
+
+    Args:
+        wind_east, wind_north: float arrays, the velocity of the air mass,
+        m/s
+
+    Returns:
+        A (speed, direction) pair of float64 arrays: the speed in m/s and
+        the direction the wind blows from, in degrees, 0.0 for a northerly
+        wind, 90.0 for an easterly wind, in the [0.0, 360.0) range.
+    """
+    wind_east = np.asarray(wind_east, dtype=np.float64)
+    wind_north = np.asarray(wind_north, dtype=np.float64)
+    direction = np.degrees(np.arctan2(-wind_east, -wind_north)) % 360.0
+    return np.hypot(wind_east, wind_north), direction
+
+
+def correct_drift(lat, lon, timestamp, reference_timestamp, wind_east,
+                  wind_north):
+    """Moves points drifting with the wind to their reference time.
+
+    A thermal drifts with the air mass: where it was seen at timestamp, it
+    was wind * (reference_timestamp - timestamp) away at the reference
+    time. Correcting the thermals of a day to a common reference time
+    aligns the thermals of the same source seen at different times.
+
+    Args:
+        lat, lon: float arrays, the positions, degrees
+        timestamp: a float array, the times of the positions, seconds
+        reference_timestamp: a float or a float array, seconds
+        wind_east, wind_north: float arrays, the wind, m/s; points with an
+        unknown (NaN) wind are not moved
+
+    Returns:
+        A (lat, lon) pair of float64 arrays, the corrected positions.
+    """
+    elapsed = np.subtract(reference_timestamp, timestamp)
+    east = np.nan_to_num(np.multiply(wind_east, elapsed))
+    north = np.nan_to_num(np.multiply(wind_north, elapsed))
+    return geo.from_local_offsets(lat, lon, east / 1000.0, north / 1000.0)
+
+
+def circling_segments(flight, min_time=60.0):
+    """Finds the circling segments of a flight.
+
+    Circling segments are the runs of circling fixes from takeoff to
+    landing, as detected by the circling stage of the flight. Unlike
+    thermals, they are not required to be closed by a straight fix: a
+    segment ends at its first straight fix, or at the landing.
+
+    Args:
+        flight: a valid igc_lib.Flight
+        min_time: a float, the minimum duration of a segment, seconds
+
+    Returns:
+        An (enter, exit) pair of int64 arrays, the indices of the first and
+        the last fixes of the segments.
+    """
+    takeoff_index = flight.takeoff_fix.index
+    landing_index = flight.landing_fix.index
+    starts, stops, states = igc_lib._run_lengths(
+        flight.fixes.circling[takeoff_index:landing_index + 1])
+    enter = starts[states] + takeoff_index
+    exit = np.minimum(stops[states] + takeoff_index, landing_index)
+    timestamp = flight.fixes.timestamp
+    long_enough = timestamp[exit] - timestamp[enter] > min_time - 1e-5
+    return (enter[long_enough].astype(np.int64),
+            exit[long_enough].astype(np.int64))
+
+
+def _group_estimates(groups, num_groups, segment, turns, min_turns,
+                     max_speed):
+    """Estimates the wind in groups of turns of the same segment.
+
+    The wind of a group is the drift of the centres of its turns, a least
+    squares regression of the centres against time.
+    """
+    count, sum_time, sum_alt = thermal_analysis._group_sums(
+        groups, num_groups, None, turns.timestamp, turns.alt)
+    # Centres in meters, relative to the first turn of their group.
+    first = np.full(num_groups, len(groups) - 1, dtype=np.int64)
+    np.minimum.at(first, groups, np.arange(len(groups)))
+    east, north = geo.local_offsets(
+        turns.lat[first][groups], turns.lon[first][groups], turns.lat,
+        turns.lon)
+    sum_east, sum_north = thermal_analysis._group_sums(
+        groups, num_groups, east, north)
+    wind_east, wind_north = thermal_analysis._drift(
+        groups, num_groups, turns.timestamp, east * 1000.0, north * 1000.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lat, lon = geo.from_local_offsets(
+            turns.lat[first], turns.lon[first], sum_east / count,
+            sum_north / count)
+        kept = ((count >= max(min_turns, 2)) &
+                (np.hypot(wind_east, wind_north) <= max_speed))
+        return WindEstimates(
+            segment=segment[kept], lat=lat[kept], lon=lon[kept],
+            alt=(sum_alt / count)[kept],
+            timestamp=(sum_time / count)[kept],
+            wind_east=wind_east[kept], wind_north=wind_north[kept],
+            num_turns=count[kept].astype(np.int64))
+
+
+def estimate_wind(analysis, band_width=500.0, min_turns=3, max_speed=30.0):
+    """Estimates the wind from the drift of the circles of segments.
+
+    A glider circling in a thermal drifts with the air mass, so the centres
+    of its circles move with the wind. The wind of a segment, or of the
+    circles of a segment in an altitude band, is the velocity of the
+    centres of its turns, see thermal_analysis.TurnTable.
+
+    Args:
+        analysis: a thermal_analysis.ThermalAnalysis of circling segments
+        band_width: a float, the height of the altitude bands, meters
+        min_turns: an int, the minimum number of turns of an estimate, at
+        least 2
+        max_speed: a float, estimates of faster winds are dropped, m/s
+
+    Returns:
+        A WindAnalysis namedtuple, whose segments are the thermals of
+        analysis.
+    """
+    turns = analysis.turns
+    if not len(turns.thermal):
+        return WindAnalysis(_empty_estimates(), _empty_estimates())
+    num_segments = len(analysis.geometry.num_turns)
+    segments = _group_estimates(
+        turns.thermal, num_segments, np.arange(num_segments), turns,
+        min_turns, max_speed)
+
+    band = np.floor(turns.alt / band_width).astype(np.int64)
+    keys, inverse = np.unique(
+        np.stack([turns.thermal, band]), axis=1, return_inverse=True)
+    bands = _group_estimates(inverse.ravel(), keys.shape[1], keys[0], turns,
+                             min_turns, max_speed)
+    return WindAnalysis(segments, bands)
+
+
+def estimate_flights(flights, band_width=500.0, min_time=60.0, min_turns=3,
+                     max_speed=30.0, **kwargs):
+    """Estimates the wind from the circling segments of many flights.
+
+    The circling segments of all the flights are analyzed together, see
+    thermal_analysis.analyze_flights.
+
+    Args:
+        flights: a list of igc_lib.Flight; invalid flights are skipped
+        band_width, min_turns, max_speed: see estimate_wind
+        min_time: see circling_segments
+        **kwargs: passed to thermal_analysis.analyze_fixes
+
+    Returns:
+        A (flights, wind) pair: an int64 array, the index in flights of
+        every circling segment, and a WindAnalysis namedtuple.
+    """
+    owner, analysis = thermal_analysis.analyze_flights(
+        flights, functools.partial(circling_segments, min_time=min_time),
+        **kwargs)
+    return owner, estimate_wind(analysis, band_width, min_turns, max_speed)
+
+
+def _estimate_flight(flight, **kwargs):
+    """Returns the number of circling segments and the WindAnalysis of a
+    flight, in a batch worker."""
+    owner, wind = estimate_flights([flight], **kwargs)
+    return len(owner), wind
+
+
+def _concatenate(wind, offsets):
+    """Concatenates WindAnalysis, adding offsets to segments."""
+    tables = []
+    for records in zip(*wind):
+        columns = []
+        for field, values in zip(WindEstimates._fields, zip(*records)):
+            if field == 'segment':
+                values = [value + offset for value, offset in
+                          zip(values, offsets)]
+            columns.append(np.concatenate(values))
+        tables.append(WindEstimates(*columns))
+    return WindAnalysis(*tables)
+
+
+def estimate_files(filenames, config_class=igc_lib.FlightParsingConfig,
+                   workers=None, band_width=500.0, min_time=60.0,
+                   min_turns=3, max_speed=30.0, **kwargs):
+    """Estimates the wind from the circling segments of many IGC files.
+
+    The files are loaded in parallel as lazy flights, and the estimates are
+    computed in the workers, see batch.iter_flights.
+
+    Args:
+        filenames: a list of strings, the IGC files
+        config_class: a class that implements FlightParsingConfig
+        workers: an int, the number of worker processes
+        band_width, min_time, min_turns, max_speed: see estimate_flights
+        **kwargs: passed to batch.iter_flights, e.g. chunk_size
+
+    Returns:
+        A (sources, wind) pair: an int64 array, the index in filenames of
+        every circling segment, and a WindAnalysis namedtuple.
+    """
+    filenames = list(filenames)
+    positions = dict((filename, position)
+                     for position, filename in enumerate(filenames))
+    transform = functools.partial(
+        _estimate_flight, band_width=band_width, min_time=min_time,
+        min_turns=min_turns, max_speed=max_speed)
+    kwargs.setdefault('lazy', True)
+    sources = [np.zeros(0, dtype=np.int64)]
+    wind = [WindAnalysis(_empty_estimates(), _empty_estimates())]
+    offsets = [0]
+    num_segments = 0
+    for result in batch.iter_flights(
+            filenames, config_class=config_class, workers=workers,
+            transform=transform, **kwargs):
+        if not result.valid:
+            continue
+        count, flight_wind = result.flight
+        sources.append(np.full(count, positions[result.filename],
+                               dtype=np.int64))
+        wind.append(flight_wind)
+        offsets.append(num_segments)
+        num_segments += count
+    return np.concatenate(sources), _concatenate(wind, offsets)
+
+
+class WindField(object):
+    """The wind of a day, in cells of space, time and altitude.
+
+    Wind estimates are summed in cells of four levels, from the finest to
+    the coarsest: (grid cell, time step, altitude band), (grid cell, time
+    step), (altitude band) and the whole day, weighted by their number of
+    turns. The wind at a point is the mean of the finest cell holding
+    estimates, so regions and times without circling gliders get the wind
+    of their altitude band, or of the day. Fields of the same day built in
+    parallel can be merged.
+
+    Attributes:
+        day: an int, the UTC day (since epoch) of the field
+        level: an int, the level of the grid cells, see
+        thermal_grid.cell_keys
+        time_step: a float, the duration of the time steps, seconds
+        band_width: a float, the height of the altitude bands, meters
+    """
+
+    # Altitude bands above the highest one are counted in the highest one.
+    _NUM_BANDS = 1024
+    _MAX_LEVEL = 16
+
+    def __init__(self, day, level=8, time_step=3600.0, band_width=500.0):
+        if not 0 <= level <= self._MAX_LEVEL:
+            raise ValueError("level must be between 0 and %d" %
+                             self._MAX_LEVEL)
+        self.day = int(day)
+        self.level = level
+        self.time_step = float(time_step)
+        self.band_width = float(band_width)
+        self._num_steps = int(math.ceil(_DAY / self.time_step))
+        # For every level, the sorted keys of the cells, the sum of the
+        # weights and the weighted sums of the wind.
+        self._cells = [
+            (np.zeros(0, dtype=np.int64), np.zeros(0),
+             collections.OrderedDict([('east', np.zeros(0)),
+                                      ('north', np.zeros(0))]))
+            for _ in range(4)]
+
+    def __len__(self):
+        """Returns the number of the finest cells holding estimates."""
+        return len(self._cells[0][0])
+
+    def _keys(self, lat, lon, alt, timestamp):
+        """Returns the cell keys of points, for every level."""
+        timestamp = np.asarray(timestamp, dtype=np.float64)
+        cell = thermal_grid.cell_keys(lat, lon, self.level)
+        step = np.clip(np.floor((timestamp - self.day * _DAY) /
+                                self.time_step),
+                       0, self._num_steps - 1).astype(np.int64)
+        band = np.clip(np.floor(np.asarray(alt, dtype=np.float64) /
+                                self.band_width),
+                       0, self._NUM_BANDS - 1).astype(np.int64)
+        space_time = cell * self._num_steps + step
+        return [space_time * self._NUM_BANDS + band, space_time, band,
+                np.zeros_like(band)]
+
+    def _combine(self, cells):
+        """Adds (keys, weights, sums) cells of every level."""
+        for level, (keys, weights, sums) in enumerate(cells):
+            cell_keys, cell_weights, cell_sums = self._cells[level]
+            self._cells[level] = thermal_grid._reduce_cells(
+                np.concatenate([cell_keys, keys]),
+                np.concatenate([cell_weights, weights]),
+                collections.OrderedDict(
+                    (field, np.concatenate([values, sums[field]]))
+                    for field, values in cell_sums.items()),
+                collections.OrderedDict())[:3]
+
+    def add(self, estimates):
+        """Adds wind estimates of the day.
+
+        Args:
+            estimates: a WindEstimates namedtuple, e.g. the bands of a
+            WindAnalysis
+
+        Raises:
+            ValueError: some estimates are not of the day of the field.
+        """
+        timestamp = np.asarray(estimates.timestamp, dtype=np.float64)
+        if np.any(np.floor(timestamp / _DAY) != self.day):
+            raise ValueError("estimates are not of day %d" % self.day)
+        weights = np.asarray(estimates.num_turns, dtype=np.float64)
+        sums = collections.OrderedDict([
+            ('east', weights * estimates.wind_east),
+            ('north', weights * estimates.wind_north)])
+        self._combine([
+            (keys, weights, sums) for keys in self._keys(
+                estimates.lat, estimates.lon, estimates.alt, timestamp)])
+
+    def merge(self, other):
+        """Adds the estimates of another field with the same cells."""
+        if ((other.day, other.level, other.time_step, other.band_width) !=
+                (self.day, self.level, self.time_step, self.band_width)):
+            raise ValueError("can not merge fields of different days or "
+                             "cells")
+        self._combine(other._cells)
+
+    def wind(self, lat, lon, alt, timestamp):
+        """Returns the wind at points of the day.
+
+        Args:
+            lat, lon: float arrays, the positions of the points, degrees
+            alt: a float array, the altitudes of the points, meters
+            timestamp: a float array, the times of the points, seconds
+
+        Returns:
+            A (wind_east, wind_north) pair of float64 arrays, m/s; NaN when
+            the field holds no estimate.
+        """
+        keys = self._keys(lat, lon, alt, timestamp)
+        wind_east = np.full(keys[0].shape, np.nan)
+        wind_north = np.full(keys[0].shape, np.nan)
+        missing = np.ones(keys[0].shape, dtype=bool)
+        for level_keys, (cell_keys, weights, sums) in zip(keys, self._cells):
+            if not len(cell_keys):
+                continue
+            position = np.minimum(np.searchsorted(cell_keys, level_keys),
+                                  len(cell_keys) - 1)
+            found = missing & (cell_keys[position] == level_keys)
+            cells = position[found]
+            wind_east[found] = sums['east'][cells] / weights[cells]
+            wind_north[found] = sums['north'][cells] / weights[cells]
+            missing &= ~found
+        return wind_east, wind_north
+
+    def correct_drift(self, lat, lon, alt, timestamp, reference_timestamp):
+        """Moves thermals of the day to their reference time, with the wind
+        of the field at their position, see correct_drift.
+
+        Returns:
+            A (lat, lon) pair of float64 arrays.
+        """
+        wind_east, wind_north = self.wind(lat, lon, alt, timestamp)
+        return correct_drift(lat, lon, timestamp, reference_timestamp,
+                             wind_east, wind_north)
+
+
+def wind_fields(estimates, **kwargs):
+    """Builds the wind fields of the days of estimates.
+
+    Args:
+        estimates: a WindEstimates namedtuple
+        **kwargs: passed to WindField, e.g. level
+
+    Returns:
+        A dict, UTC day (since epoch) -> WindField.
+    """
+    days = np.floor(np.asarray(estimates.timestamp) / _DAY).astype(np.int64)
+    fields = {}
+    for day in np.unique(days).tolist():
+        field = WindField(day, **kwargs)
+        field.add(WindEstimates(*[np.asarray(column)[days == day]
+                                  for column in estimates]))
+        fields[day] = field
+    return fields
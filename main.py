@@ -1,9 +1,14 @@
 from __future__ import print_function
-import igc_lib
 import matplotlib.pyplot as plt
 import geopandas
 import numpy as np
 import data_analysis
+import lib.batch as batch
+import lib.corpus_index as corpus_index
+import lib.thermal_analysis as thermal_analysis
+import lib.thermal_grid as thermal_grid
+from matplotlib.collections import PatchCollection
+from matplotlib.patches import Rectangle
 
 
 def make_list_of_tracks(repertoire, list_of_names_txt):
@@ -18,14 +23,29 @@ def make_list_of_tracks(repertoire, list_of_names_txt):
     return list_of_track_names
 
 
-def get_list_of_flight(repertoire, list_of_names_txt):
-    list_of_flight = list()
+def get_list_of_flight(repertoire, list_of_names_txt, workers=None,
+                       cache_dir=None, lazy=False):
     track_list = make_list_of_tracks(repertoire, list_of_names_txt)
-    for name in track_list:
-        flight = igc_lib.Flight.create_from_file("IGC_FILES/" + repertoire + '/' + name)
-        if flight.valid:
-            list_of_flight.append(flight)
-    return list_of_flight
+    filenames = ["IGC_FILES/" + repertoire + '/' + name for name in track_list]
+    return batch.load_flights(filenames, workers=workers, cache_dir=cache_dir,
+                              lazy=lazy)
+
+
+def get_index_of_flights(repertoire, list_of_names_txt, workers=None,
+                         index_filename=None):
+    track_list = make_list_of_tracks(repertoire, list_of_names_txt)
+    filenames = ["IGC_FILES/" + repertoire + '/' + name for name in track_list]
+    previous = None
+    if index_filename is not None:
+        try:
+            previous = corpus_index.load_index(index_filename)
+        except (IOError, OSError, ValueError):
+            pass
+    records = corpus_index.build_index(filenames, workers=workers,
+                                       previous=previous)
+    if index_filename is not None:
+        corpus_index.save_index(records, index_filename)
+    return records
 
 
 def get_thermal_list(list_flights):
@@ -71,6 +91,39 @@ def plot_thermal_position_2(thermal_list_, ax, title="Graphics"):
     plt.title(title)
 
 
+def plot_thermal_grid(thermal_list_, ax, level=12, quantile=0.5,
+                      title="Graphics"):
+    """Plots a quantile of the climb rate of the thermals in grid cells."""
+    grid = thermal_grid.ThermalGrid(level)
+    grid.add(thermal_list_)
+    lat_min, lat_max, lon_min, lon_max = grid.bounds()
+    cells = [Rectangle((x, y), width, height) for x, y, width, height in
+             zip(lon_min, lat_min, lon_max - lon_min, lat_max - lat_min)]
+    collection = PatchCollection(cells, cmap=plt.get_cmap("jet"))
+    collection.set_array(grid.quantiles("vertical_velocity", quantile))
+    ax.add_collection(collection)
+    ax.autoscale_view()
+    plt.colorbar(collection, ax=ax, label="Vertical Speed")
+    ax.set_xlabel("longitude (deg)")
+    ax.set_ylabel("latitude (deg)")
+    ax.grid(True)
+    plt.title(title)
+
+
+def plot_thermal_cores(list_flights, ax, title="Graphics"):
+    """Plots the drift-corrected cores of the thermals of flights, colored
+    by their turn radius."""
+    _, analysis = thermal_analysis.analyze_flights(list_flights)
+    geometry = analysis.geometry
+    scatter = ax.scatter(geometry.core_lon, geometry.core_lat,
+                         c=geometry.radius, cmap=plt.get_cmap("jet"))
+    plt.colorbar(scatter, ax=ax, label="Turn radius (m)")
+    ax.set_xlabel("longitude (deg)")
+    ax.set_ylabel("latitude (deg)")
+    ax.grid(True)
+    plt.title(title)
+
+
 def plot_over_map(thermal_list, ax, title="Graphics"):
 
     sorted_x_th = sorted(thermal_list, key=lambda thermal: (thermal.enter_fix.lon + thermal.exit_fix.lon) / 2)
@@ -95,6 +148,8 @@ def sort_by_date(flight_list):
 
     flight_per_date = dict()
     for flight in flight_list:
+        if getattr(flight, 'date', None) is None:
+            continue
         date = date_to_str(flight.date)
         if flight_per_date.get(date):
             flight_per_date[date] += [flight]
@@ -107,9 +162,11 @@ def main():
     repertoires = ["IGC_SO_18"]
     for rep in repertoires:
         repertoire, list_of_names_txt = rep, "list_files_igc_1.txt"
-        list_of_flights = get_list_of_flight(repertoire, list_of_names_txt)
-        dict_flight = sort_by_date(list_of_flights)
-        for key, cont in dict_flight:
+        # Sorting by date only needs the headers of the files. Without
+        # loading the flights, files failing validation are counted too.
+        index_of_flights = get_index_of_flights(repertoire, list_of_names_txt)
+        dict_flight = sort_by_date(index_of_flights)
+        for key, cont in dict_flight.items():
             print(key, len(cont))
         # thermal_list = get_thermal_list(list_of_flights)
         # print(thermal_list)
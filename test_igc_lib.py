@@ -0,0 +1,558 @@
+import gc
+import math
+import pickle
+import unittest
+import weakref
+
+import numpy as np
+
+import igc_lib
+
+
+class TestLazyFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.igc_file = 'testfiles/napret.igc'
+        self.flight = igc_lib.Flight.create_from_file(self.igc_file, lazy=True)
+
+    def assertComputed(self, columns):
+        computed = [name for name in ['gsp', 'flying', 'bearing',
+                                      'bearing_change_rate', 'circling']
+                    if name in vars(self.flight.fixes)]
+        self.assertListEqual(computed, columns)
+
+    def testHeadersNeedNoAnalysis(self):
+        self.assertIsNotNone(self.flight.date)
+        self.assertIsNotNone(self.flight.glider_type)
+        self.assertComputed([])
+
+    def testValidityNeedsFlightDetectionOnly(self):
+        self.assertTrue(self.flight.valid)
+        self.assertIsNotNone(self.flight.takeoff_fix)
+        self.assertComputed(['gsp', 'flying'])
+
+    def testFixColumnsAreComputedOnAccess(self):
+        self.assertIsInstance(self.flight.fixes[10].bearing, float)
+        self.assertComputed(['bearing'])
+
+    def testThermalsMatchEagerFlight(self):
+        eager = igc_lib.Flight.create_from_file(self.igc_file)
+        self.assertListEqual(
+            [(t.enter_fix.index, t.exit_fix.index)
+             for t in self.flight.thermals],
+            [(t.enter_fix.index, t.exit_fix.index) for t in eager.thermals])
+        self.assertComputed(['gsp', 'flying', 'bearing',
+                             'bearing_change_rate', 'circling'])
+        np.testing.assert_array_equal(self.flight.fixes.circling,
+                                      eager.fixes.circling)
+
+    def testFixesKeepLazyFlightForColumns(self):
+        fixes = igc_lib.Flight.create_from_file(self.igc_file,
+                                                lazy=True).fixes
+        gc.collect()
+        self.assertIsNotNone(fixes.flight)
+        self.assertEqual(len(fixes.gsp), len(fixes))
+        self.assertEqual(len(fixes.circling), len(fixes))
+        # All the columns are computed, the flight is not needed anymore.
+        gc.collect()
+        self.assertIsNone(fixes.flight)
+        self.assertIsNone(fixes[0].flight)
+
+    def testNoTakeoffIsInvalid(self):
+        flight = igc_lib.Flight.create_from_file(
+            self.igc_file, NeverFlyingConfig, lazy=True)
+        self.assertFalse(flight.valid)
+        self.assertListEqual(flight.notes, ["Error: did not detect takeoff."])
+        self.assertFalse(hasattr(flight, 'thermals'))
+        self.assertFalse(hasattr(flight, 'takeoff_fix'))
+
+    def testInvalidFileRunsNoStage(self):
+        flight = igc_lib.Flight.create_from_file('testfiles/no_date.igc',
+                                                 lazy=True)
+        self.assertFalse(flight.valid)
+        self.assertFalse(hasattr(flight, 'thermals'))
+        self.assertFalse(hasattr(flight.fixes, 'gsp'))
+
+
+class NeverFlyingConfig(igc_lib.FlightParsingConfig):
+    min_gsp_flight = 1000.0
+
+
+class TestAnalyzeFlights(unittest.TestCase):
+
+    def setUp(self):
+        self.igc_files = ['testfiles/napret.igc', 'testfiles/olsztyn.igc',
+                          'testfiles/south.igc', 'testfiles/no_date.igc',
+                          'testfiles/napret.igc']
+
+    def testMatchesEagerFlights(self):
+        flights = [igc_lib.Flight.create_from_file(igc_file, lazy=True)
+                   for igc_file in self.igc_files]
+        igc_lib.analyze_flights(flights, batch_size=2)
+        for igc_file, flight in zip(self.igc_files, flights):
+            eager = igc_lib.Flight.create_from_file(igc_file)
+            self.assertEqual(flight.valid, eager.valid)
+            self.assertListEqual(flight.notes, eager.notes)
+            if not eager.valid:
+                continue
+            np.testing.assert_array_equal(flight.fixes.flying,
+                                          eager.fixes.flying)
+            np.testing.assert_array_equal(flight.fixes.circling,
+                                          eager.fixes.circling)
+            self.assertListEqual(
+                [(t.enter_fix.index, t.exit_fix.index)
+                 for t in flight.thermals],
+                [(t.enter_fix.index, t.exit_fix.index)
+                 for t in eager.thermals])
+
+    def testNoTakeoffSkipsCircling(self):
+        flights = [
+            igc_lib.Flight.create_from_file(self.igc_files[0], lazy=True),
+            igc_lib.Flight.create_from_file(self.igc_files[0],
+                                            NeverFlyingConfig, lazy=True)]
+        igc_lib.analyze_flights(flights)
+        self.assertTrue(flights[0].valid)
+        self.assertFalse(flights[1].valid)
+        self.assertFalse(hasattr(flights[1].fixes, 'circling'))
+        self.assertFalse(hasattr(flights[1], 'thermals'))
+
+
+class TestCompactObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = igc_lib.Flight.create_from_file('testfiles/napret.igc')
+
+    def testNoInstanceDicts(self):
+        for obj in [self.flight.fixes[0], self.flight.thermals[0],
+                    self.flight.glides[0]]:
+            self.assertFalse(hasattr(obj, '__dict__'))
+            with self.assertRaises(AttributeError):
+                obj.unknown_attribute = 1
+
+    def testFlightIsFreedWithoutCycleCollection(self):
+        thermal = self.flight.thermals[0]
+        flight_ref = weakref.ref(self.flight)
+        gc.disable()
+        try:
+            del self.flight
+            self.assertIsNone(flight_ref())
+        finally:
+            gc.enable()
+        self.assertIsNone(thermal.enter_fix.flight)
+        self.assertIsInstance(thermal.enter_fix.alt, float)
+
+    def testPickleKeepsBackReference(self):
+        flight = pickle.loads(pickle.dumps(self.flight))
+        self.assertIs(flight.fixes.flight, flight)
+        self.assertIs(flight.thermals[0].exit_fix.flight, flight)
+        self.assertEqual(flight.thermals[0].exit_fix.alt,
+                         self.flight.thermals[0].exit_fix.alt)
+
+
+def _check_fixes_with_loops(rawtime, press_alt, gnss_alt, config):
+    """Reference validators: the fix by fix loops igc_lib used to run."""
+    notes = []
+    counts = {}
+    for name, alt in [('press', press_alt), ('gnss', gnss_alt)]:
+        violations, huge_changes, changes_sum = 0, 0, 0.0
+        for i in range(len(rawtime) - 1):
+            alt_delta = math.fabs(alt[i+1] - alt[i])
+            rawtime_delta = math.fabs(rawtime[i+1] - rawtime[i])
+            if rawtime_delta > 0.5:
+                if alt_delta / rawtime_delta > config.max_alt_change_rate:
+                    huge_changes += 1
+                else:
+                    changes_sum += alt_delta
+            if alt[i] > config.max_alt or alt[i] < config.min_alt:
+                violations += 1
+        counts[name] = (violations, huge_changes,
+                        changes_sum / float(len(rawtime) - 1))
+
+    DAY = 24.0 * 60.0 * 60.0
+    rawtime = list(rawtime)
+    days_added, rawtime_to_add, exceeded = 0, 0.0, 0
+    for i in range(1, len(rawtime)):
+        rawtime[i] += rawtime_to_add
+        if (rawtime[i-1] > rawtime[i] and
+                rawtime[i] + DAY < rawtime[i-1] + 200.0):
+            days_added += 1
+            rawtime_to_add += DAY
+            rawtime[i] += DAY
+        time_change = rawtime[i] - rawtime[i-1]
+        if time_change < config.min_seconds_between_fixes - 1e-5:
+            exceeded += 1
+        if time_change > config.max_seconds_between_fixes + 1e-5:
+            exceeded += 1
+    return counts, rawtime, days_added, exceeded
+
+
+class TestValidation(unittest.TestCase):
+
+    def makeFixes(self, rawtime, press_alt, gnss_alt):
+        n = len(rawtime)
+        return igc_lib.FixArray(rawtime, [0.0] * n, [0.0] * n, ['A'] * n,
+                                press_alt, gnss_alt, range(n), [''] * n)
+
+    def makeFlight(self, rawtime, press_alt, gnss_alt, config_class):
+        flight = igc_lib.Flight.__new__(igc_lib.Flight)
+        flight._config = config_class()
+        flight.fixes = self.makeFixes(rawtime, press_alt, gnss_alt)
+        flight.valid = True
+        flight.notes = []
+        flight._days_added = None
+        return flight
+
+    def testMatchesLoops(self):
+        random = np.random.RandomState(42)
+        config = igc_lib.FlightParsingConfig()
+        for _ in range(20):
+            n = random.randint(2, 400)
+            steps = random.choice([0.0, 1.0, 4.0, 60.0], size=n,
+                                  p=[0.02, 0.9, 0.05, 0.03])
+            rawtime = np.fmod(80000.0 + np.cumsum(steps), 86400.0)
+            press_alt = 500.0 + np.cumsum(random.normal(0.0, 30.0, size=n))
+            gnss_alt = np.round(press_alt * random.choice([0.0, 1.0]) +
+                                random.choice([0.0, 11000.0], size=n,
+                                              p=[0.99, 0.01]))
+            counts, fixed_rawtime, days_added, exceeded = (
+                _check_fixes_with_loops(rawtime.tolist(), press_alt.tolist(),
+                                        gnss_alt.tolist(), config))
+
+            flight = self.makeFlight(rawtime, press_alt, gnss_alt,
+                                     igc_lib.FlightParsingConfig)
+            rawtime_delta = np.fabs(np.diff(flight.fixes.rawtime))
+            self.assertEqual(flight._count_altitude_anomalies(
+                flight.fixes.press_alt, rawtime_delta), counts['press'])
+            self.assertEqual(flight._count_altitude_anomalies(
+                flight.fixes.gnss_alt, rawtime_delta), counts['gnss'])
+            flight._check_altitudes()
+            flight._check_fix_rawtime()
+            flight._correct_day_crossings()
+            self.assertListEqual(flight.fixes.rawtime.tolist(), fixed_rawtime)
+            self.assertEqual(
+                flight.valid, exceeded <= config.max_time_violations and
+                days_added <= config.max_new_days_in_flight)
+            self.assertEqual(
+                any('too many fixes intervals' in note
+                    for note in flight.notes),
+                exceeded > config.max_time_violations)
+
+    def testFailFast(self):
+        class FailFastConfig(igc_lib.FlightParsingConfig):
+            fail_fast = True
+
+        # Constant altitudes and too long intervals between fixes.
+        rawtime = [0.0, 100.0, 200.0, 86000.0] * 20
+        alt = [100.0] * len(rawtime)
+        slow = igc_lib.Flight(self.makeFixes(rawtime, alt, alt), [], [], [],
+                              igc_lib.FlightParsingConfig())
+        fast = igc_lib.Flight(self.makeFixes(rawtime, alt, alt), [], [], [],
+                              FailFastConfig())
+        self.assertFalse(slow.valid)
+        self.assertFalse(fast.valid)
+        self.assertEqual(len(fast.notes), 1)
+        self.assertIn('too many fixes intervals', fast.notes[0])
+        self.assertEqual(slow.notes[-1], fast.notes[0])
+        self.assertGreater(len(slow.notes), 1)
+
+    def testFailFastStopsEarly(self):
+        class FailFastConfig(igc_lib.FlightParsingConfig):
+            fail_fast = True
+
+        rawtime = [0.0, 100.0, 200.0, 86000.0] * 5000
+        alt = np.arange(len(rawtime), dtype=np.float64) % 7.0
+        slow = igc_lib.Flight(self.makeFixes(rawtime, alt, alt), [], [], [],
+                              igc_lib.FlightParsingConfig())
+        fast = igc_lib.Flight(self.makeFixes(rawtime, alt, alt), [], [], [],
+                              FailFastConfig())
+        self.assertIn('found 19999 fixes', slow.notes[-1])
+        # Only the first chunk of fixes is checked.
+        self.assertEqual(len(fast.notes), 1)
+        self.assertIn('found at least %d fixes' %
+                      igc_lib.Flight._FAIL_FAST_CHUNK, fast.notes[0])
+
+    def testFailFastChecksAltitudesOnRecordedTimes(self):
+        class FailFastConfig(igc_lib.FlightParsingConfig):
+            fail_fast = True
+
+        # Crosses 0:00 UTC, with a 200 m altitude step at the crossing.
+        rawtime = np.concatenate([np.arange(86300.0, 86400.0),
+                                  np.arange(0.0, 100.0)])
+        alt = np.where(rawtime < 1000.0, 700.0, 500.0)
+        # The rawtimes are corrected in place, give each flight a copy.
+        slow = igc_lib.Flight(self.makeFixes(rawtime.copy(), alt, alt), [],
+                              [], [], igc_lib.FlightParsingConfig())
+        fast = igc_lib.Flight(self.makeFixes(rawtime.copy(), alt, alt), [],
+                              [], [], FailFastConfig())
+        self.assertListEqual(fast.notes, slow.notes)
+        np.testing.assert_array_equal(fast.fixes.rawtime,
+                                      slow.fixes.rawtime)
+        self.assertEqual(slow.fixes.rawtime[-1], 86400.0 + 99.0)
+
+
+def _bearing_change_rates_with_loop(timestamp, bearing, min_time):
+    """Reference bearing change rates: the backward scan from every fix
+    igc_lib used to run (which also considers the first fix)."""
+    rates = [0.0] * len(timestamp)
+    for curr_fix in range(len(timestamp)):
+        for prev_fix in range(curr_fix - 1, -1, -1):
+            if (math.fabs(timestamp[curr_fix] - timestamp[prev_fix]) >
+                    min_time - 1e-7):
+                bearing_change = bearing[prev_fix] - bearing[curr_fix]
+                if math.fabs(bearing_change) > 180.0:
+                    if bearing_change < 0.0:
+                        bearing_change += 360.0
+                    else:
+                        bearing_change -= 360.0
+                rates[curr_fix] = bearing_change / (
+                    timestamp[prev_fix] - timestamp[curr_fix])
+                break
+    return rates
+
+
+class TestBearingChangeRates(unittest.TestCase):
+
+    def rates(self, timestamp, bearing):
+        flight = igc_lib.Flight.__new__(igc_lib.Flight)
+        flight._config = igc_lib.FlightParsingConfig()
+        n = len(timestamp)
+        flight.fixes = igc_lib.FixArray(
+            [0.0] * n, [0.0] * n, [0.0] * n, ['A'] * n, [0.0] * n,
+            [0.0] * n, range(n), [''] * n)
+        flight.fixes.timestamp = np.asarray(timestamp, dtype=np.float64)
+        flight.fixes.bearing = np.asarray(bearing, dtype=np.float64)
+        flight._compute_bearing_change_rates()
+        return flight.fixes.bearing_change_rate
+
+    def testMatchesLoop(self):
+        random = np.random.RandomState(7)
+        min_time = igc_lib.FlightParsingConfig().min_time_for_bearing_change
+        for case in range(30):
+            n = random.randint(1, 300)
+            steps = random.choice([0.0, 0.2, 0.5, 1.0, 4.0, 5.0, 60.0],
+                                  size=n)
+            if case % 3 == 0:
+                # A few fixes going back in time.
+                steps[random.randint(0, n, size=3)] = -7.0
+            timestamp = 1.5e9 + np.cumsum(steps)
+            bearing = random.uniform(0.0, 360.0, size=n)
+            expected = _bearing_change_rates_with_loop(
+                timestamp.tolist(), bearing.tolist(), min_time)
+            np.testing.assert_allclose(self.rates(timestamp, bearing),
+                                       expected, rtol=1e-12, atol=0.0)
+
+    def testFirstFixIsAPredecessor(self):
+        rates = self.rates(1.5e9 + np.arange(7.0),
+                           [350.0, 0.0, 0.0, 0.0, 0.0, 10.0, 10.0])
+        self.assertListEqual(rates.tolist(),
+                             [0.0] * 5 + [4.0, 2.0])
+
+
+def _flight_with_loops(outputs, rawtime, config):
+    """Reference flight detection post-processing and takeoff/landing: the
+    fix by fix loops igc_lib used to run."""
+    flying = [False] * len(outputs)
+    ignore_next_downtime = False
+    apply_next_downtime = False
+    for i, output in enumerate(outputs):
+        if output == 1:
+            flying[i] = True
+            ignore_next_downtime = False
+            apply_next_downtime = False
+        elif apply_next_downtime or ignore_next_downtime:
+            flying[i] = not apply_next_downtime
+        else:
+            j = i + 1
+            while j < len(outputs) and outputs[j] != 1:
+                j += 1
+            if (j == len(outputs) or
+                    rawtime[j] - rawtime[i] >= config.min_landing_time):
+                apply_next_downtime = True
+                flying[i] = False
+            else:
+                ignore_next_downtime = True
+                flying[i] = True
+
+    takeoff_row = None
+    landing_row = None
+    was_flying = False
+    for row, fix_flying in enumerate(flying):
+        if fix_flying and takeoff_row is None:
+            takeoff_row = row
+        if not fix_flying and was_flying:
+            landing_row = row
+            if config.which_flight_to_pick == "first":
+                break
+        was_flying = fix_flying
+    if takeoff_row is not None and landing_row is None:
+        landing_row = len(flying) - 1
+    return flying, takeoff_row, landing_row
+
+
+class FirstFlightConfig(igc_lib.FlightParsingConfig):
+    which_flight_to_pick = "first"
+
+
+class TestFlightSegments(unittest.TestCase):
+
+    def testMatchesLoops(self):
+        random = np.random.RandomState(11)
+        for case in range(40):
+            n = random.randint(1, 300)
+            # Runs of random lengths, some longer than min_landing_time.
+            lengths = random.choice([1, 3, 20, 80], size=n)
+            outputs = np.repeat(np.arange(n) % 2, lengths)[:n]
+            if case % 2:
+                outputs = 1 - outputs
+            rawtime = 36000.0 + np.cumsum(
+                random.choice([1.0, 2.0, 5.0], size=n))
+            config_class = [igc_lib.FlightParsingConfig,
+                            FirstFlightConfig][case % 3 == 0]
+            flight = igc_lib.Flight.__new__(igc_lib.Flight)
+            flight._config = config_class()
+            flight.fixes = igc_lib.FixArray(
+                rawtime, [0.0] * n, [0.0] * n, ['A'] * n, [0.0] * n,
+                [0.0] * n, range(n), [''] * n)
+            flight.notes = []
+            flight._compute_flight(outputs.astype(np.int8))
+            flight._compute_takeoff_landing()
+
+            flying, takeoff_row, landing_row = _flight_with_loops(
+                outputs.tolist(), rawtime.tolist(), flight._config)
+            self.assertListEqual(flight.fixes.flying.tolist(), flying)
+            np.testing.assert_array_equal(
+                np.flatnonzero(flight.fixes.flying),
+                np.concatenate([np.arange(start, stop) for start, stop in
+                                flight.flying_segments] + [[]]))
+            if takeoff_row is None:
+                self.assertFalse(flight.valid)
+            else:
+                self.assertEqual(flight.takeoff_fix.index, takeoff_row)
+                self.assertEqual(flight.landing_fix.index, landing_row)
+
+
+def _segments_with_loop(flight):
+    """Reference thermals and glides: the fix by fix loop igc_lib used to
+    run. Returns lists of (enter, exit) and (enter, exit, track_length)."""
+    circling = flight.fixes.circling.tolist()
+    rawtime = flight.fixes.rawtime.tolist()
+    distances = [flight.fixes[i].distance_to(flight.fixes[i + 1])
+                 for i in range(len(circling) - 1)]
+    thermals = []
+    glides = []
+    circling_now = False
+    gliding_now = False
+    distance = 0.0
+    for row in range(flight.takeoff_fix.index,
+                     flight.landing_fix.index + 1):
+        if not circling_now and circling[row]:
+            circling_now = True
+            first_fix = row
+            distance_start_circling = distance
+        elif circling_now and not circling[row]:
+            circling_now = False
+            if (rawtime[row] - rawtime[first_fix] >
+                    flight._config.min_time_for_thermal - 1e-5):
+                thermals.append((first_fix, row))
+                glides.append((first_glide_fix, first_fix,
+                               distance_start_circling))
+                gliding_now = False
+        if gliding_now:
+            distance = distance + distances[row - 1]
+            last_glide_fix = row
+        else:
+            first_glide_fix = row
+            last_glide_fix = row
+            gliding_now = True
+            distance = 0.0
+    if gliding_now:
+        glides.append((first_glide_fix, last_glide_fix, distance))
+    return thermals, glides
+
+
+class TestSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = [igc_lib.Flight.create_from_file(igc_file)
+                        for igc_file in ['testfiles/napret.igc',
+                                         'testfiles/olsztyn.igc',
+                                         'testfiles/south.igc']]
+
+    def testMatchesLoop(self):
+        for flight in self.flights:
+            thermals, glides = _segments_with_loop(flight)
+            table = flight.thermal_segments
+            self.assertListEqual(
+                list(zip(table.enter_index.tolist(),
+                         table.exit_index.tolist())), thermals)
+            table = flight.glide_segments
+            self.assertListEqual(
+                list(zip(table.enter_index.tolist(),
+                         table.exit_index.tolist())),
+                [glide[:2] for glide in glides])
+            np.testing.assert_allclose(
+                table.track_length, [glide[2] for glide in glides],
+                rtol=1e-9)
+
+    def testTablesMatchObjects(self):
+        for flight in self.flights:
+            for table, segments in [(flight.thermal_segments,
+                                     flight.thermals),
+                                    (flight.glide_segments, flight.glides)]:
+                self.assertListEqual(
+                    table.time_change.tolist(),
+                    [segment.time_change() for segment in segments])
+                self.assertListEqual(
+                    table.alt_change.tolist(),
+                    [segment.alt_change() for segment in segments])
+            self.assertListEqual(
+                flight.glide_segments.track_length.tolist(),
+                [glide.track_length for glide in flight.glides])
+
+    def testObjectsAreBuiltOnRequest(self):
+        flight = self.flights[0]
+        self.assertNotIn('thermals', vars(flight))
+        self.assertGreater(len(flight.thermal_segments.enter_index), 0)
+        self.assertIs(flight.thermals[0].enter_fix.flight, flight)
+        self.assertEqual(flight.thermals[0].enter_fix.index,
+                         flight.thermal_segments.enter_index[0])
+        self.assertIn('thermals', vars(flight))
+
+
+class LocalDistanceConfig(igc_lib.FlightParsingConfig):
+    distance_backend = "local"
+
+
+class TestLocalDistanceBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.igc_file = 'testfiles/napret.igc'
+        self.flight = igc_lib.Flight.create_from_file(self.igc_file)
+        self.local = igc_lib.Flight.create_from_file(
+            self.igc_file, LocalDistanceConfig)
+
+    def testSameAnalysis(self):
+        self.assertTrue(self.local.valid)
+        np.testing.assert_allclose(self.local.fixes.gsp, self.flight.fixes.gsp,
+                                   rtol=1e-6)
+        np.testing.assert_array_equal(self.local.fixes.circling,
+                                      self.flight.fixes.circling)
+        self.assertListEqual(
+            [(t.enter_fix.index, t.exit_fix.index)
+             for t in self.local.thermals],
+            [(t.enter_fix.index, t.exit_fix.index)
+             for t in self.flight.thermals])
+        np.testing.assert_allclose(
+            [g.track_length for g in self.local.glides],
+            [g.track_length for g in self.flight.glides], rtol=1e-6)
+
+    def testTurnpointInRadius(self):
+        fix = self.local.fixes[100]
+        # Just inside and just outside a 1 km cylinder, 5 m from the edge.
+        for offset, inside in [(0.995, True), (1.005, False)]:
+            turnpoint = igc_lib.Turnpoint(
+                fix.lat + offset / 111.19492664455873, fix.lon, 1.0,
+                "cylinder")
+            self.assertEqual(turnpoint.in_radius(fix), inside)
+            self.assertEqual(turnpoint.in_radius(self.flight.fixes[100]),
+                             inside)